@@ -0,0 +1,4268 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 Tracy Poff. See LICENSE for details.
+
+"""
+Server-free memcached replacement.
+
+Gemstash provides a simple cache similar to memcached, appropriate for use in
+standalone applications which do not have access to a memcached server. Its
+usage should be familiar to users of python-memcached.
+
+Usage:
+
+    >>> import gemstash
+    >>> gs = gemstash.Client(gemstash.Stash())
+
+Each stash stores its own independent set of keys and values. Two clients
+accessing the same stash will get the same values.
+
+    >>> gs.set("foo", "bar", time=0)
+    True
+    >>> gs.get("foo")
+    'bar'
+    >>> gs.set("spam", "eggs", 300)
+    True
+    >>> gs.get("spam")
+    'eggs'
+    # five minutes later
+    >>> print(gs.get("spam"))
+    None
+
+Values can be stored with an expiry time, specified in seconds, after which they
+will be deleted from the cache (and not returned). Numbers greater than
+60*60*24*30 (thirty days) will be interpreted instead as an absolute timestamp
+in seconds since January 1, 1970 (epoch time). If the time parameter is set to
+0 or omitted, the item will never expire.
+
+"""
+
+import sys
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import functools
+import hashlib
+import heapq
+import itertools
+import math
+import mmap
+import multiprocessing
+import os
+import pickle
+import random
+import struct
+import threading
+import time as _time
+import zlib
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+
+SERVER_MAX_KEY_LENGTH = 250
+SERVER_MAX_VALUE_LENGTH = 1024*1024
+_DEAD_RETRY = 30  # number of seconds before retrying a dead server.
+_SOCKET_TIMEOUT = 3  #  number of seconds before sockets timeout.
+NAMESPACE_SEPARATOR = "\x1f"
+
+class SingleFlight(object):
+    """
+    Tracks values being computed for a stash, so that concurrent callers of
+    Client.get_or_set compute each key only once.
+
+    Each computation in progress is represented by a concurrent.futures.Future,
+    through which its result or exception is passed to any callers waiting on
+    the same key. Flights are tracked per process.
+
+    The time taken by the most recent computation of each key is also kept, for
+    up to max_durations keys, to decide when to refresh a value early.
+
+    """
+
+    def __init__(self, max_durations=10000):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.durations = collections.OrderedDict()
+        self.max_durations = max_durations
+
+    def begin(self, key):
+        """
+        Join the flight for key, or start one.
+
+        Returns the flight's Future, and whether the caller started it and is
+        therefore responsible for finishing it.
+
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self.flights[key] = concurrent.futures.Future()
+            return flight, True
+
+    def finish(self, key, flight, value=None, error=None):
+        """Finish a flight, passing its outcome to any waiting callers."""
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        if error is not None:
+            flight.set_exception(error)
+        else:
+            flight.set_result(value)
+
+    def record(self, key, seconds):
+        """Record the time taken to compute the value of key."""
+        with self.lock:
+            self.durations[key] = seconds
+            self.durations.move_to_end(key)
+            if len(self.durations) > self.max_durations:
+                self.durations.popitem(last=False)
+
+    def duration(self, key):
+        """Return the time last taken to compute key, or 0 if unknown."""
+        return self.durations.get(key, 0)
+
+
+class Namespaces(object):
+    """
+    Generation counters for the namespaces of a stash.
+
+    A key belongs to a namespace if it begins with the namespace's prefix: the
+    name of the namespace and its current generation, each followed by
+    NAMESPACE_SEPARATOR. The separator is a control character, which
+    Client.check_key does not allow, so no other key can begin with a prefix.
+    Invalidating a namespace increments its generation, changing its prefix,
+    so that the keys written before are no longer found; the keys themselves
+    are left to be evicted or reclaimed by the stash.
+
+    """
+
+    def __init__(self):
+        self.generations = {}
+        self.invalidated = False
+        self._prefixes = {}
+        self._lock = threading.RLock()
+
+    def prefix(self, namespace):
+        """Return the prefix of the keys in namespace."""
+        prefix = self._prefixes.get(namespace)
+        if prefix is None:
+            with self._lock:
+                prefix = self._prefixes.get(namespace)
+                if prefix is None:
+                    generation = self.generations.get(namespace, 0)
+                    prefix = self._prefixes[namespace] = _namespace_prefix(namespace,
+                                                                           generation)
+        return prefix
+
+    def invalidate(self, namespace):
+        """Increment the generation of namespace, returning the new generation."""
+        with self._lock:
+            return self.set(namespace, self.generations.get(namespace, 0) + 1)
+
+    def set(self, namespace, generation):
+        """Set the generation of namespace, returning it."""
+        with self._lock:
+            self.generations[namespace] = generation
+            self._prefixes[namespace] = _namespace_prefix(namespace, generation)
+            self.invalidated = True
+        return generation
+
+    def stale(self, key):
+        """Return whether key was written in an earlier generation of its namespace."""
+        return _stale(key, self.generations)
+
+
+def _namespace_prefix(namespace, generation):
+    if NAMESPACE_SEPARATOR in namespace:
+        raise ValueError("namespace may not contain {!r}".format(NAMESPACE_SEPARATOR))
+    return "{0}{2}{1}{2}".format(namespace, generation, NAMESPACE_SEPARATOR)
+
+
+def _stale(key, generations):
+    """
+    Return whether key belongs to a namespace in generations, but was written
+    in an earlier generation.
+
+    """
+    if key.__class__ is not str or NAMESPACE_SEPARATOR not in key:
+        return False
+    namespace, _, rest = key.partition(NAMESPACE_SEPARATOR)
+    generation = generations.get(namespace)
+    if generation is None:
+        return False
+    written, separator, _ = rest.partition(NAMESPACE_SEPARATOR)
+    return bool(separator) and written != str(generation)
+
+
+class PrefixIndex(object):
+    """
+    The str keys of a stash in sorted order, for finding keys by prefix.
+
+    The keys are held in a list of sorted blocks of up to 2 * BLOCK keys each,
+    as in a B+ tree of one level, so that adding or removing a key moves at
+    most one block's worth of references, and the keys beginning with a
+    prefix are found by bisection in time proportional to their number.
+
+    """
+
+    BLOCK = 512
+
+    def __init__(self):
+        self._blocks = []
+        self._maxes = []
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._blocks)
+
+    def add(self, key):
+        """Add key, if it is a str not already present."""
+        if key.__class__ is not str:
+            return
+        blocks, maxes = self._blocks, self._maxes
+        if not blocks:
+            blocks.append([key])
+            maxes.append(key)
+            self._len = 1
+            return
+        i = bisect.bisect_left(maxes, key)
+        if i == len(maxes):
+            # beyond the last key
+            i -= 1
+            block = blocks[i]
+            block.append(key)
+            maxes[i] = key
+        else:
+            block = blocks[i]
+            j = bisect.bisect_left(block, key)
+            if block[j] == key:
+                return
+            block.insert(j, key)
+        self._len += 1
+        if len(block) > 2 * self.BLOCK:
+            blocks.insert(i + 1, block[self.BLOCK:])
+            del block[self.BLOCK:]
+            maxes.insert(i, block[-1])
+
+    def discard(self, key):
+        """Remove key, if present."""
+        if key.__class__ is not str:
+            return
+        blocks, maxes = self._blocks, self._maxes
+        i = bisect.bisect_left(maxes, key)
+        if i == len(maxes):
+            return
+        block = blocks[i]
+        j = bisect.bisect_left(block, key)
+        if block[j] != key:
+            return
+        del block[j]
+        self._len -= 1
+        if not block:
+            del blocks[i]
+            del maxes[i]
+            return
+        if j == len(block):
+            maxes[i] = block[-1]
+        if (len(block) < self.BLOCK // 2 and i + 1 < len(blocks) and
+                len(block) + len(blocks[i + 1]) <= 2 * self.BLOCK):
+            # merge small blocks, so that they do not accumulate
+            block.extend(blocks.pop(i + 1))
+            maxes[i] = maxes.pop(i + 1)
+
+    def prefixed(self, prefix):
+        """Return a list of the keys beginning with prefix, in order."""
+        blocks = self._blocks
+        keys = []
+        i = bisect.bisect_left(self._maxes, prefix)
+        j = bisect.bisect_left(blocks[i], prefix) if i < len(blocks) else 0
+        while i < len(blocks):
+            block = blocks[i]
+            for key in itertools.islice(block, j, None):
+                if not key.startswith(prefix):
+                    return keys
+                keys.append(key)
+            i += 1
+            j = 0
+        return keys
+
+
+class _Lock(type(threading.RLock())):
+    """A reentrant lock, which ignores the operation names given to held."""
+
+    __slots__ = ()
+
+    def held(self, op):
+        return self
+
+
+class _Held(object):
+    """Hold a ProfiledLock for the operation op."""
+
+    __slots__ = ('lock', 'op')
+
+    def __init__(self, lock, op):
+        self.lock = lock
+        self.op = op
+
+    def __enter__(self):
+        return self.lock.acquire(op=self.op)
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+class ProfiledLock(object):
+    """
+    A reentrant lock which records how long threads wait for it and hold it.
+
+    Each outermost acquisition is attributed to an operation, named by the
+    caller: with lock.held("set"), or lock.acquire(op="set"). If the outermost
+    acquisition is not named, as with a plain "with lock:", the first name
+    given by a nested acquisition is used, or else "other". For each operation,
+    the number of acquisitions, how many of them had to wait, and the total and
+    longest wait and hold times are kept in stats.
+
+    lock is the lock to wrap; by default, a new threading.RLock.
+
+    """
+
+    FIELDS = ('acquires', 'contended', 'wait_seconds', 'max_wait_seconds',
+              'hold_seconds', 'max_hold_seconds')
+
+    def __init__(self, lock=None):
+        self.lock = lock or threading.RLock()
+        self.stats = {}
+        self._depth = 0
+        self._op = None
+        self._acquired = 0.0
+        self._waited = None
+
+    def held(self, op):
+        """Return a context manager holding the lock, on behalf of op."""
+        return _Held(self, op)
+
+    def acquire(self, blocking=True, timeout=-1, op=None):
+        started = _time.perf_counter()
+        if self.lock.acquire(False):
+            contended = False
+        elif not blocking:
+            return False
+        else:
+            if not self.lock.acquire(True, timeout):
+                return False
+            contended = True
+        # we hold the lock now, so the remaining state is ours to change
+        self._depth += 1
+        if self._depth == 1:
+            self._acquired = _time.perf_counter()
+            self._waited = self._acquired - started if contended else None
+            self._op = op
+        elif self._op is None:
+            self._op = op
+        return True
+
+    def release(self):
+        if self._depth == 1:
+            held = _time.perf_counter() - self._acquired
+            op = self._op or "other"
+            stats = self.stats.get(op)
+            if stats is None:
+                stats = self.stats[op] = dict.fromkeys(self.FIELDS, 0)
+            stats['acquires'] += 1
+            waited = self._waited
+            if waited is not None:
+                stats['contended'] += 1
+                stats['wait_seconds'] += waited
+                if waited > stats['max_wait_seconds']:
+                    stats['max_wait_seconds'] = waited
+            stats['hold_seconds'] += held
+            if held > stats['max_hold_seconds']:
+                stats['max_hold_seconds'] = held
+        self._depth -= 1
+        self.lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def report(self):
+        """Return a table of the stats, with the longest held operations first."""
+        lines = ["{:<16} {:>10} {:>10} {:>12} {:>12} {:>12} {:>12}".format(
+            "op", "acquires", "contended", "wait ms", "max wait ms", "hold ms",
+            "max hold ms")]
+        for op, stats in sorted(self.stats.items(),
+                                key=lambda item: -item[1]['hold_seconds']):
+            lines.append("{:<16} {:>10} {:>10} {:>12.3f} {:>12.3f} {:>12.3f} {:>12.3f}".format(
+                op, stats['acquires'], stats['contended'],
+                stats['wait_seconds'] * 1000, stats['max_wait_seconds'] * 1000,
+                stats['hold_seconds'] * 1000, stats['max_hold_seconds'] * 1000))
+        return "\n".join(lines)
+
+
+class BaseStash(collections.MutableMapping):
+    """
+    Storage machinery shared by Stash and MimicStash.
+
+    A stash may be bounded by number of items (max_items) and/or by the total
+    cost of the stored items (max_bytes). When a bound is exceeded, the least
+    recently used items are evicted to make room. The cost of an item is
+    computed by calling sizeof(key, value), where value is the stored form of
+    the item's value. If sizeof is not given, a default appropriate to the
+    stash type is used. A value of 0 for either bound means unbounded. The
+    total cost of the items is reported by bytes. It is kept up to date if
+    max_bytes is set, which records the cost of each item. Otherwise, reading
+    bytes visits every item, unless track_bytes is true: then the items
+    stored since bytes was last read are recorded, and sized when it is next
+    read. Either way of keeping bytes holds an extra dictionary entry per key.
+
+    Items with an expiry time are also tracked in a heap ordered by deadline, so
+    that cleanup need only visit the items which are due. Entries in the heap
+    for keys which have since been deleted are skipped when popped, and those
+    for keys which now expire later are pushed again with the later time.
+    Expired items are removed when read, when cleanup is called, or by a
+    background reaper thread started with start_reaper.
+
+    If max_value_length is given, values longer than max_value_length bytes
+    are not stored, as by memcached. Only str, bytes and the values stored by
+    Client in compressed or chunked form have a length; other values are
+    never rejected.
+
+    Keys may be grouped into namespaces, each of which can be invalidated at
+    once; see invalidate_namespace.
+
+    The expiry time of a key can be changed without rewriting its value with
+    touch, gat or get_multi_and_touch. A key touched with sliding true has its
+    expiry time pushed out again each time it is read, until it is replaced,
+    deleted or touched again without sliding. The sliding keys are kept in a
+    dictionary beside the cache, so that items need no extra field; the new
+    deadlines set by reads are not written to the journal.
+
+    If prefix_index is true, the str keys of the stash are also kept in a
+    PrefixIndex, so that keys_with_prefix, get_prefix and delete_prefix take
+    time proportional to the number of keys found, rather than to the size of
+    the stash. Keeping the index adds to the cost of adding and removing keys.
+
+    If a Journal is given, the contents of the stash are restored from it when
+    the stash is created, and every change is recorded in it thereafter.
+
+    If profile_lock is true, the write_lock is a ProfiledLock, and the time
+    spent waiting for and holding it by each operation is reported by
+    get_stats("locks").
+
+    Counts of operations are kept in the attributes named in COUNTERS, and are
+    reported with other statistics by get_stats, using the names memcached
+    uses. The counters are updated without locking, so under heavy contention
+    they may undercount slightly.
+
+    """
+
+    COUNTERS = ('get_hits', 'get_misses', 'get_expired', 'cmd_set', 'cmd_flush',
+                'total_items', 'delete_hits', 'delete_misses', 'incr_hits',
+                'incr_misses', 'decr_hits', 'decr_misses', 'cas_hits',
+                'cas_misses', 'cas_badval', 'evictions', 'expired_unfetched',
+                'evicted_unfetched', 'cmd_touch', 'touch_hits', 'touch_misses')
+
+    def __init__(self, max_items=0, max_bytes=0, sizeof=None, journal=None,
+                 profile_lock=False, max_value_length=0, prefix_index=False,
+                 track_bytes=False):
+        """Create a new Stash."""
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_value_length = max_value_length
+        self.track_bytes = track_bytes
+        self.sizeof = sizeof or self._sizeof
+        self.write_lock = ProfiledLock() if profile_lock else _Lock()
+        self._bytes = 0
+        for counter in self.COUNTERS:
+            setattr(self, counter, 0)
+        self.started = _time.time()
+        self._cas_ids = itertools.count(1)
+        self._sizes = dict()
+        self._unsized = dict()
+        self._lru = bool(max_items or max_bytes)
+        self._expiry = []
+        self._expiry_seq = itertools.count()
+        self._sliding = {}
+        self._reaper = None
+        self.reaper_stats = {
+            'reclaimed' : 0,
+            'slices' : 0,
+            'last_slice_items' : 0,
+            'last_slice_seconds' : 0.0,
+            'max_slice_seconds' : 0.0,
+        }
+        self.cache = self._new_cache()
+        self.prefix_index = PrefixIndex() if prefix_index else None
+        self.flights = SingleFlight()
+        self.namespaces = Namespaces()
+        self.journal = None
+        if journal is not None:
+            journal.open(self)
+            self.journal = journal
+
+    def __setitem__(self, key, value):
+        raise NotImplementedError("Add items to the stash using the set method.")
+
+    def __delitem__(self, key):
+        with self.write_lock.held("delete"):
+            self._delete(key)
+
+    def __iter__(self):
+        return iter(self.cache)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def incr(self, key, delta):
+        with self.write_lock.held("incr"):
+            item = self._fetch(key)
+            value = None if item is None else self._decode(item)
+            if not value:
+                if delta < 0:
+                    self.decr_misses += 1
+                else:
+                    self.incr_misses += 1
+                return None
+            if isinstance(value, str):
+                value = str(int(value) + delta)
+            elif isinstance(value, int):
+                value = value + delta
+            else:
+                # not a str or int, can't increment
+                raise ValueError("cannot increment or decrement non-numeric value")
+            if delta < 0:
+                self.decr_hits += 1
+            else:
+                self.incr_hits += 1
+            self._set(key, value, None)
+            return int(value)
+
+    def update(self, key, value, time=None):
+        with self.write_lock.held("update"):
+            if self._fetch(key) is None:
+                return False
+            else:
+                return self.set(key, value, time)
+
+    def touch(self, key, time, sliding=False):
+        """
+        Change the expiry time of key, keeping its value and cas id.
+
+        If sliding, each later read of key sets its expiry time to time seconds
+        after the read. Returns whether key was present.
+
+        """
+        _check_sliding(time, sliding)
+        with self.write_lock.held("touch"):
+            self.cmd_touch += 1
+            item = self._fetch(key)
+            if item is None:
+                self.touch_misses += 1
+                return False
+            self.touch_hits += 1
+            self._touch(key, item, time, sliding)
+            return True
+
+    def gat(self, key, time, sliding=False):
+        """
+        Look up key and change its expiry time, as by touch.
+
+        Returns a tuple of its value and cas id, as for stash[key], or None.
+
+        """
+        return self.get_multi_and_touch((key,), time, sliding).get(key)
+
+    def get_multi_and_touch(self, keys, time, sliding=False):
+        """
+        Look up several keys at once, changing the expiry time of each one
+        found, as by touch.
+
+        Returns a dictionary as for get_multi.
+
+        """
+        _check_sliding(time, sliding)
+        results = {}
+        decode = self._decode
+        with self.write_lock.held("get_multi_and_touch"):
+            for key in keys:
+                self.cmd_touch += 1
+                item = self._fetch(key)
+                if item is None:
+                    self.get_misses += 1
+                    self.touch_misses += 1
+                    continue
+                self.get_hits += 1
+                self.touch_hits += 1
+                item.fetched = True
+                self._touch(key, item, time, sliding)
+                results[key] = decode(item), item.cas_id
+        return results
+
+    def keys_with_prefix(self, prefix):
+        """
+        Return a sorted list of the keys which begin with prefix.
+
+        Only str keys are considered, and expired keys are not returned. Unless
+        the stash has a prefix_index, this visits every key.
+
+        """
+        with self.write_lock.held("keys_with_prefix"):
+            now = _time.time()
+            return [key for key in self._prefixed(prefix) if self._present(key, now)]
+
+    def get_prefix(self, prefix):
+        """
+        Look up every key which begins with prefix.
+
+        Returns a dictionary mapping each key to a tuple of its value and cas
+        id, as get_multi does.
+
+        """
+        with self.write_lock.held("get_prefix"):
+            return self.get_multi(self.keys_with_prefix(prefix))
+
+    def delete_prefix(self, prefix):
+        """
+        Delete every key which begins with prefix, returning a list of them.
+        Expired keys with the prefix are removed too, but are not listed.
+
+        """
+        deleted = []
+        with self.write_lock.held("delete_prefix"):
+            now = _time.time()
+            for key in self._prefixed(prefix):
+                if self._present(key, now):
+                    self._delete(key)
+                    deleted.append(key)
+                else:
+                    self._expire(key)
+        return deleted
+
+    def namespace_prefix(self, namespace):
+        """
+        Return the prefix of the keys in namespace, in its current generation.
+
+        See invalidate_namespace.
+
+        """
+        return self.namespaces.prefix(namespace)
+
+    def invalidate_namespace(self, namespace):
+        """
+        Invalidate every key in namespace at once, returning its new generation.
+
+        Keys beginning with namespace_prefix(namespace) belong to the namespace.
+        Invalidating it increments its generation, which changes its prefix, so
+        the keys written with the old prefix are no longer found. The cost does
+        not depend on the number of keys: they are left in place, to be evicted
+        in time, since they are never read again, or removed by cleanup.
+
+        """
+        with self.write_lock.held("invalidate_namespace"):
+            generation = self.namespaces.invalidate(namespace)
+            if self.journal is not None:
+                self.journal.write(('namespace', namespace, generation))
+            return generation
+
+    def flush(self):
+        with self.write_lock.held("flush"):
+            self.cmd_flush += 1
+            if self.journal is not None:
+                self.journal.write(('flush',))
+            self.cache = self._new_cache()
+            if self.prefix_index is not None:
+                self.prefix_index = PrefixIndex()
+            self._sizes = dict()
+            self._unsized = dict()
+            self._expiry = []
+            self._sliding = {}
+            self._bytes = 0
+
+    def cas(self, key, value, time, cas_id):
+        with self.write_lock.held("cas"):
+            item = self._fetch(key)
+            if item is None or not cas_id:
+                if item is None:
+                    self.cas_misses += 1
+                return self.set(key, value, time)
+            else:
+                if cas_id == item.cas_id:
+                    self.cas_hits += 1
+                    return self.set(key, value, time)
+                else:
+                    self.cas_badval += 1
+                    return 0
+
+    def modify(self, key, func):
+        """
+        Replace the value of key with one computed from it, atomically.
+
+        func is called with None if key is not present, or else a tuple of its
+        value, cas id and expiry time (in seconds since the epoch, or None for
+        never), and no other change is made to key until it returns. It returns
+        None to leave the stash unchanged, or a tuple of the new value and its
+        time, as for set.
+
+        Returns None if func did, or else whether the new value was stored.
+
+        """
+        with self.write_lock.held("modify"):
+            item = self._fetch(key)
+            found = None if item is None else (self._decode(item), item.cas_id, item.expires)
+            change = func(found)
+            if change is None:
+                return None
+            return self.set(key, *change)
+
+    def set(self, key, value, time):
+        with self.write_lock.held("set"):
+            self.cmd_set += 1
+            return self._set(key, value, time)
+
+    def get_multi(self, keys):
+        """
+        Look up several keys at once.
+
+        Returns a dictionary mapping each key which is present to a tuple of its
+        value and cas id, as for stash[key]. The keys are read under a single
+        acquisition of the write_lock, so the result is a consistent snapshot.
+
+        """
+        results = {}
+        decode = self._decode
+        with self.write_lock.held("get_multi"):
+            cache, lru, sliding = self.cache, self._lru, self._sliding
+            # read the clock only if some item can expire
+            now = None
+            for key in keys:
+                item = cache.get(key)
+                if item is not None and item.expires:
+                    if now is None:
+                        now = _time.time()
+                    if item.expires < now:
+                        self.get_expired += 1
+                        self._expire(key)
+                        item = None
+                    elif sliding and key in sliding:
+                        item.expires = now + sliding[key]
+                if item is None:
+                    # a TieredStash may still have it on disk
+                    item = self._fetch(key, now)
+                    if item is None:
+                        self.get_misses += 1
+                        continue
+                elif lru:
+                    cache.move_to_end(key)
+                item.fetched = True
+                results[key] = decode(item), item.cas_id
+            self.get_hits += len(results)
+        return results
+
+    def set_multi(self, mapping, time, atomic=False):
+        """
+        Set several keys at once, all with the same expiry time.
+
+        Returns a list of the keys which could not be set. If atomic, either
+        every key is set or, if they would not all fit within the stash's
+        bounds at once, none are and every key is returned.
+
+        """
+        with self.write_lock.held("set_multi"):
+            items = self._prepare(mapping, time)
+            if atomic and not self._fits(items):
+                return list(mapping)
+            return self._store_all(items)
+
+    def delete_multi(self, keys, atomic=False):
+        """
+        Delete several keys at once.
+
+        Returns a list of the keys which were not present. If atomic, nothing
+        is deleted unless every key is present.
+
+        """
+        with self.write_lock.held("delete_multi"):
+            if atomic:
+                now = _time.time()
+                missing = [key for key in keys if self._fetch(key, now) is None]
+                if missing:
+                    self.delete_misses += len(missing)
+                    return missing
+            return [key for key in keys if not self._delete(key)]
+
+    def get_stats(self, stat_args=None):
+        """
+        Return a dictionary of statistics about the stash.
+
+        With no stat_args, the general statistics are returned, as memcached's
+        "stats" command does. "items" returns statistics about the items in the
+        stash, "reaper" the statistics of the reaper thread, "locks" the
+        statistics of a ProfiledLock, as "op:field", with totals over all
+        operations under the bare field names, and "compression" the number
+        of values held compressed by Client, with the bytes they occupy and
+        the bytes they hold. Other values return an empty dictionary.
+
+        Computing "bytes" visits every item in the stash, unless max_bytes or
+        track_bytes is set, and computing "compression" always does.
+
+        """
+        if stat_args == "items":
+            return {
+                'number' : len(self),
+                'evicted' : self.evictions,
+                'evicted_unfetched' : self.evicted_unfetched,
+                'expired_unfetched' : self.expired_unfetched,
+            }
+        elif stat_args == "reaper":
+            return dict(self.reaper_stats)
+        elif stat_args == "locks":
+            return self._lock_stats()
+        elif stat_args == "compression":
+            return self._compression_stats()
+        elif stat_args is not None:
+            return {}
+        now = _time.time()
+        stats = {
+            'pid' : os.getpid(),
+            'uptime' : int(now - self.started),
+            'time' : int(now),
+            'curr_items' : len(self),
+            'bytes' : self.bytes,
+            'limit_maxbytes' : self.max_bytes,
+            'limit_maxitems' : self.max_items,
+            'cmd_get' : self.get_hits + self.get_misses,
+            'reclaimed' : self.reaper_stats['reclaimed'],
+        }
+        for counter in self.COUNTERS:
+            stats[counter] = getattr(self, counter)
+        return stats
+
+    def cleanup(self):
+        """Remove expired items from the cache.
+
+        Returns a list of keys removed. If a namespace has been invalidated
+        since the last cleanup, this visits every item, to remove those in the
+        namespace's earlier generations.
+
+        """
+        removed, _ = self._reap()
+        if self.namespaces.invalidated:
+            self.namespaces.invalidated = False
+            removed.extend(self._reclaim(self.namespaces.stale))
+        return removed
+
+    def start_reaper(self, interval=1.0, budget_ms=1.0):
+        """
+        Start a background thread which removes expired items.
+
+        Every interval seconds, the reaper removes the items which have expired.
+        The work is done in slices, each holding the write_lock for about
+        budget_ms milliseconds at most, so that other threads using the stash
+        are not held up for long. Counts of items reclaimed and the duration of
+        the slices are kept in reaper_stats.
+
+        """
+        with self.write_lock.held("start_reaper"):
+            if self._reaper is not None:
+                raise RuntimeError("reaper is already running")
+            stop = threading.Event()
+            thread = threading.Thread(target=self._run_reaper,
+                                      args=(stop, interval, budget_ms / 1000),
+                                      name="gemstash-reaper", daemon=True)
+            self._reaper = thread, stop
+        thread.start()
+
+    def stop_reaper(self):
+        """Stop the reaper thread, if running, and wait for it to exit."""
+        with self.write_lock.held("stop_reaper"):
+            reaper, self._reaper = self._reaper, None
+        if reaper is not None:
+            thread, stop = reaper
+            stop.set()
+            thread.join()
+
+    def _run_reaper(self, stop, interval, budget):
+        stats = self.reaper_stats
+        while not stop.wait(interval):
+            finished = False
+            while not finished and not stop.is_set():
+                started = _time.perf_counter()
+                removed, finished = self._reap(budget, "reaper")
+                elapsed = _time.perf_counter() - started
+                stats['reclaimed'] += len(removed)
+                stats['slices'] += 1
+                stats['last_slice_items'] = len(removed)
+                stats['last_slice_seconds'] = elapsed
+                if elapsed > stats['max_slice_seconds']:
+                    stats['max_slice_seconds'] = elapsed
+
+    def _reap(self, budget=None, op="cleanup"):
+        """
+        Remove expired items, giving up after about budget seconds.
+
+        Returns the list of keys removed, and whether all expired items were
+        removed. The time spent holding the write_lock is attributed to op.
+
+        """
+        removed = []
+        with self.write_lock.held(op):
+            if budget is not None:
+                deadline = _time.perf_counter() + budget
+            now = _time.time()
+            expiry = self._expiry
+            while expiry and expiry[0][0] < now:
+                expires, _, key = heapq.heappop(expiry)
+                item = self.cache.get(key)
+                # the key may have been replaced or deleted since it was pushed
+                if item is not None and item.expires == expires:
+                    self._expire(key)
+                    removed.append(key)
+                elif item is not None and item.expires and item.expires > expires:
+                    # replaced or touched since; queue it for its new time
+                    heapq.heappush(expiry, (item.expires, next(self._expiry_seq), key))
+                if budget is not None and _time.perf_counter() > deadline:
+                    return removed, not (expiry and expiry[0][0] < now)
+        return removed, True
+
+    def _reclaim(self, stale):
+        """Remove every key for which stale(key) is true, returning them."""
+        with self.write_lock.held("cleanup"):
+            removed = [key for key in self if stale(key)]
+            for key in removed:
+                self._remove(key)
+                if self.journal is not None:
+                    self.journal.write(('delete', key))
+        return removed
+
+    def _new_cache(self):
+        if self._lru:
+            return collections.OrderedDict()
+        return dict()
+
+    def _fetch(self, key, now=None):
+        """
+        Return the live item stored under key, or None.
+
+        now, if given, is the current time, for callers fetching many keys.
+
+        """
+        item = self.cache.get(key)
+        if item is None:
+            return None
+        if item.expires:
+            if item.expires < (now or _time.time()):
+                with self.write_lock.held("get"):
+                    if self.cache.get(key) is item:
+                        self.get_expired += 1
+                        self._expire(key)
+                return None
+            if self._sliding:
+                ttl = self._sliding.get(key)
+                if ttl is not None:
+                    item.expires = (now or _time.time()) + ttl
+        if self._lru:
+            try:
+                self.cache.move_to_end(key)
+            except KeyError:
+                # deleted by another thread since we looked it up
+                pass
+        return item
+
+    def _store(self, key, item):
+        """
+        Store item under key, evicting other items if a bound is exceeded.
+
+        Returns False, leaving the stash unchanged, if the item alone is larger
+        than max_bytes, or its value longer than max_value_length. The caller
+        must hold the write_lock.
+
+        """
+        limit = self.max_value_length
+        if limit:
+            value = item.value
+            if len(value) > limit if value.__class__ is bytes else _too_long(value, limit):
+                return False
+        if self.max_bytes:
+            size = self.sizeof(key, item.value)
+            if size > self.max_bytes:
+                return False
+        if self.journal is not None:
+            self.journal.write(('set', key, tuple(item)))
+        if self.max_bytes:
+            self._bytes += size - self._sizes.get(key, 0)
+            self._sizes[key] = size
+        elif self.track_bytes:
+            self._unsized[key] = item
+        if self.prefix_index is not None and key not in self.cache:
+            self.prefix_index.add(key)
+        if self._sliding:
+            self._sliding.pop(key, None)
+        self.cache[key] = item
+        self.total_items += 1
+        if item.expires:
+            heapq.heappush(self._expiry, (item.expires, next(self._expiry_seq), key))
+            if len(self._expiry) > 2 * len(self.cache) + 64:
+                self._rebuild_expiry()
+        if self._lru:
+            self.cache.move_to_end(key)
+            self._evict()
+        return True
+
+    def _restore(self, record):
+        """Apply a record read from the journal."""
+        op = record[0]
+        if op == 'set':
+            item = self.CachedItem(*record[2])
+            if isinstance(item.expires, datetime.datetime):
+                # written before expiry times were stored as timestamps
+                item.expires = item.expires.timestamp()
+            if isinstance(item.cas_id, int):
+                # never reissue a cas id which was in use before the restart
+                self._cas_ids = itertools.count(max(item.cas_id + 1, next(self._cas_ids)))
+            if item.expires and item.expires < _time.time():
+                self._remove(record[1])
+            else:
+                self._store(record[1], item)
+        elif op == 'delete':
+            self._remove(record[1])
+        elif op == 'flush':
+            self.flush()
+        elif op == 'namespace':
+            self.namespaces.set(record[1], record[2])
+
+    def _remove(self, key):
+        """Remove key from the stash, if present. Caller holds the write_lock."""
+        item = self.cache.pop(key, None)
+        if item is not None:
+            if self._sizes:
+                self._bytes -= self._sizes.pop(key, 0)
+            if self._unsized:
+                self._unsized.pop(key, None)
+            if self.prefix_index is not None:
+                self.prefix_index.discard(key)
+            if self._sliding:
+                self._sliding.pop(key, None)
+        return item
+
+    def _expire(self, key):
+        """Remove an expired item. Caller holds the write_lock."""
+        item = self.cache.get(key)
+        if item is not None and not item.fetched:
+            self.expired_unfetched += 1
+        self._remove(key)
+
+    def _delete(self, key):
+        """
+        Delete key, returning whether it was present. The caller holds the
+        write_lock.
+
+        """
+        if self._remove(key) is None:
+            self.delete_misses += 1
+            return False
+        self.delete_hits += 1
+        if self.journal is not None:
+            self.journal.write(('delete', key))
+        return True
+
+    def _prepare(self, mapping, time):
+        """Return a list of (key, item) to store for mapping."""
+        expires = self._expires(time)
+        return [(key, self._item(value, expires)) for key, value in mapping.items()]
+
+    def _fits(self, items):
+        """
+        Return whether all of items can be stored at once without any of them
+        being rejected or evicting another. The caller holds the write_lock.
+
+        """
+        if self.max_items and len(items) > self.max_items:
+            return False
+        limit = self.max_value_length
+        if limit and any(_too_long(item.value, limit) for _, item in items):
+            return False
+        if self.max_bytes:
+            sizeof = self.sizeof
+            return sum(sizeof(key, item.value) for key, item in items) <= self.max_bytes
+        return True
+
+    def _store_all(self, items):
+        """Store each (key, item), returning the keys which were rejected."""
+        self.cmd_set += len(items)
+        return [key for key, item in items if not self._store(key, item)]
+
+    def _lock_stats(self):
+        stats = {}
+        profile = getattr(self.write_lock, 'stats', None)
+        if profile is None:
+            return stats
+        for op, fields in list(profile.items()):
+            for field, value in list(fields.items()):
+                stats["{}:{}".format(op, field)] = value
+                if field.startswith('max_'):
+                    stats[field] = max(stats.get(field, 0), value)
+                else:
+                    stats[field] = stats.get(field, 0) + value
+        return stats
+
+    def _compression_stats(self):
+        items = stored = raw = 0
+        for item in list(self.cache.values()):
+            value = item.value
+            if value.__class__ is Compressed:
+                items += 1
+                stored += len(value)
+                raw += value.raw_length
+        return {
+            'compressed_items' : items,
+            'compressed_bytes' : stored,
+            'compressed_raw_bytes' : raw,
+        }
+
+    @property
+    def bytes(self):
+        """The total cost of the items in the stash, as computed by sizeof."""
+        if not (self.max_bytes or self.track_bytes):
+            sizeof = self.sizeof
+            return sum(sizeof(key, item.value) for key, item in list(self.cache.items()))
+        if self._unsized:
+            with self.write_lock.held("bytes"):
+                sizes, sizeof = self._sizes, self.sizeof
+                for key, item in self._unsized.items():
+                    size = sizeof(key, item.value)
+                    self._bytes += size - sizes.get(key, 0)
+                    sizes[key] = size
+                self._unsized = dict()
+        return self._bytes
+
+    def _rebuild_expiry(self):
+        """Rebuild the expiry heap, dropping entries for stale items."""
+        seq = self._expiry_seq
+        self._expiry = [(item.expires, next(seq), key)
+                        for key, item in self.cache.items() if item.expires]
+        heapq.heapify(self._expiry)
+
+    def _evict(self):
+        """Evict least recently used items until the stash is within bounds."""
+        while ((self.max_items and len(self.cache) > self.max_items) or
+               (self.max_bytes and self._bytes > self.max_bytes)):
+            key, item = self.cache.popitem(last=False)
+            self._bytes -= self._sizes.pop(key, 0)
+            if self._unsized:
+                self._unsized.pop(key, None)
+            if not item.fetched:
+                self.evicted_unfetched += 1
+            self._evicted(key, item)
+
+    def _evicted(self, key, item):
+        """Called with each item evicted from the stash."""
+        self.evictions += 1
+        if self.prefix_index is not None:
+            self.prefix_index.discard(key)
+        if self._sliding:
+            self._sliding.pop(key, None)
+
+    def _touch(self, key, item, time, sliding):
+        """Change the expiry time of item, stored under key. Caller holds the write_lock."""
+        expires = self._expires(time)
+        if expires and not (item.expires and item.expires < expires):
+            # a later time is pushed when the entry for the earlier one is popped
+            heapq.heappush(self._expiry, (expires, next(self._expiry_seq), key))
+            if len(self._expiry) > 2 * len(self.cache) + 64:
+                self._rebuild_expiry()
+        item.expires = expires
+        if sliding:
+            self._sliding[key] = time
+        elif self._sliding:
+            self._sliding.pop(key, None)
+        if self.journal is not None:
+            self.journal.write(('set', key, tuple(item)))
+
+    def _snapshot_items(self):
+        """Return a list of (key, item) for every item, for a Journal snapshot."""
+        return list(self.cache.items())
+
+    def _prefixed(self, prefix):
+        """Return a sorted list of the keys beginning with prefix, even if expired."""
+        if self.prefix_index is not None:
+            return self.prefix_index.prefixed(prefix)
+        return sorted(key for key in self if key.__class__ is str and key.startswith(prefix))
+
+    def _present(self, key, now):
+        """Return whether key is held and unexpired, without fetching it."""
+        item = self.cache.get(key)
+        return item is not None and not (item.expires and item.expires < now)
+
+    @staticmethod
+    def _ttl(expires):
+        if expires:
+            return expires - _time.time()
+        return None
+
+    @staticmethod
+    def _expires(time):
+        """Return the expiry time, in seconds since the epoch, or None for never."""
+        if time and time > 60*60*24*30:
+            return float(time)
+        elif not time:
+            return None
+        else:
+            return _time.time() + time
+
+
+class Stash(BaseStash):
+    """A cache, taking place of a memcached server for a gemstash Client."""
+
+    class CachedItem(object):
+        """
+        An item in a Stash.
+
+        expires is in seconds since the epoch, or None if the item never
+        expires, and cas_id is taken from the stash's counter. fetched records
+        whether the item has been read, for the expired_unfetched and
+        evicted_unfetched statistics; stash[key] does not record reads of
+        items which can neither expire nor be evicted. Iterating over an item
+        gives the fields which are persisted.
+
+        """
+
+        __slots__ = ('value', 'expires', 'cas_id', 'fetched')
+
+        def __init__(self, value, expires, cas_id):
+            self.value = value
+            self.expires = expires
+            self.cas_id = cas_id
+            self.fetched = False
+
+        def __iter__(self):
+            return iter((self.value, self.expires, self.cas_id))
+
+    def __getitem__(self, key):
+        item = self.cache.get(key)
+        if item is None:
+            self.get_misses += 1
+            return None
+        if item.expires and (item.expires < _time.time() or self._sliding):
+            # expired or perhaps sliding, which _fetch deals with
+            item = self._fetch(key)
+            if item is None:
+                self.get_misses += 1
+                return None
+            item.fetched = True
+        elif self._lru:
+            try:
+                self.cache.move_to_end(key)
+            except KeyError:
+                # deleted by another thread since we looked it up
+                pass
+            item.fetched = True
+        elif item.expires:
+            item.fetched = True
+        self.get_hits += 1
+        return item.value, item.cas_id
+
+    def lookup(self, key):
+        """
+        Like stash[key], but also return the time to live of the item.
+
+        Returns None if key is not in the stash, or else a tuple of the value,
+        its cas id and the number of seconds until it expires, which is None if
+        it never does.
+
+        """
+        item = self._fetch(key)
+        if item is None:
+            self.get_misses += 1
+            return None
+        else:
+            self.get_hits += 1
+            item.fetched = True
+            return item.value, item.cas_id, self._ttl(item.expires)
+
+    def _set(self, key, value, time):
+        with self.write_lock.held("set"):
+            return self._store(key, self._item(value, self._expires(time)))
+
+    def _item(self, value, expires):
+        return self.CachedItem(value, expires, next(self._cas_ids))
+
+    def append(self, key, value, time):
+        with self.write_lock.held("append"):
+            item = self._fetch(key)
+            original = None if item is None else item.value
+            if not original:
+                return False
+            if isinstance(original, str):
+                value = original + str(value)
+            elif original.__class__ is Compressed:
+                value = original.append(value)
+                if value is None:
+                    return False
+            elif isinstance(original, int):
+                try:
+                    value = int(str(original) + str(value))
+                except ValueError as e:
+                    raise ValueError("cannot append non-numeric value to int") from e
+            elif isinstance(original, float):
+                try:
+                    value = float(str(original) + str(value))
+                except ValueError as e:
+                    raise ValueError("cannot append non-numeric value to float") from e
+            else:
+                return False
+
+            return self.set(key, value, time)
+
+    def prepend(self, key, value, time):
+        with self.write_lock.held("prepend"):
+            item = self._fetch(key)
+            original = None if item is None else item.value
+            if not original:
+                return False
+            if isinstance(original, str):
+                value = str(value) + original
+            elif original.__class__ is Compressed:
+                value = original.prepend(value)
+                if value is None:
+                    return False
+            elif isinstance(original, int):
+                try:
+                    value = int(str(value) + str(original))
+                except ValueError as e:
+                    raise ValueError("cannot prepend non-numeric value to int") from e
+            elif isinstance(original, float):
+                try:
+                    value = float(str(value) + str(original))
+                except ValueError as e:
+                    raise ValueError("cannot prepend non-numeric value to float") from e
+            else:
+                return False
+
+            return self.set(key, value, time)
+
+    @staticmethod
+    def _decode(item):
+        return item.value
+
+    @staticmethod
+    def _sizeof(key, value):
+        return sys.getsizeof(key) + sys.getsizeof(value)
+
+
+class MimicStash(BaseStash):
+    """
+    A cache, mimicking a memcached server for a gemstash Client.
+
+    This Stash behaves more like python-memcached + memcached. Use when closer
+    correspondence between gemstash and memcache behvior is required.
+
+    """
+
+    class CachedItem(object):
+        """
+        An item in a MimicStash, as for a Stash, but with its value encoded.
+
+        Until the value is first read, decoded holds the _MimicCodec for its
+        type, given by tag (or, in journals written by older versions, by
+        the codec's parse function); after that, it holds the decoded value,
+        so that it is decoded only once. An item has been fetched once its
+        value has been decoded.
+
+        """
+
+        __slots__ = ('value', 'expires', 'decoded', 'cas_id')
+
+        def __init__(self, value, expires, codec, cas_id):
+            self.value = value
+            self.expires = expires
+            self.decoded = codec if codec.__class__ is _MimicCodec else _MIMIC_CODECS[codec]
+            self.cas_id = cas_id
+
+        @property
+        def codec(self):
+            decoded = self.decoded
+            if decoded.__class__ is _MimicCodec:
+                return decoded
+            return _MIMIC_TYPES.get(decoded.__class__, _MIMIC_ENCODED)
+
+        @property
+        def fetched(self):
+            return self.decoded.__class__ is not _MimicCodec
+
+        @fetched.setter
+        def fetched(self, fetched):
+            # an item is fetched when it is decoded
+            pass
+
+        def __iter__(self):
+            return iter((self.value, self.expires, self.codec.tag, self.cas_id))
+
+    def __init__(self, mimic=True, *args, **kwargs):
+        """Create a new Stash, by default rejecting values as memcached does."""
+        kwargs.setdefault('max_value_length', SERVER_MAX_VALUE_LENGTH)
+        super().__init__(*args, **kwargs)
+        self.mimic = mimic
+
+    def __getitem__(self, key):
+        # as Stash.__getitem__, but an item is fetched once it is decoded
+        item = self.cache.get(key)
+        if item is None:
+            self.get_misses += 1
+            return None
+        if item.expires and (item.expires < _time.time() or self._sliding):
+            item = self._fetch(key)
+            if item is None:
+                self.get_misses += 1
+                return None
+        elif self._lru:
+            try:
+                self.cache.move_to_end(key)
+            except KeyError:
+                pass
+        self.get_hits += 1
+        value = item.decoded
+        if value.__class__ is _MimicCodec:
+            value = item.decoded = value.parse(item.value)
+        return value, item.cas_id
+
+    def lookup(self, key):
+        """Like stash[key], but also return the time to live of the item."""
+        item = self._fetch(key)
+        if item is None:
+            self.get_misses += 1
+            return None
+        else:
+            self.get_hits += 1
+            return self._decode(item), item.cas_id, self._ttl(item.expires)
+
+    def _set(self, key, value, time):
+        with self.write_lock.held("set"):
+            return self._store(key, self._item(value, self._expires(time)))
+
+    def _item(self, value, expires):
+        if value.__class__ in _STORED_AS_IS:
+            return self.CachedItem(value, expires, _MIMIC_ENCODED, next(self._cas_ids))
+        if isinstance(value, int):
+            codec = _MIMIC_INT
+        elif isinstance(value, float):
+            codec = _MIMIC_FLOAT
+        else:
+            codec = _MIMIC_STR
+        value = str(value).encode("utf_8")
+        return self.CachedItem(value, expires, codec, next(self._cas_ids))
+
+    def append(self, key, value, time):
+        with self.write_lock.held("append"):
+            self.cmd_set += 1
+            item = self._fetch(key)
+            if item is None:
+                return False
+            original = item.value
+            if original.__class__ is Compressed:
+                value = original.append(value)
+                if value is None:
+                    return False
+            elif original.__class__ is not bytes:
+                return False
+            else:
+                if isinstance(self._decode(item), float):
+                    return True
+                value = original + str(value).encode("utf_8")
+            return self._store(key, self.CachedItem(value, self._expires(time), item.codec,
+                                                    next(self._cas_ids)))
+
+    def prepend(self, key, value, time):
+        with self.write_lock.held("prepend"):
+            self.cmd_set += 1
+            item = self._fetch(key)
+            if item is None:
+                return False
+            original = item.value
+            if original.__class__ is Compressed:
+                value = original.prepend(value)
+                if value is None:
+                    return False
+            elif original.__class__ is not bytes:
+                return False
+            else:
+                if isinstance(self._decode(item), float):
+                    return True
+                value = str(value).encode("utf_8") + original
+            return self._store(key, self.CachedItem(value, self._expires(time), item.codec,
+                                                    next(self._cas_ids)))
+
+    @staticmethod
+    def _decode(item):
+        value = item.decoded
+        if value.__class__ is _MimicCodec:
+            value = item.decoded = value.parse(item.value)
+        return value
+
+    @staticmethod
+    def _sizeof(key, value):
+        return len(key.encode("utf_8")) + len(value)
+
+def _parse_int(x):
+    return int(x.decode("utf_8"))
+
+def _parse_float(x):
+    return float(x.decode("utf_8"))
+
+def _parse_str(x):
+    return x.decode("utf_8")
+
+def _parse_encoded(x):
+    return x
+
+
+class _MimicCodec(object):
+    """How a MimicStash decodes the values of one type, identified by tag."""
+
+    __slots__ = ('tag', 'parse')
+
+    def __init__(self, tag, parse):
+        self.tag = tag
+        self.parse = parse
+
+_MIMIC_INT = _MimicCodec(0, _parse_int)
+_MIMIC_FLOAT = _MimicCodec(1, _parse_float)
+_MIMIC_STR = _MimicCodec(2, _parse_str)
+_MIMIC_ENCODED = _MimicCodec(3, _parse_encoded)
+
+# codecs by tag, and by parse function for journals written by older versions
+_MIMIC_CODECS = {}
+for _codec in (_MIMIC_INT, _MIMIC_FLOAT, _MIMIC_STR, _MIMIC_ENCODED):
+    _MIMIC_CODECS[_codec.tag] = _MIMIC_CODECS[_codec.parse] = _codec
+del _codec
+
+# codecs by the type of the values they decode
+_MIMIC_TYPES = {int : _MIMIC_INT, float : _MIMIC_FLOAT, str : _MIMIC_STR}
+
+
+CODECS = {'zlib' : (zlib.compress, zlib.decompress)}
+
+def register_codec(name, compress, decompress):
+    """
+    Make a compression codec available as Client(codec=name).
+
+    compress and decompress are functions taking and returning bytes.
+
+    """
+    CODECS[name] = compress, decompress
+
+
+class Compressed(object):
+    """
+    A str or bytes value stored compressed by Client.
+
+    The value is held as a sequence of frames, each compressed separately with
+    a codec from CODECS, between an uncompressed head and tail. Appending to
+    the value adds to its tail, and prepending to its head; once either
+    reaches threshold bytes, it is compressed into a new frame, so that the
+    existing frames are never decompressed and compressed again. Compressed
+    values are never modified: append and prepend return new ones.
+
+    len() of a Compressed value is the number of bytes it occupies, and its
+    raw_length the number of bytes of the value it holds.
+
+    """
+
+    __slots__ = ('codec', 'frames', 'head', 'tail', 'text', 'threshold', 'raw_length')
+
+    def __init__(self, codec, frames, head, tail, text, threshold, raw_length):
+        self.codec = codec
+        self.frames = frames
+        self.head = head
+        self.tail = tail
+        self.text = text
+        self.threshold = threshold
+        self.raw_length = raw_length
+
+    @classmethod
+    def compress(cls, value, threshold, codec='zlib'):
+        """
+        Compress a str or bytes value, or return None if that saves no space.
+
+        """
+        text = isinstance(value, str)
+        data = value.encode("utf_8") if text else bytes(value)
+        frame = CODECS[codec][0](data)
+        if len(frame) >= len(data):
+            return None
+        return cls(codec, (frame,), b'', b'', text, threshold, len(data))
+
+    def decompress(self):
+        """Return the value held, as it was before it was compressed."""
+        decompress = CODECS[self.codec][1]
+        data = b''.join([self.head] + [decompress(frame) for frame in self.frames] +
+                        [self.tail])
+        return data.decode("utf_8") if self.text else data
+
+    def append(self, value):
+        """
+        Return a new Compressed value with value appended, or None if value is
+        of the wrong type.
+
+        """
+        data = self._encode(value)
+        if data is None:
+            return None
+        return self._with(self.frames, self.head, self.tail + data, len(data))
+
+    def prepend(self, value):
+        """
+        Return a new Compressed value with value prepended, or None if value is
+        of the wrong type.
+
+        """
+        data = self._encode(value)
+        if data is None:
+            return None
+        return self._with(self.frames, data + self.head, self.tail, len(data))
+
+    def _encode(self, value):
+        if self.text:
+            return str(value).encode("utf_8")
+        if isinstance(value, (bytes, bytearray)):
+            return bytes(value)
+        return None
+
+    def _with(self, frames, head, tail, added):
+        compress = CODECS[self.codec][0]
+        if len(head) >= self.threshold:
+            frames = (compress(head),) + frames
+            head = b''
+        if len(tail) >= self.threshold:
+            frames = frames + (compress(tail),)
+            tail = b''
+        return Compressed(self.codec, frames, head, tail, self.text, self.threshold,
+                          self.raw_length + added)
+
+    def __len__(self):
+        return sum(map(len, self.frames)) + len(self.head) + len(self.tail)
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + len(self)
+
+    def __repr__(self):
+        return "<Compressed {} bytes of {} ({})>".format(len(self), self.raw_length,
+                                                         self.codec)
+
+
+class Chunked(object):
+    """
+    A large str or bytes value stored by Client as a sequence of chunks.
+
+    Each chunk but the last is chunk_size bytes long, so that no single
+    allocation is larger than chunk_size, and the length of the value as seen
+    by a stash's max_value_length is that of one chunk.
+
+    A Chunked value is returned as it is by Client.get for bytes, as a read-only
+    view of the value: iterating over it yields a memoryview of each chunk, so
+    that it can be written out with file.writelines or socket.sendmsg without
+    being copied, while bytes(value) joins the chunks into a single bytes
+    object. A str is always joined and decoded.
+
+    """
+
+    __slots__ = ('chunks', 'text', 'chunk_size')
+
+    def __init__(self, chunks, text, chunk_size):
+        self.chunks = chunks
+        self.text = text
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def split(cls, value, chunk_size):
+        """Split a str or bytes value into chunks of chunk_size bytes."""
+        text = isinstance(value, str)
+        view = memoryview(value.encode("utf_8") if text else value)
+        chunks = tuple(view[start:start + chunk_size].tobytes()
+                       for start in range(0, len(view), chunk_size))
+        return cls(chunks, text, chunk_size)
+
+    def join(self):
+        """Return the value held, as a single str or bytes object."""
+        data = b''.join(self.chunks)
+        return data.decode("utf_8") if self.text else data
+
+    def __bytes__(self):
+        return b''.join(self.chunks)
+
+    def __iter__(self):
+        return map(memoryview, self.chunks)
+
+    def __len__(self):
+        return sum(map(len, self.chunks))
+
+    def __eq__(self, other):
+        if isinstance(other, Chunked):
+            return self.text == other.text and bytes(self) == bytes(other)
+        if isinstance(other, (bytes, bytearray, memoryview)) and not self.text:
+            other = memoryview(other).cast('B')
+            if len(other) != len(self):
+                return False
+            start = 0
+            for chunk in self.chunks:
+                if other[start:start + len(chunk)] != chunk:
+                    return False
+                start += len(chunk)
+            return True
+        return NotImplemented
+
+    __hash__ = None
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sum(map(sys.getsizeof, self.chunks))
+
+    def __repr__(self):
+        return "<Chunked {} bytes in {} chunks>".format(len(self), len(self.chunks))
+
+
+class RawValue(object):
+    """
+    A value as memcached stores it: opaque data, with the flags given by the
+    client which stored it. Values stored through gemstash.server are kept
+    as RawValues.
+
+    """
+
+    __slots__ = ('flags', 'data')
+
+    def __init__(self, flags, data):
+        self.flags = flags
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __eq__(self, other):
+        if isinstance(other, RawValue):
+            return self.flags == other.flags and self.data == other.data
+        return NotImplemented
+
+    __hash__ = None
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self.data)
+
+    def __repr__(self):
+        return "RawValue({!r}, {!r})".format(self.flags, self.data)
+
+
+_ENCODED = (Compressed, Chunked)
+# values which a MimicStash stores without encoding them
+_STORED_AS_IS = _ENCODED + (RawValue,)
+
+def _check_sliding(time, sliding):
+    """Raise ValueError unless time is a relative expiry time, if sliding."""
+    if sliding and not 0 < time <= 60*60*24*30:
+        raise ValueError("sliding expiration needs a time in seconds from now")
+
+
+def _too_long(value, limit):
+    """Return whether value would be longer than limit bytes in memcached."""
+    kind = value.__class__
+    if kind is str:
+        length = len(value)
+        if length <= limit < 4 * length:
+            # only the encoded length will tell
+            length = len(value.encode("utf_8"))
+    elif kind is bytes or kind is bytearray or kind is Compressed or kind is RawValue:
+        length = len(value)
+    elif kind is memoryview:
+        length = value.nbytes
+    elif kind is Chunked:
+        length = value.chunk_size
+    else:
+        return False
+    return length > limit
+
+
+class Journal(object):
+    """
+    Persistence for a Stash, MimicStash or TieredStash, using snapshots and a
+    log.
+
+    The journal keeps its files in the directory path. Every change to the
+    stash is appended to a log, and from time to time the entire contents of
+    the stash are written to a snapshot, after which the older logs are
+    discarded. When a stash is created with a journal, it is restored by
+    loading the latest snapshot and replaying the logs written since. Items
+    which have expired by then are not restored, nor are those in namespaces
+    invalidated since. Values must be picklable.
+
+    fsync controls how often the log is forced to disk: after every change
+    ('always'), once per second ('everysec') or never, leaving it to the
+    operating system ('no'). The log is flushed to the operating system after
+    every change in any case, so only a crash of the machine can lose changes.
+
+    A snapshot is taken every snapshot_interval seconds, if set, or when
+    snapshot is called. The items are copied under the stash's write_lock, but
+    written out without holding it.
+
+    """
+
+    VERSION = 1
+    FSYNC_POLICIES = ('always', 'everysec', 'no')
+
+    def __init__(self, path, fsync='everysec', snapshot_interval=None):
+        """Create a new Journal, storing its files in the directory path."""
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError("fsync must be one of {}".format(", ".join(self.FSYNC_POLICIES)))
+        self.path = path
+        self.fsync = fsync
+        self.snapshot_interval = snapshot_interval
+        self.stash = None
+        self.generation = 0
+        self._log = None
+        self._retired = []
+        self._snapshot_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def open(self, stash):
+        """Restore stash from the journal and begin recording its changes."""
+        if self.stash is not None:
+            raise RuntimeError("journal is already in use")
+        os.makedirs(self.path, exist_ok=True)
+        self.stash = stash
+        with stash.write_lock.held("journal"):
+            generation = self._load_snapshot(stash)
+            logs = self._logs()
+            for log in logs:
+                if log >= generation:
+                    self._replay(stash, log)
+            self.generation = max([generation] + logs) + 1
+            self._log = open(self._log_path(self.generation), 'ab')
+        if self.fsync == 'everysec' or self.snapshot_interval:
+            self._thread = threading.Thread(target=self._run, name="gemstash-journal",
+                                            daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """Stop recording changes, and close the log."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self.stash.write_lock.held("journal"):
+            self.stash.journal = None
+            self._sync()
+            for log in self._retired + [self._log]:
+                log.close()
+            self._retired = []
+
+    def write(self, record):
+        """Append a record to the log. The caller holds the stash's write_lock."""
+        pickle.dump(record, self._log, pickle.HIGHEST_PROTOCOL)
+        self._log.flush()
+        if self.fsync == 'always':
+            os.fsync(self._log.fileno())
+
+    def snapshot(self):
+        """Write a snapshot of the stash and discard the logs it replaces."""
+        with self._snapshot_lock:
+            with self.stash.write_lock.held("snapshot"):
+                items = self.stash._snapshot_items()
+                generations = dict(self.stash.namespaces.generations)
+                self._retired.append(self._log)
+                self.generation += 1
+                generation = self.generation
+                self._log = open(self._log_path(generation), 'ab')
+            now = _time.time()
+            temp = os.path.join(self.path, 'snapshot.tmp')
+            with open(temp, 'wb') as f:
+                pickle.dump(('gemstash', self.VERSION, generation), f,
+                            pickle.HIGHEST_PROTOCOL)
+                for record in generations.items():
+                    pickle.dump(('namespace',) + record, f, pickle.HIGHEST_PROTOCOL)
+                for key, item in items:
+                    if item.expires and item.expires < now or _stale(key, generations):
+                        continue
+                    pickle.dump(('set', key, tuple(item)), f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self._snapshot_path())
+            for log in self._logs():
+                if log < generation:
+                    os.remove(self._log_path(log))
+
+    def _run(self):
+        interval = 1 if self.fsync == 'everysec' else self.snapshot_interval
+        last_snapshot = _time.monotonic()
+        while not self._stop.wait(interval):
+            if self.fsync == 'everysec':
+                self._sync()
+            if (self.snapshot_interval and
+                    _time.monotonic() - last_snapshot >= self.snapshot_interval):
+                self.snapshot()
+                last_snapshot = _time.monotonic()
+
+    def _sync(self):
+        """Force the log to disk, and close logs replaced by a snapshot."""
+        os.fsync(self._log.fileno())
+        while self._retired:
+            log = self._retired.pop()
+            os.fsync(log.fileno())
+            log.close()
+
+    def _snapshot_path(self):
+        return os.path.join(self.path, 'snapshot')
+
+    def _log_path(self, generation):
+        return os.path.join(self.path, 'log.{}'.format(generation))
+
+    def _logs(self):
+        """Return the generations of the logs present, in order."""
+        generations = []
+        for name in os.listdir(self.path):
+            prefix, _, suffix = name.partition('.')
+            if prefix == 'log' and suffix.isdigit():
+                generations.append(int(suffix))
+        return sorted(generations)
+
+    def _load_snapshot(self, stash):
+        """Load the snapshot, if any, returning the generation it was taken at."""
+        try:
+            f = open(self._snapshot_path(), 'rb')
+        except FileNotFoundError:
+            return 0
+        with f:
+            _, version, generation = pickle.load(f)
+            if version != self.VERSION:
+                raise ValueError("unsupported snapshot version {}".format(version))
+            for record in self._records(f):
+                stash._restore(record)
+        return generation
+
+    def _replay(self, stash, generation):
+        with open(self._log_path(generation), 'rb') as f:
+            for record in self._records(f):
+                stash._restore(record)
+
+    @staticmethod
+    def _records(f):
+        """Read records from f until the end, or a record cut short by a crash."""
+        while True:
+            try:
+                yield pickle.load(f)
+            except (EOFError, ValueError, pickle.UnpicklingError):
+                return
+
+
+class TieredStash(Stash):
+    """
+    A Stash which moves items it would evict to a file on disk.
+
+    The most recently used items are kept in memory, within the max_items and
+    max_bytes bounds, as in a Stash. Instead of being dropped, items evicted
+    from memory are pickled and appended to a segment file at path, which is
+    memory-mapped for reading and indexed by key. Items too large to be held
+    in memory at all are written directly to disk. When an item on disk is
+    read, it is moved back into memory.
+
+    If disk_max_bytes is set, the oldest items on disk are dropped when the
+    live data on disk exceeds it. The segment file is compacted when more than
+    half of it is taken up by items which have been replaced, deleted or moved
+    back into memory. The file is emptied when the stash is created.
+
+    Reads which find an item in each tier, and which miss, are counted in
+    tier_stats, along with the time spent reading from disk. Operations other
+    than reads, such as update or touch, read from disk too; their time and
+    disk_reads are counted, but not their hits and misses.
+
+    """
+
+    _MIN_COMPACT_BYTES = 1024*1024
+
+    def __init__(self, path, max_items=0, max_bytes=0, sizeof=None,
+                 disk_max_bytes=0, **kwargs):
+        """Create a new TieredStash, keeping items on disk at path."""
+        self.path = path
+        self.disk_max_bytes = disk_max_bytes
+        self.index = collections.OrderedDict()
+        self.disk_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_reads = 0
+        self.disk_read_seconds = 0.0
+        self._open_segment(open(path, 'w+b', buffering=0))
+        super().__init__(max_items=max_items, max_bytes=max_bytes, sizeof=sizeof,
+                         **kwargs)
+
+    @property
+    def tier_stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits' : self.memory_hits,
+            'disk_hits' : self.disk_hits,
+            'misses' : self.misses,
+            'memory_hit_ratio' : self.memory_hits / lookups if lookups else 0.0,
+            'disk_hit_ratio' : self.disk_hits / lookups if lookups else 0.0,
+            'memory_items' : len(self.cache),
+            'disk_items' : len(self.index),
+            'disk_bytes' : self.disk_bytes,
+            'disk_file_bytes' : self._segment_size,
+            'disk_reads' : self.disk_reads,
+            'disk_read_seconds' : self.disk_read_seconds,
+            'mean_disk_read_seconds' : (self.disk_read_seconds / self.disk_reads
+                                        if self.disk_reads else 0.0),
+        }
+
+    def get_stats(self, stat_args=None):
+        """Like Stash.get_stats, but the general statistics include tier_stats."""
+        stats = super().get_stats(stat_args)
+        if stat_args is None:
+            stats.update(self.tier_stats)
+        return stats
+
+    def __iter__(self):
+        return itertools.chain(list(self.cache), list(self.index))
+
+    def __len__(self):
+        return len(self.cache) + len(self.index)
+
+    def flush(self):
+        with self.write_lock.held("flush"):
+            super().flush()
+            self.index = collections.OrderedDict()
+            self.disk_bytes = 0
+            if self._map is not None:
+                self._map.close()
+            self._segment.truncate(0)
+            self._segment.seek(0)
+            self._open_segment(self._segment)
+
+    def cleanup(self):
+        """Remove expired items from the cache, both in memory and on disk.
+
+        Returns a list of keys removed. Unlike for a Stash, this visits every
+        item on disk.
+
+        """
+        with self.write_lock.held("cleanup"):
+            removed = super().cleanup()
+            now = _time.time()
+            for key, (_, _, expires, _) in list(self.index.items()):
+                if expires and expires < now:
+                    self._forget(key)
+                    removed.append(key)
+            return removed
+
+    def close(self):
+        """Close the segment file."""
+        with self.write_lock.held("close"):
+            if self._map is not None:
+                self._map.close()
+            self._segment.close()
+
+    def __getitem__(self, key):
+        # every read goes through _fetch, which looks on disk too
+        in_memory = key in self.cache
+        item = self._fetch(key)
+        self._count_read(item is not None, in_memory)
+        if item is None:
+            self.get_misses += 1
+            return None
+        self.get_hits += 1
+        item.fetched = True
+        return item.value, item.cas_id
+
+    def lookup(self, key):
+        in_memory = key in self.cache
+        result = super().lookup(key)
+        self._count_read(result is not None, in_memory)
+        return result
+
+    def _count_read(self, found, in_memory):
+        if not found:
+            self.misses += 1
+        elif in_memory:
+            self.memory_hits += 1
+        else:
+            self.disk_hits += 1
+
+    def _fetch(self, key, now=None):
+        item = super()._fetch(key, now)
+        if item is not None:
+            return item
+        with self.write_lock.held("get"):
+            item = super()._fetch(key, now)
+            if item is not None:
+                return item
+            try:
+                offset, length, expires, cas_id = self.index[key]
+            except KeyError:
+                return None
+            if expires and expires < (now or _time.time()):
+                self._forget(key)
+                return None
+            started = _time.perf_counter()
+            value = pickle.loads(self._read(offset, length))
+            self.disk_read_seconds += _time.perf_counter() - started
+            self.disk_reads += 1
+            ttl = self._sliding.get(key)
+            if ttl is not None:
+                expires = (now or _time.time()) + ttl
+            item = self.CachedItem(value, expires, cas_id)
+            if not self.max_bytes or self.sizeof(key, value) <= self.max_bytes:
+                self._store(key, item)
+                if ttl is not None:
+                    # moving back into memory is not a new value
+                    self._sliding[key] = ttl
+            elif ttl is not None:
+                self.index[key] = offset, length, expires, cas_id
+            return item
+
+    def _store(self, key, item):
+        if super()._store(key, item):
+            self._drop(key)
+            return True
+        if self.max_value_length and _too_long(item.value, self.max_value_length):
+            return False
+        # too large to keep in memory at all, so BaseStash._store has not
+        # journalled it
+        removed = super()._remove(key)
+        stored = self._demote(key, item)
+        if self.journal is not None:
+            if stored:
+                self.journal.write(('set', key, tuple(item)))
+            elif removed is not None:
+                self.journal.write(('delete', key))
+        return stored
+
+    def _remove(self, key):
+        item = super()._remove(key)
+        if key in self.index:
+            self._forget(key)
+            if item is None:
+                item = True
+        return item
+
+    def _evicted(self, key, item):
+        if not self._demote(key, item):
+            super()._evicted(key, item)
+
+    def _touch(self, key, item, time, sliding):
+        super()._touch(key, item, time, sliding)
+        location = self.index.get(key)
+        if location is not None:
+            # too large to be moved back into memory
+            offset, length, _, cas_id = location
+            self.index[key] = offset, length, item.expires, cas_id
+
+    def _snapshot_items(self):
+        items = super()._snapshot_items()
+        # read under the write_lock, as compaction may move the data
+        for key, (offset, length, expires, cas_id) in self.index.items():
+            value = pickle.loads(self._read(offset, length))
+            items.append((key, self.CachedItem(value, expires, cas_id)))
+        return items
+
+    def _present(self, key, now):
+        if key in self.cache:
+            return super()._present(key, now)
+        location = self.index.get(key)
+        return location is not None and not (location[2] and location[2] < now)
+
+    def _fits(self, items):
+        # items which do not fit in memory are kept on disk instead, but values
+        # which are too long are not kept at all
+        limit = self.max_value_length
+        return not (limit and any(_too_long(item.value, limit) for _, item in items))
+
+    def get_multi(self, keys):
+        with self.write_lock.held("get_multi"):
+            keys = list(keys)
+            disk_reads = self.disk_reads
+            return self._count_reads(keys, super().get_multi(keys), disk_reads)
+
+    def get_multi_and_touch(self, keys, time, sliding=False):
+        with self.write_lock.held("get_multi_and_touch"):
+            keys = list(keys)
+            disk_reads = self.disk_reads
+            return self._count_reads(keys, super().get_multi_and_touch(keys, time, sliding),
+                                     disk_reads)
+
+    def _count_reads(self, keys, results, disk_reads):
+        """
+        Count the tiers in which keys were found, given the value disk_reads
+        had before they were read. The caller holds the write_lock.
+
+        """
+        found = sum(1 for key in keys if key in results)
+        disk_hits = self.disk_reads - disk_reads
+        self.memory_hits += found - disk_hits
+        self.disk_hits += disk_hits
+        self.misses += len(keys) - found
+        return results
+
+    def _demote(self, key, item):
+        """Write item to disk. The caller holds the write_lock."""
+        try:
+            data = pickle.dumps(item.value, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return False
+        if self.disk_max_bytes and len(data) > self.disk_max_bytes:
+            return False
+        self._drop(key)
+        offset = self._segment_size
+        self._segment.write(data)
+        self._segment_size += len(data)
+        self.index[key] = offset, len(data), item.expires, item.cas_id
+        self.disk_bytes += len(data)
+        if self.prefix_index is not None:
+            self.prefix_index.add(key)
+        while self.disk_max_bytes and self.disk_bytes > self.disk_max_bytes:
+            self._forget(next(iter(self.index)))
+            self.evictions += 1
+        if (self._segment_size > self._MIN_COMPACT_BYTES and
+                self._segment_size > 2 * self.disk_bytes):
+            self._compact()
+        return True
+
+    def _drop(self, key):
+        """Forget the disk copy of key, if any."""
+        location = self.index.pop(key, None)
+        if location is not None:
+            self.disk_bytes -= location[1]
+
+    def _forget(self, key):
+        """Forget the disk copy of key, which is no longer in the stash."""
+        self._drop(key)
+        if self.prefix_index is not None:
+            self.prefix_index.discard(key)
+        if self._sliding:
+            self._sliding.pop(key, None)
+
+    def _read(self, offset, length):
+        if self._map is None or offset + length > len(self._map):
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._segment.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map[offset:offset + length]
+
+    def _open_segment(self, segment):
+        self._segment = segment
+        self._segment_size = os.fstat(segment.fileno()).st_size
+        self._map = None
+
+    def _compact(self):
+        """Rewrite the segment file, keeping only live items."""
+        now = _time.time()
+        temp = self.path + '.tmp'
+        index = collections.OrderedDict()
+        with open(temp, 'wb') as f:
+            offset = 0
+            for key, (start, length, expires, cas_id) in self.index.items():
+                if expires and expires < now:
+                    if self.prefix_index is not None:
+                        self.prefix_index.discard(key)
+                    continue
+                f.write(self._read(start, length))
+                index[key] = offset, length, expires, cas_id
+                offset += length
+        if self._map is not None:
+            self._map.close()
+        self._segment.close()
+        os.replace(temp, self.path)
+        self.index = index
+        self.disk_bytes = offset
+        self._open_segment(open(self.path, 'r+b', buffering=0))
+        self._segment.seek(0, os.SEEK_END)
+
+
+class ShardedStash(collections.MutableMapping):
+    """
+    A cache split across several independently locked stashes.
+
+    Keys are hashed onto one of the shards, each of which is a complete stash
+    with its own write_lock, so that threads working on different keys do not
+    contend for a single lock. Operations on a single key are performed by the
+    key's shard and so are exactly as atomic as for an unsharded stash.
+    Operations on the whole stash (flush, cleanup, len, and those on every key
+    with a prefix) visit the shards one at a time and ARE NOT atomic.
+
+    Keyword arguments other than shards and stash are passed to the stash
+    class when creating each shard, except that max_items and max_bytes are
+    divided evenly between the shards.
+
+    """
+
+    def __init__(self, shards=16, stash=Stash, **kwargs):
+        """Create a new ShardedStash."""
+        for bound in ('max_items', 'max_bytes'):
+            if kwargs.get(bound):
+                kwargs[bound] = -(-kwargs[bound] // shards)
+        self.shards = [stash(**kwargs) for _ in range(shards)]
+        self.flights = SingleFlight()
+        self.namespaces = Namespaces()
+        self._shared = _any_shared(self.shards)
+
+    def shard(self, key):
+        """Return the shard responsible for key."""
+        return self.shards[hash(key) % len(self.shards)]
+
+    def __getitem__(self, key):
+        return self.shard(key)[key]
+
+    def lookup(self, key):
+        return self.shard(key).lookup(key)
+
+    def __setitem__(self, key, value):
+        raise NotImplementedError("Add items to the stash using the set method.")
+
+    def __delitem__(self, key):
+        del self.shard(key)[key]
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    @property
+    def bytes(self):
+        return sum(shard.bytes for shard in self.shards)
+
+    @property
+    def evictions(self):
+        return sum(shard.evictions for shard in self.shards)
+
+    def incr(self, key, delta):
+        return self.shard(key).incr(key, delta)
+
+    def update(self, key, value, time=None):
+        return self.shard(key).update(key, value, time)
+
+    def touch(self, key, time, sliding=False):
+        return self.shard(key).touch(key, time, sliding)
+
+    def gat(self, key, time, sliding=False):
+        return self.shard(key).gat(key, time, sliding)
+
+    def get_multi_and_touch(self, keys, time, sliding=False):
+        results = {}
+        for shard, group in self._group(keys):
+            results.update(shard.get_multi_and_touch(group, time, sliding))
+        return results
+
+    def keys_with_prefix(self, prefix):
+        """Return a sorted list of the keys, in every shard, beginning with prefix."""
+        return list(heapq.merge(*[shard.keys_with_prefix(prefix) for shard in self.shards]))
+
+    def get_prefix(self, prefix):
+        results = {}
+        for shard in self.shards:
+            results.update(shard.get_prefix(prefix))
+        return results
+
+    def delete_prefix(self, prefix):
+        deleted = []
+        for shard in self.shards:
+            deleted.extend(shard.delete_prefix(prefix))
+        return deleted
+
+    def namespace_prefix(self, namespace):
+        if self._shared:
+            return self.shard(namespace).namespace_prefix(namespace)
+        return self.namespaces.prefix(namespace)
+
+    def invalidate_namespace(self, namespace):
+        """
+        Invalidate every key in namespace, in all the shards, at once. See
+        BaseStash.invalidate_namespace.
+
+        If any shard is a SharedMemoryStash, the generation of each namespace
+        is kept by the shard the namespace's name belongs to, so that every
+        process sharing the shards sees it. The keys of earlier generations
+        held by other shards are then left to be evicted.
+
+        """
+        if self._shared:
+            return self.shard(namespace).invalidate_namespace(namespace)
+        return self.namespaces.invalidate(namespace)
+
+    def set(self, key, value, time):
+        return self.shard(key).set(key, value, time)
+
+    def get_multi(self, keys):
+        """
+        Look up several keys at once. See BaseStash.get_multi.
+
+        The keys held by each shard are read together, but the shards are read
+        one at a time.
+
+        """
+        results = {}
+        for shard, group in self._group(keys):
+            results.update(shard.get_multi(group))
+        return results
+
+    def set_multi(self, mapping, time, atomic=False):
+        """
+        Set several keys at once. See BaseStash.set_multi.
+
+        If atomic, the locks of all the shards involved are held while the keys
+        are set, so that the whole batch is set at once or not at all.
+
+        """
+        groups = self._group(mapping)
+        if not atomic or len(groups) == 1:
+            failures = []
+            for shard, group in groups:
+                failures.extend(shard.set_multi({key : mapping[key] for key in group}, time,
+                                                atomic))
+            return failures
+        with self._locked(groups):
+            prepared = [(shard, shard._prepare({key : mapping[key] for key in group}, time))
+                        for shard, group in groups]
+            if not all(shard._fits(items) for shard, items in prepared):
+                return list(mapping)
+            failures = []
+            for shard, items in prepared:
+                failures.extend(shard._store_all(items))
+            return failures
+
+    def delete_multi(self, keys, atomic=False):
+        """
+        Delete several keys at once. See BaseStash.delete_multi.
+
+        If atomic, the locks of all the shards involved are held throughout.
+
+        """
+        groups = self._group(keys)
+        if not atomic or len(groups) == 1:
+            missing = []
+            for shard, group in groups:
+                missing.extend(shard.delete_multi(group, atomic))
+            return missing
+        with self._locked(groups):
+            now = _time.time()
+            missing = []
+            for shard, group in groups:
+                absent = [key for key in group if shard._fetch(key, now) is None]
+                shard.delete_misses += len(absent)
+                missing.extend(absent)
+            if missing:
+                return missing
+            for shard, group in groups:
+                shard.delete_multi(group)
+            return []
+
+    def _group(self, keys):
+        """Return a list of (shard, keys held by shard), in shard order."""
+        groups = {}
+        for key in keys:
+            groups.setdefault(hash(key) % len(self.shards), []).append(key)
+        return [(self.shards[index], groups[index]) for index in sorted(groups)]
+
+    @contextlib.contextmanager
+    def _locked(self, groups):
+        """Hold the locks of the shards in groups, always taken in shard order."""
+        with contextlib.ExitStack() as stack:
+            for shard, _ in groups:
+                stack.enter_context(shard.write_lock)
+            yield
+
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+
+    def append(self, key, value, time):
+        return self.shard(key).append(key, value, time)
+
+    def prepend(self, key, value, time):
+        return self.shard(key).prepend(key, value, time)
+
+    def cas(self, key, value, time, cas_id):
+        return self.shard(key).cas(key, value, time, cas_id)
+
+    def modify(self, key, func):
+        return self.shard(key).modify(key, func)
+
+    def cleanup(self):
+        """Remove expired items from the cache.
+
+        Returns a list of keys removed.
+
+        """
+        removed = []
+        for shard in self.shards:
+            removed.extend(shard.cleanup())
+        if self.namespaces.invalidated:
+            self.namespaces.invalidated = False
+            for shard in self.shards:
+                removed.extend(shard._reclaim(self.namespaces.stale))
+        return removed
+
+    def get_stats(self, stat_args=None):
+        """
+        Return statistics for the whole stash. See BaseStash.get_stats.
+
+        Numeric statistics are summed over the shards, except for maxima,
+        which are the largest of any shard, and those describing the process,
+        which are taken from the first shard.
+
+        """
+        totals = {}
+        for shard in self.shards:
+            for name, value in shard.get_stats(stat_args).items():
+                if name not in totals or name in self._PROCESS_STATS:
+                    totals.setdefault(name, value)
+                elif 'max_' in name:
+                    totals[name] = max(totals[name], value)
+                else:
+                    totals[name] += value
+        return totals
+
+    _PROCESS_STATS = frozenset(['pid', 'uptime', 'time', 'last_slice_items',
+                                'last_slice_seconds'])
+
+    def start_reaper(self, interval=1.0, budget_ms=1.0):
+        """Start a reaper thread for each shard. See BaseStash.start_reaper."""
+        for shard in self.shards:
+            shard.start_reaper(interval, budget_ms)
+
+    def stop_reaper(self):
+        """Stop the reaper threads of all shards."""
+        for shard in self.shards:
+            shard.stop_reaper()
+
+
+def _any_shared(shards):
+    """Return whether any of shards is shared with other processes."""
+    return any(isinstance(shard, SharedMemoryStash) for shard in shards)
+
+
+class RingStash(ShardedStash):
+    """
+    A cache distributed across several stashes by a consistent hash ring.
+
+    As in ketama, each stash is given 160 points on a ring of 32-bit hashes
+    for each unit of its weight, and each key belongs to the stash owning the
+    first point at or after the key's hash. Replacing the stashes with
+    set_servers moves only the keys on the points which change hands, about
+    1/N of them when one of N stashes is added or removed; the rest stay
+    where they are. Keys on a stash which is removed are not moved, but are
+    simply no longer found.
+
+    servers is a list of stashes, or (stash, weight) pairs. The points of a
+    stash are placed by its name, if it has one (as a SharedMemoryStash
+    does), so that clients in different processes sharing the same stashes
+    agree on where each key belongs; otherwise by its identity.
+
+    As for a ShardedStash, operations on a single key are performed by the
+    key's stash, and bulk operations make one call to each stash involved.
+    Atomic bulk operations involving several stashes require them all to be
+    derived from BaseStash.
+
+    """
+
+    POINTS_PER_WEIGHT = 160
+    # the ring is divided into 2**_BUCKET_BITS buckets, so that a key whose
+    # bucket holds no points can be placed without searching for its point
+    _BUCKET_BITS = 14
+
+    def __init__(self, servers):
+        """Create a new RingStash."""
+        self.flights = SingleFlight()
+        self.namespaces = Namespaces()
+        self.set_servers(servers)
+
+    @property
+    def shards(self):
+        return self._ring[2]
+
+    def set_servers(self, servers):
+        """Replace the stashes in the ring."""
+        servers = [server if isinstance(server, tuple) else (server, 1)
+                   for server in servers]
+        if not servers:
+            raise ValueError("a RingStash requires at least one stash")
+        points = []
+        for index, (stash, weight) in enumerate(servers):
+            name = getattr(stash, 'name', None) or "{}-{:x}".format(type(stash).__name__,
+                                                                   id(stash))
+            # each digest gives four points
+            for i in range(round(self.POINTS_PER_WEIGHT * weight / 4)):
+                digest = hashlib.md5("{}-{}".format(name, i).encode("utf_8")).digest()
+                points.extend((point, index) for point in struct.unpack('<4I', digest))
+        points.sort()
+        owners = [index for _, index in points]
+        points = [point for point, _ in points]
+        # the owner of every hash in each bucket, or -1 if that depends on
+        # where the hash falls between the points in the bucket
+        shift = 32 - self._BUCKET_BITS
+        buckets = []
+        position = 0
+        for bucket in range(1 << self._BUCKET_BITS):
+            end = (bucket + 1) << shift
+            if position < len(points) and points[position] < end:
+                buckets.append(-1)
+                while position < len(points) and points[position] < end:
+                    position += 1
+            else:
+                buckets.append(owners[position] if position < len(points) else owners[0])
+        self.servers = servers
+        self._ring = (points, owners, [stash for stash, _ in servers], buckets)
+        self._shared = _any_shared(self.shards)
+
+    def _index(self, key):
+        points, owners, _, buckets = self._ring
+        hashed = zlib.crc32(key.encode("utf_8"))
+        index = buckets[hashed >> (32 - self._BUCKET_BITS)]
+        if index < 0:
+            position = bisect.bisect_left(points, hashed)
+            index = owners[position if position < len(points) else 0]
+        return index
+
+    def shard(self, key):
+        """Return the stash responsible for key."""
+        return self.shards[self._index(key)]
+
+    def _group(self, keys):
+        """Return a list of (stash, keys held by stash), in the order of servers."""
+        groups = {}
+        index = self._index
+        for key in keys:
+            groups.setdefault(index(key), []).append(key)
+        shards = self.shards
+        return [(shards[index], groups[index]) for index in sorted(groups)]
+
+    def _locked(self, groups):
+        if not all(isinstance(stash, BaseStash) for stash, _ in groups):
+            raise ValueError("atomic operations across several stashes require "
+                             "stashes derived from BaseStash")
+        return super()._locked(groups)
+
+
+class SharedMemoryStash(collections.MutableMapping):
+    """
+    A cache held in shared memory, usable by several processes at once.
+
+    Items are stored in a fixed-size hash table with open addressing, followed
+    by a data region holding each item's encoded key and value. Values are
+    stored as bytes: str, int and float values are encoded as text, as in a
+    MimicStash, and anything else is pickled. All access is serialized by a
+    lock shared between the processes.
+
+    A stash created before worker processes are started (e.g. before gunicorn
+    or multiprocessing forks its workers) is shared by all of them, and may be
+    passed as an argument to a multiprocessing.Process. Other processes may
+    attach to an existing stash by name, with create=False, provided they are
+    given the same lock.
+
+    The table holds at most slots items, and their keys and values must fit in
+    data_size bytes. A value replacing one at least as long is written over it.
+    When either the table or the data region is exhausted, items are evicted,
+    by the clock algorithm (an approximation of LRU), until compacting away
+    the evicted, expired and deleted items will free an eighth of the region,
+    so that the region is compacted only once for many writes. set fails only
+    for a value too large for the data region, or whose encoded form is longer
+    than max_value_length bytes, if that is given. Each process has its own
+    max_value_length, but a stash passed to another process keeps it.
+
+    The generations of namespaces (see BaseStash.invalidate_namespace) are
+    shared by the processes too. They are kept in table slots of their own,
+    apart from the items: they are not counted, listed, evicted or deleted
+    with the items, and survive flush.
+
+    The creating process should call unlink() when the stash is no longer
+    needed, and every process should call close().
+
+    """
+
+    # magic, slots, data_size, bytes used, last cas id, live items, deleted
+    # items, bytes of dead data, clock hand, namespace generations
+    _HEADER = struct.Struct('<8sQQQQQQQQQ')
+    # state, tag, hash, offset, key length, value length, expiry time, cas id,
+    # referenced since the clock hand last passed, sliding expiration seconds
+    _SLOT = struct.Struct('<BBxxIQIIdQBxxxf')
+    _MAGIC = b'GEMSTSH3'
+    _EMPTY, _USED, _DELETED, _GENERATION = range(4)
+    _STR, _INT, _FLOAT, _PICKLE = range(4)
+    _MAX_LOAD = 0.9
+
+    def __init__(self, name=None, slots=65536, data_size=64*1024*1024,
+                 create=True, lock=None, max_value_length=0):
+        """Create a new SharedMemoryStash, or attach to an existing one."""
+        if shared_memory is None:
+            raise RuntimeError("SharedMemoryStash requires python 3.8 or later")
+        self.write_lock = lock or multiprocessing.RLock()
+        self.max_value_length = max_value_length
+        if create:
+            size = self._HEADER.size + slots * self._SLOT.size + data_size
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self._HEADER.pack_into(self.shm.buf, 0, self._MAGIC, slots, data_size,
+                                   0, 0, 0, 0, 0, 0, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.flights = SingleFlight()
+        self.get_hits = self.get_misses = 0
+        self._attach()
+
+    def _attach(self):
+        magic, self.slots, self.data_size = self._HEADER.unpack_from(self.shm.buf, 0)[:3]
+        if magic != self._MAGIC:
+            raise ValueError("{} is not a gemstash shared memory stash".format(self.shm.name))
+        self._table = self._HEADER.size
+        self._data = self._table + self.slots * self._SLOT.size
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __getstate__(self):
+        return self.shm.name, self.write_lock, self.max_value_length
+
+    def __setstate__(self, state):
+        name, self.write_lock, self.max_value_length = state
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.flights = SingleFlight()
+        self.get_hits = self.get_misses = 0
+        self._attach()
+
+    def close(self):
+        """Detach this process from the shared memory."""
+        self.shm.close()
+
+    def unlink(self):
+        """Destroy the shared memory. Other processes should close() first."""
+        self.shm.unlink()
+
+    def __getitem__(self, key):
+        item = self.lookup(key)
+        if item is None:
+            return None
+        return item[:2]
+
+    def lookup(self, key):
+        """Like stash[key], but also return the time to live of the item."""
+        kb = key.encode("utf_8")
+        with self.write_lock:
+            return self._lookup(kb, _time.time())
+
+    def get_multi(self, keys):
+        """Look up several keys at once. See BaseStash.get_multi."""
+        results = {}
+        with self.write_lock:
+            now = _time.time()
+            for key in keys:
+                found = self._lookup(key.encode("utf_8"), now)
+                if found is not None:
+                    results[key] = found[:2]
+        return results
+
+    def set_multi(self, mapping, time, atomic=False):
+        """
+        Set several keys at once. See BaseStash.set_multi.
+
+        If atomic, the batch is set only if it fits without evicting other
+        items, compacting the table first if that is needed to make room.
+
+        """
+        expires = self._expires(time)
+        items = [(key, key.encode("utf_8")) + self._encode(value)
+                 for key, value in mapping.items()]
+        with self.write_lock:
+            if atomic and not self._fits(items):
+                return list(mapping)
+            return [key for key, kb, tag, vb in items if not self._put(kb, tag, vb, expires)]
+
+    def delete_multi(self, keys, atomic=False):
+        """Delete several keys at once. See BaseStash.delete_multi."""
+        with self.write_lock:
+            now = _time.time()
+            found, missing = [], []
+            for key in keys:
+                kb = key.encode("utf_8")
+                index = self._find(kb, zlib.crc32(kb))[0]
+                if index < 0 or 0 < self._slot(index)[6] < now:
+                    missing.append(key)
+                else:
+                    found.append(index)
+            if atomic and missing:
+                return missing
+            for index in found:
+                slot = self._slot(index)
+                # the same key may appear twice
+                if slot[0] == self._USED:
+                    self._delete(index, slot)
+            return missing
+
+    def keys_with_prefix(self, prefix):
+        """
+        Return a sorted list of the keys which begin with prefix. Unlike for the
+        other stashes, this always visits every slot in the table.
+
+        """
+        return sorted(self.get_prefix(prefix))
+
+    def get_prefix(self, prefix):
+        with self.write_lock:
+            return self.get_multi([key for key in self if key.startswith(prefix)])
+
+    def delete_prefix(self, prefix):
+        with self.write_lock:
+            keys = self.keys_with_prefix(prefix)
+            self.delete_multi(keys)
+            return keys
+
+    def __setitem__(self, key, value):
+        raise NotImplementedError("Add items to the stash using the set method.")
+
+    def __delitem__(self, key):
+        kb = key.encode("utf_8")
+        with self.write_lock:
+            index = self._find(kb, zlib.crc32(kb))[0]
+            if index >= 0:
+                self._delete(index, self._slot(index))
+
+    def __iter__(self):
+        with self.write_lock:
+            keys = [self._key(slot) for _, slot in self._live()]
+        return iter(keys)
+
+    def __len__(self):
+        return self._header()[5]
+
+    def incr(self, key, delta):
+        with self.write_lock:
+            try:
+                value, _ = self[key]
+            except TypeError:
+                value = None
+            if not value:
+                return None
+            if isinstance(value, str):
+                value = str(int(value) + delta)
+            elif isinstance(value, int):
+                value = value + delta
+            else:
+                # not a str or int, can't increment
+                raise ValueError("cannot increment or decrement non-numeric value")
+            self.update(key, value)
+            return int(value)
+
+    def update(self, key, value, time=None):
+        with self.write_lock:
+            if self[key] is None:
+                return False
+            else:
+                return self.set(key, value, time)
+
+    def touch(self, key, time, sliding=False):
+        """
+        Change the expiry time of key in its slot, keeping its value and cas
+        id. If sliding, the time in seconds is kept in the slot too, and each
+        later read pushes the expiry time out again. Returns whether key was
+        present.
+
+        """
+        _check_sliding(time, sliding)
+        with self.write_lock:
+            return self._touch(key.encode("utf_8"), self._expires(time),
+                               time if sliding else 0, _time.time())
+
+    def gat(self, key, time, sliding=False):
+        return self.get_multi_and_touch((key,), time, sliding).get(key)
+
+    def get_multi_and_touch(self, keys, time, sliding=False):
+        """Look up several keys at once, changing the expiry time of each one found."""
+        _check_sliding(time, sliding)
+        expires, ttl = self._expires(time), time if sliding else 0
+        results = {}
+        with self.write_lock:
+            now = _time.time()
+            for key in keys:
+                kb = key.encode("utf_8")
+                found = self._lookup(kb, now)
+                if found is not None:
+                    self._touch(kb, expires, ttl, now)
+                    results[key] = found[:2]
+        return results
+
+    def set(self, key, value, time):
+        kb = key.encode("utf_8")
+        tag, vb = self._encode(value)
+        expires = self._expires(time)
+        with self.write_lock:
+            return self._put(kb, tag, vb, expires)
+
+    def flush(self):
+        with self.write_lock:
+            for index, slot in list(self._live()):
+                self._delete(index, slot)
+            # keeps the namespace generations
+            self._compact()
+
+    def append(self, key, value, time):
+        with self.write_lock:
+            try:
+                original, _ = self[key]
+            except TypeError:
+                original = None
+            if not original:
+                return False
+            if isinstance(original, str):
+                value = original + str(value)
+            elif original.__class__ is Compressed:
+                value = original.append(value)
+                if value is None:
+                    return False
+            elif isinstance(original, int):
+                try:
+                    value = int(str(original) + str(value))
+                except ValueError as e:
+                    raise ValueError("cannot append non-numeric value to int") from e
+            elif isinstance(original, float):
+                try:
+                    value = float(str(original) + str(value))
+                except ValueError as e:
+                    raise ValueError("cannot append non-numeric value to float") from e
+            else:
+                return False
+
+            return self.set(key, value, time)
+
+    def prepend(self, key, value, time):
+        with self.write_lock:
+            try:
+                original, _ = self[key]
+            except TypeError:
+                original = None
+            if not original:
+                return False
+            if isinstance(original, str):
+                value = str(value) + original
+            elif original.__class__ is Compressed:
+                value = original.prepend(value)
+                if value is None:
+                    return False
+            elif isinstance(original, int):
+                try:
+                    value = int(str(value) + str(original))
+                except ValueError as e:
+                    raise ValueError("cannot prepend non-numeric value to int") from e
+            elif isinstance(original, float):
+                try:
+                    value = float(str(value) + str(original))
+                except ValueError as e:
+                    raise ValueError("cannot prepend non-numeric value to float") from e
+            else:
+                return False
+
+            return self.set(key, value, time)
+
+    def cas(self, key, value, time, cas_id):
+        with self.write_lock:
+            item = self[key]
+            if item is None or not cas_id:
+                return self.set(key, value, time)
+            else:
+                if cas_id == item[1]:
+                    return self.set(key, value, time)
+                else:
+                    return 0
+
+    def modify(self, key, func):
+        """See BaseStash.modify."""
+        kb = key.encode("utf_8")
+        with self.write_lock:
+            index = self._find(kb, zlib.crc32(kb))[0]
+            found = None
+            if index >= 0:
+                slot = self._slot(index)
+                if slot[6] and slot[6] < _time.time():
+                    self._delete(index, slot)
+                else:
+                    found = self._decode(slot), slot[7], slot[6] or None
+            change = func(found)
+            if change is None:
+                return None
+            return self.set(key, *change)
+
+    def get_stats(self, stat_args=None):
+        """
+        Return a dictionary of statistics about the stash.
+
+        Only the general statistics are available. get_hits and get_misses
+        count the lookups made by this process; the rest describe the shared
+        table.
+
+        """
+        if stat_args is not None:
+            return {}
+        header = self._header()
+        now = _time.time()
+        return {
+            'pid' : os.getpid(),
+            'time' : int(now),
+            'curr_items' : header[5],
+            'total_items' : header[4],
+            'bytes' : header[3],
+            'limit_maxbytes' : self.data_size,
+            'limit_maxitems' : self.slots,
+            'cmd_get' : self.get_hits + self.get_misses,
+            'get_hits' : self.get_hits,
+            'get_misses' : self.get_misses,
+        }
+
+    def cleanup(self):
+        """Remove expired items from the cache.
+
+        Returns a list of keys removed. Unlike the other stashes, this visits
+        every slot in the table.
+
+        """
+        removed = []
+        buf, data = self.shm.buf, self._data
+        with self.write_lock:
+            now = _time.time()
+            generations = {}
+            for index in range(self.slots):
+                slot = self._slot(index)
+                if slot[0] == self._USED and slot[6] and slot[6] < now:
+                    removed.append(self._key(slot))
+                    self._delete(index, slot)
+                elif slot[0] == self._GENERATION:
+                    generations[self._key(slot)] = self._decode(slot)
+            if generations:
+                removed.extend(self._reclaim(functools.partial(_stale,
+                                                               generations=generations)))
+        return removed
+
+    def namespace_prefix(self, namespace):
+        with self.write_lock:
+            return _namespace_prefix(namespace, self._generation(namespace))
+
+    def invalidate_namespace(self, namespace):
+        """
+        Invalidate every key in namespace at once, for every process. See
+        BaseStash.invalidate_namespace.
+
+        If there is no room in the table for the new generation, the keys in
+        the namespace are removed instead.
+
+        """
+        kb = namespace.encode("utf_8")
+        with self.write_lock:
+            generation = self._generation(namespace)
+            prefix = _namespace_prefix(namespace, generation)
+            if self._put(kb, self._INT, str(generation + 1).encode("utf_8"), 0.0,
+                         self._GENERATION):
+                return generation + 1
+            self._reclaim(lambda key: key.startswith(prefix))
+            return generation
+
+    def _generation(self, namespace):
+        kb = namespace.encode("utf_8")
+        index = self._find(kb, zlib.crc32(kb), self._GENERATION)[0]
+        if index < 0:
+            return 0
+        return self._decode(self._slot(index))
+
+    def _reclaim(self, stale):
+        """Remove every key for which stale(key) is true, returning them."""
+        removed = []
+        with self.write_lock:
+            for index, slot in list(self._live()):
+                key = self._key(slot)
+                if stale(key):
+                    removed.append(key)
+                    self._delete(index, slot)
+        return removed
+
+    @staticmethod
+    def _expires(time):
+        if time and time > 60*60*24*30:
+            return float(time)
+        elif (not time) or time == 0:
+            return 0.0
+        else:
+            return _time.time() + time
+
+    def _encode(self, value):
+        kind = type(value)
+        if kind is str:
+            return self._STR, value.encode("utf_8")
+        elif kind is int:
+            return self._INT, str(value).encode("utf_8")
+        elif kind is float:
+            return self._FLOAT, str(value).encode("utf_8")
+        else:
+            return self._PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _decode(self, slot):
+        tag, offset, keylen, vallen = slot[1], slot[3], slot[4], slot[5]
+        start = self._data + offset + keylen
+        raw = bytes(self.shm.buf[start:start + vallen])
+        if tag == self._STR:
+            return raw.decode("utf_8")
+        elif tag == self._INT:
+            return int(raw)
+        elif tag == self._FLOAT:
+            return float(raw)
+        else:
+            return pickle.loads(raw)
+
+    def _header(self):
+        return list(self._HEADER.unpack_from(self.shm.buf, 0))
+
+    def _slot(self, index):
+        return self._SLOT.unpack_from(self.shm.buf, self._table + index * self._SLOT.size)
+
+    def _key(self, slot):
+        start = self._data + slot[3]
+        return bytes(self.shm.buf[start:start + slot[4]]).decode("utf_8")
+
+    def _live(self):
+        """Yield (index, slot) for every slot holding an item."""
+        for index in range(self.slots):
+            slot = self._slot(index)
+            if slot[0] == self._USED:
+                yield index, slot
+
+    def _find(self, kb, hashed, state=_USED):
+        """
+        Find the slot for an encoded key, among the slots in state: items, or
+        namespace generations.
+
+        Returns the index of the slot holding the key, or -1, and the index of
+        the slot where the key would be inserted, or -1 if the table is full.
+
+        """
+        buf, data, size, keylen = self.shm.buf, self._data, self._SLOT.size, len(kb)
+        index = hashed % self.slots
+        free = -1
+        for _ in range(self.slots):
+            slot = self._SLOT.unpack_from(buf, self._table + index * size)
+            kind = slot[0]
+            if kind == self._EMPTY:
+                return -1, (index if free < 0 else free)
+            elif kind == self._DELETED:
+                if free < 0:
+                    free = index
+            elif (kind == state and slot[2] == hashed and slot[4] == keylen and
+                  buf[data + slot[3]:data + slot[3] + keylen] == kb):
+                return index, index
+            index = (index + 1) % self.slots
+        return -1, free
+
+    def _put(self, kb, tag, vb, expires, state=_USED):
+        need = len(kb) + len(vb)
+        if need > self.data_size or (self.max_value_length and
+                                     len(vb) > self.max_value_length):
+            return False
+        hashed = zlib.crc32(kb)
+        index, free = self._find(kb, hashed, state)
+        header = self._header()
+        if index >= 0:
+            old = self._slot(index)
+            if need <= old[4] + old[5]:
+                # write over the old value
+                header[7] += old[4] + old[5] - need
+                return self._write(header, index, old[3], kb, tag, vb, expires, hashed, state)
+        if (header[3] + need > self.data_size or
+                (index < 0 and
+                 header[5] + header[6] + header[9] >= self.slots * self._MAX_LOAD)):
+            if not self._make_room(need):
+                return False
+            index, free = self._find(kb, hashed, state)
+            header = self._header()
+        if index >= 0:
+            old = self._slot(index)
+            header[7] += old[4] + old[5]
+        else:
+            index = free
+            if self._slot(index)[0] == self._DELETED:
+                header[6] -= 1
+            header[5 if state == self._USED else 9] += 1
+        offset = header[3]
+        header[3] += need
+        return self._write(header, index, offset, kb, tag, vb, expires, hashed, state)
+
+    def _write(self, header, index, offset, kb, tag, vb, expires, hashed, state):
+        start = self._data + offset
+        self.shm.buf[start:start + len(kb) + len(vb)] = kb + vb
+        header[4] += 1
+        self._SLOT.pack_into(self.shm.buf, self._table + index * self._SLOT.size,
+                             state, tag, hashed, offset, len(kb), len(vb),
+                             expires, header[4], 0, 0)
+        self._HEADER.pack_into(self.shm.buf, 0, *header)
+        return True
+
+    def _make_room(self, need):
+        """
+        Make room for need more bytes and another item, evicting items if
+        compacting alone would free less than an eighth of the data region
+        and of the table. Returns whether there is room.
+
+        """
+        wanted = min(need + self.data_size // 8, self.data_size)
+        max_items = self.slots * self._MAX_LOAD - max(1, self.slots // 8) - self._header()[9]
+        header = self._header()
+        hand, now = header[8], _time.time()
+        # two turns of the clock clear every referenced bit and evict
+        for _ in range(2 * self.slots):
+            if (self.data_size - header[3] + header[7] >= wanted and
+                    header[5] <= max_items):
+                break
+            index, hand = hand, (hand + 1) % self.slots
+            slot = self._slot(index)
+            if slot[0] != self._USED:
+                continue
+            if slot[8] and not (slot[6] and slot[6] < now):
+                self._SLOT.pack_into(self.shm.buf, self._table + index * self._SLOT.size,
+                                     *slot[:8] + (0,) + slot[9:])
+                continue
+            self._delete(index, slot)
+            header = self._header()
+        header[8] = hand
+        self._HEADER.pack_into(self.shm.buf, 0, *header)
+        self._compact()
+        header = self._header()
+        return (header[3] + need <= self.data_size and
+                header[5] + header[9] < self.slots * self._MAX_LOAD)
+
+    def _lookup(self, kb, now):
+        index = self._find(kb, zlib.crc32(kb))[0]
+        if index < 0:
+            self.get_misses += 1
+            return None
+        slot = self._slot(index)
+        expires = slot[6]
+        if expires and expires < now:
+            self._delete(index, slot)
+            self.get_misses += 1
+            return None
+        if slot[9]:
+            expires = now + slot[9]
+            self._SLOT.pack_into(self.shm.buf, self._table + index * self._SLOT.size,
+                                 *slot[:6] + (expires, slot[7], 1, slot[9]))
+        elif not slot[8]:
+            self._SLOT.pack_into(self.shm.buf, self._table + index * self._SLOT.size,
+                                 *slot[:8] + (1, 0))
+        self.get_hits += 1
+        return self._decode(slot), slot[7], expires - now if expires else None
+
+    def _touch(self, kb, expires, ttl, now):
+        index = self._find(kb, zlib.crc32(kb))[0]
+        if index < 0:
+            return False
+        slot = self._slot(index)
+        if slot[6] and slot[6] < now:
+            self._delete(index, slot)
+            return False
+        self._SLOT.pack_into(self.shm.buf, self._table + index * self._SLOT.size,
+                             *slot[:6] + (expires, slot[7], slot[8], ttl))
+        return True
+
+    def _fits(self, items):
+        """
+        Return whether every one of items can be put without evicting another,
+        compacting the table if that is needed to make room.
+
+        """
+        limit = self.max_value_length
+        if limit and any(len(vb) > limit for _, _, _, vb in items):
+            return False
+        header = self._header()
+        need = sum(len(kb) + len(vb) for _, kb, _, vb in items)
+        max_items = self.slots * self._MAX_LOAD - header[9]
+        if (header[3] + need - header[7] > self.data_size or
+                header[5] + len(items) - 1 >= max_items):
+            return False
+        if header[3] + need > self.data_size or header[5] + header[6] + len(items) > max_items:
+            self._compact()
+        return True
+
+    def _delete(self, index, slot):
+        self._SLOT.pack_into(self.shm.buf, self._table + index * self._SLOT.size,
+                             self._DELETED, *slot[1:])
+        header = self._header()
+        header[5] -= 1
+        header[6] += 1
+        header[7] += slot[4] + slot[5]
+        self._HEADER.pack_into(self.shm.buf, 0, *header)
+
+    def _compact(self):
+        """
+        Rewrite the table and data region, dropping expired and deleted items,
+        but keeping the namespace generations.
+
+        """
+        buf, data = self.shm.buf, self._data
+        now = _time.time()
+        items = []
+        for index in range(self.slots):
+            slot = self._slot(index)
+            if slot[0] == self._GENERATION or (slot[0] == self._USED and
+                                                not (slot[6] and slot[6] < now)):
+                start = data + slot[3]
+                items.append((slot, bytes(buf[start:start + slot[4] + slot[5]])))
+        buf[self._table:data] = bytes(data - self._table)
+        offset = 0
+        for slot, raw in items:
+            index = slot[2] % self.slots
+            while self._slot(index)[0] != self._EMPTY:
+                index = (index + 1) % self.slots
+            buf[data + offset:data + offset + len(raw)] = raw
+            self._SLOT.pack_into(buf, self._table + index * self._SLOT.size, *slot[:3] +
+                                 (offset,) + slot[4:])
+            offset += len(raw)
+        generations = sum(1 for slot, _ in items if slot[0] == self._GENERATION)
+        header = self._header()
+        header[3], header[5], header[6], header[7] = offset, len(items) - generations, 0, 0
+        header[9] = generations
+        self._HEADER.pack_into(buf, 0, *header)
+
+
+class Client(object):
+    """Client mimicking a memcached client."""
+
+    class MemcachedKeyError(Exception):
+        pass
+    class MemcachedKeyLengthError(MemcachedKeyError):
+        pass
+    class MemcachedKeyCharacterError(MemcachedKeyError):
+        pass
+    class MemcachedKeyNoneError(MemcachedKeyError):
+        pass
+    class MemcachedKeyTypeError(MemcachedKeyError):
+        pass
+
+    def __init__(self, servers, debug=0, pickleProtocol=0,
+                 pickler=None, unpickler=None,
+                 pload=None, pid=None,
+                 server_max_key_length=SERVER_MAX_KEY_LENGTH,
+                 server_max_value_length=SERVER_MAX_VALUE_LENGTH,
+                 dead_retry=_DEAD_RETRY, socket_timeout=_SOCKET_TIMEOUT,
+                 cache_cas = False, flush_on_reconnect=0, check_keys=True,
+                 codec='zlib', chunk_size=0):
+        """
+        Create a new Client attached to a specified Stash.
+
+        servers may instead be a list of stashes, or of (stash, weight) pairs,
+        across which keys are distributed by a RingStash.
+
+        codec names the entry of CODECS used to compress values for which
+        min_compress_len is given.
+
+        As with python-memcached, a str or bytes value longer than
+        server_max_value_length bytes (after compression) is not stored, unless
+        chunk_size is given, in which case str and bytes values longer than
+        chunk_size bytes are stored as Chunked values, and returned by get as
+        described there. chunk_size may not be larger than
+        server_max_value_length.
+
+        """
+        if codec not in CODECS:
+            raise ValueError("unknown codec: {!r}".format(codec))
+        if server_max_value_length and chunk_size > server_max_value_length:
+            raise ValueError("chunk_size is larger than server_max_value_length")
+        self.stash = self._connect(servers)
+        self.codec = codec
+        self.chunk_size = chunk_size
+        self.debug = debug
+        self.server_max_key_length = server_max_key_length
+        self.server_max_value_length = server_max_value_length
+        self.cache_cas = cache_cas
+        self.cas_cache = {}
+
+
+    def flush_all(self):
+        """
+        Expires all data in the connected Stash, including data with no expiry
+        time.
+
+        """
+        self.stash.flush()
+
+    def debuglog(self, str):
+        """
+        Write a log entry to stderr.
+
+        This method is provided purely for compatibility with python-memcached.
+
+        """
+
+        if self.debug:
+            sys.stderr.write("MemCached: {}\n".format(str))
+
+    def delete_multi(self, keys, time=0, key_prefix='', atomic=False):
+        """
+        Delete multiple keys from the connected Stash.
+
+        If a key_prefix is specified, it is prepended to each of the keys in the
+        list. So:
+
+            delete_multi(['bar', 'baz'], key_prefix='foo')
+
+        is equivalent to:
+
+            delete('foobar')
+            delete('foobaz')
+
+        The keys are deleted together, in a single call to the stash. If atomic
+        is true, nothing is deleted unless every key is present, and False is
+        returned if any was missing. Otherwise, True is returned.
+
+        """
+        # TODO: the time param does nothing
+        missing = self.stash.delete_multi([key_prefix + key for key in keys], atomic)
+        return not (atomic and missing)
+
+    def delete(self, key, time=0):
+        """Delete a key from the connected Stash."""
+        # TODO: the time param does nothing
+        del self.stash[key]
+
+    def incr(self, key, delta=1):
+        """
+        Increment the value assigned to key by delta.
+
+        This operation is performed by the stash with atomicity guaranteed.
+
+        """
+        return self.stash.incr(key, delta)
+
+    def decr(self, key, delta=1):
+        """
+        Decrement the value assigned to key by delta.
+
+        This operation is performed by the stash with atomicity guaranteed.
+
+        """
+        return self.stash.incr(key, 0 - delta)
+
+    def add(self, key, val, time = 0, min_compress_len = 0):
+        """Add a new key only if that key does not exist in the stash."""
+        item = self.stash[key]
+        if item:
+            return False
+        if val.__class__ is str or val.__class__ is bytes:
+            val = self._encode(val, min_compress_len)
+            if val is None:
+                return False
+        return self.stash.set(key, val, time)
+
+    def append(self, key, val, time=0, min_compress_len=0):
+        """
+        Append the given val to the existing key's value.
+
+        If the key does not exist in the stash, or if appending to the value
+        otherwise fails, do nothing and return False.
+
+        Integers (as either int or str) may be appended to integers, and
+        int or str may be appended to a str. Appending with other types may have
+        unexpected results.
+
+        Appending to a compressed value compresses what is appended, without
+        decompressing the value. A value which is not compressed stays so;
+        min_compress_len is ignored.
+
+        """
+        return self.stash.append(key, val, time)
+
+    def prepend(self, key, val, time=0, min_compress_len=0):
+        """
+        Prepend the given val to the existing key's value.
+
+        If the key does not exist in the stash, or if prepending to the value
+        otherwise fails, do nothing and return False.
+
+        Integers (as either int or str) may be prepended to integers, and
+        int or str may be prepended to a str. Prepending with other types may
+        have unexpected results.
+
+        As for append, min_compress_len is ignored.
+
+        """
+        return self.stash.prepend(key, val, time)
+
+    def replace(self, key, val, time=0, min_compress_len=0):
+        """
+        Replace an existing key's value with val.
+
+        Does nothing and returns False if the key does not exist in the stash.
+
+        """
+        if val.__class__ is str or val.__class__ is bytes:
+            val = self._encode(val, min_compress_len)
+            if val is None:
+                return False
+        return self.stash.update(key, val, time)
+
+    def set(self, key, val, time=0, min_compress_len=0):
+        """
+        Assign val to key in the connected stash.
+
+        This with replace the current assignment, if one exists, or else assign
+        the value to a new key in the stash.
+
+        If min_compress_len is given, a str or bytes value longer than
+        min_compress_len is stored compressed with the client's codec, unless
+        that would not make it smaller. It is decompressed again by get.
+
+        Returns False if the value is too long to store; see __init__.
+
+        """
+        if val.__class__ is str or val.__class__ is bytes:
+            val = self._encode(val, min_compress_len)
+            if val is None:
+                return False
+        return self.stash.set(key, val, time)
+
+    def set_multi(self, mapping, time=0, key_prefix='', min_compress_len=0, atomic=False):
+        """
+        Set multiple keys in the connected Stash.
+
+        If a key_prefix is specified, it is prepended to each of the keys in the
+        mapping. So:
+
+            set_multi({'bar' : 'barvalue', 'baz' : 'bazvalue'}, key_prefix='foo')
+
+        is equivalent to:
+
+            set('foobar', 'barvalue')
+            set('foobaz', 'bazvalue')
+
+        This method returns a list of any keys which could not be set. So:
+
+            failures = set_multi(...)
+            if failures:
+                # do something
+            else:
+                # all keys were set successfully
+
+        The keys are set together, in a single call to the stash. If atomic is
+        true, either every key is set or none are, in which case every key is
+        returned as a failure.
+
+        """
+        encode = self._encode
+        encoded, rejected = {}, []
+        for key, value in mapping.items():
+            if value.__class__ is str or value.__class__ is bytes:
+                value = encode(value, min_compress_len)
+                if value is None:
+                    rejected.append(key)
+                    continue
+            encoded[key_prefix + key] = value
+        if rejected and atomic:
+            return list(mapping)
+        failures = self.stash.set_multi(encoded, time, atomic)
+        return rejected + [key[len(key_prefix):] for key in failures]
+
+    def get(self, key):
+        """Retrieve the value of a key from the connected Stash."""
+        try:
+            result, cas_id = self.stash[key]
+        except TypeError:
+            result = None
+        if result and self.cache_cas:
+            self.cas_cache[key] = cas_id
+        if result.__class__ in _ENCODED:
+            return self._decode(result)
+        return result
+
+    def get_multi(self, keys, key_prefix=''):
+        """
+        Retrieve the values of multiple keys from the connected Stash.
+
+        The results are returned as a dictionary. If a key prefix was specified,
+        the keys in the result dictionary WILL NOT include the prefix.
+
+        The keys are read together, in a single call to the stash, which sees
+        a consistent snapshot of each Stash.
+
+        """
+        found = self.stash.get_multi([key_prefix + key for key in keys])
+        results = {}
+        for key in keys:
+            try:
+                result, cas_id = found[key_prefix + key]
+            except KeyError:
+                result = None
+            if result:
+                if self.cache_cas:
+                    self.cas_cache[key] = cas_id
+                if result.__class__ in _ENCODED:
+                    result = self._decode(result)
+                results[key] = result
+        return results
+
+    def touch(self, key, time=0, sliding=False):
+        """
+        Change the expiry time of a key without sending its value again.
+
+        The value and its cas id are left as they are. If sliding is true, time
+        must be in seconds from now, and each later read of the key pushes its
+        expiry time out to time seconds after the read, until the key is set
+        again, deleted, or touched without sliding:
+
+            gs.set(session_id, session, 1800)
+            gs.touch(session_id, 1800, sliding=True)
+
+        Returns whether the key was present.
+
+        """
+        return self.stash.touch(key, time, sliding)
+
+    def gat(self, key, time=0, sliding=False):
+        """Retrieve the value of a key and change its expiry time, as by touch."""
+        try:
+            result, cas_id = self.stash.gat(key, time, sliding)
+        except TypeError:
+            result = None
+        if result and self.cache_cas:
+            self.cas_cache[key] = cas_id
+        if result.__class__ in _ENCODED:
+            return self._decode(result)
+        return result
+
+    def get_multi_and_touch(self, keys, time=0, key_prefix='', sliding=False):
+        """
+        Retrieve the values of multiple keys and change the expiry time of
+        each one found, as by touch. The results are returned as for get_multi.
+
+        """
+        found = self.stash.get_multi_and_touch([key_prefix + key for key in keys],
+                                               time, sliding)
+        results = {}
+        for key in keys:
+            try:
+                result, cas_id = found[key_prefix + key]
+            except KeyError:
+                result = None
+            if result:
+                if self.cache_cas:
+                    self.cas_cache[key] = cas_id
+                if result.__class__ in _ENCODED:
+                    result = self._decode(result)
+                results[key] = result
+        return results
+
+    def get_or_set(self, key, factory, time=0, timeout=None, stale_time=0,
+                   beta=0, refresh=None):
+        """
+        Retrieve the value of a key, computing and storing it if missing.
+
+        If key is not in the stash, factory() is called to compute its value,
+        which is stored with the given expiry time and returned. Concurrent
+        callers missing the same key in the same stash wait for the first
+        caller's result rather than calling factory themselves. If factory
+        raises an exception, it is raised in every waiting caller, and nothing
+        is stored. A caller which has waited for timeout seconds raises
+        concurrent.futures.TimeoutError.
+
+        If stale_time is given, values are kept for stale_time seconds after
+        they expire. A caller finding such a stale value gets it immediately,
+        and a single refresh of the value is started. If beta is given, a
+        value may also be refreshed before it expires, with a probability
+        which rises as expiry approaches and with the time factory took to
+        run (the "XFetch" algorithm). A beta of 1 is a sensible default;
+        larger values refresh earlier.
+
+        A refresh is run by calling refresh with a function of no arguments
+        which performs it, e.g. refresh=executor.submit. If refresh is None,
+        the caller which starts the refresh runs it before returning, and gets
+        the new value. A refresh which fails leaves the stale value in place.
+
+        """
+        if stale_time or beta:
+            found = self.stash.lookup(key)
+            if found is not None and found[0] is not None:
+                value, _, ttl = found
+                if value.__class__ in _ENCODED:
+                    value = self._decode(value)
+                if ttl is not None:
+                    fresh_for = ttl - stale_time
+                    early = beta and fresh_for > 0 and (
+                        self.stash.flights.duration(key) * beta *
+                        -math.log(1 - random.random()) >= fresh_for)
+                    if fresh_for <= 0 or early:
+                        value = self._start_refresh(key, factory, time, stale_time,
+                                                    refresh, value)
+                return value
+        else:
+            value = self.get(key)
+            if value is not None:
+                return value
+        flights = self.stash.flights
+        flight, leader = flights.begin(key)
+        if not leader:
+            return flight.result(timeout)
+        try:
+            # the value may have been stored while we were looking
+            value = self.get(key)
+            if value is None:
+                value = self._compute(key, factory, time, stale_time)
+        except BaseException as e:
+            flights.finish(key, flight, error=e)
+            raise
+        flights.finish(key, flight, value)
+        return value
+
+    def _compute(self, key, factory, time, stale_time):
+        """Call factory, and store its result under key."""
+        started = _time.perf_counter()
+        value = factory()
+        self.stash.flights.record(key, _time.perf_counter() - started)
+        self.set(key, value, time + stale_time if time else 0)
+        return value
+
+    def _start_refresh(self, key, factory, time, stale_time, refresh, stale):
+        """
+        Refresh a stale value, unless another caller already is.
+
+        Returns the new value if the refresh was run by this caller, or else
+        the stale value.
+
+        """
+        flights = self.stash.flights
+        flight, leader = flights.begin(key)
+        if not leader:
+            return stale
+
+        def run():
+            try:
+                value = self._compute(key, factory, time, stale_time)
+            except Exception as e:
+                self.debuglog("refresh of {} failed: {!r}".format(key, e))
+                flights.finish(key, flight, stale)
+                return stale
+            flights.finish(key, flight, value)
+            return value
+
+        if refresh is None:
+            return run()
+        try:
+            refresh(run)
+        except BaseException:
+            flights.finish(key, flight, stale)
+            raise
+        return stale
+
+    def get_or_set_multi(self, keys, factory, time=0, key_prefix='', timeout=None):
+        """
+        Retrieve the values of multiple keys, computing and storing any missing.
+
+        The keys not found in the stash are passed, as a list, to factory, which
+        should return a dictionary of their values. These are stored with the
+        given expiry time, and the values of all the keys are returned as for
+        get_multi. Keys being computed by another caller are waited for, as for
+        get_or_set, rather than passed to factory; timeout applies to the wait
+        for all such keys together.
+
+        """
+        results = self.get_multi(keys, key_prefix)
+        flights = self.stash.flights
+        leading, following = {}, {}
+        for key in keys:
+            if key not in results:
+                flight, leader = flights.begin(key_prefix + key)
+                (leading if leader else following)[key] = flight
+        if leading:
+            try:
+                computed = factory(list(leading))
+                computed = {key : computed[key] for key in leading if key in computed}
+                self.set_multi(computed, time, key_prefix)
+            except BaseException as e:
+                for key, flight in leading.items():
+                    flights.finish(key_prefix + key, flight, error=e)
+                raise
+            for key, flight in leading.items():
+                flights.finish(key_prefix + key, flight, computed.get(key))
+            results.update(computed)
+        if following:
+            if timeout is not None:
+                deadline = _time.monotonic() + timeout
+            for key, flight in following.items():
+                if timeout is not None:
+                    timeout = max(0, deadline - _time.monotonic())
+                value = flight.result(timeout)
+                if value is not None:
+                    results[key] = value
+        return results
+
+    def check_key(self, key, key_extra_len=0):
+        """Check whether a given key is valid."""
+        if not key:
+            raise Client.MemcachedKeyNoneError("Key is None")
+        if not isinstance(key, str):
+            raise Client.MemcachedKeyTypeError("Key must be str()'s")
+        if isinstance(key, bytes):
+            # this could happen in python 2, but not python 3
+            keylen = len(key)
+        else:
+            keylen = len(key.encode("utf_8"))
+        if (self.server_max_key_length != 0 and
+            keylen + key_extra_len > self.server_max_key_length):
+            raise Client.MemcachedKeyLengthError(
+                "Key length is > {}".format(self.server_max_key_length)
+            )
+        invalid_key_characters = ''.join(map(chr, list(range(33)) + [127]))
+        after_translate = key.translate(key.maketrans('', '', invalid_key_characters))
+        if len(key) != len(after_translate):
+            raise Client.MemcachedKeyCharacterError("Control characters not allowed")
+
+    def cas(self, key, val, time=0, min_compress_len=0):
+        """Set a key only if it has not been changed since last fetched."""
+        if val.__class__ is str or val.__class__ is bytes:
+            val = self._encode(val, min_compress_len)
+            if val is None:
+                return False
+        return self.stash.cas(key, val, time, self.cas_cache.get(key))
+
+    def reset_cas(self):
+        """Reset the cas cache."""
+        self.cas_cache = {}
+
+    def keys_with_prefix(self, prefix):
+        """Return a sorted list of the keys in the connected Stash beginning with prefix."""
+        return self.stash.keys_with_prefix(prefix)
+
+    def get_prefix(self, prefix):
+        """
+        Retrieve the value of every key beginning with prefix.
+
+        The results are returned as a dictionary, whose keys DO NOT include the
+        prefix, as for get_multi with a key_prefix. The keys are found using
+        the stash's prefix_index, if it has one; see BaseStash.
+
+        """
+        found = self.stash.get_prefix(prefix)
+        start = len(prefix)
+        results = {}
+        for key, (result, cas_id) in found.items():
+            key = key[start:]
+            if self.cache_cas:
+                self.cas_cache[key] = cas_id
+            if result.__class__ in _ENCODED:
+                result = self._decode(result)
+            results[key] = result
+        return results
+
+    def delete_prefix(self, prefix):
+        """Delete every key beginning with prefix, returning how many there were."""
+        return len(self.stash.delete_prefix(prefix))
+
+    def namespace_prefix(self, namespace):
+        """
+        Return the prefix for keys in namespace, in its current generation.
+
+        Keys beginning with the prefix belong to the namespace, and are all
+        invalidated at once by invalidate_namespace:
+
+            prefix = gs.namespace_prefix("tenant:42")
+            gs.set(prefix + "settings", settings)
+            gs.get_multi(["settings", "plan"], key_prefix=prefix)
+            gs.invalidate_namespace("tenant:42")
+
+        The prefix changes when the namespace is invalidated, so it should be
+        looked up for each operation, rather than kept.
+
+        """
+        return self.stash.namespace_prefix(namespace)
+
+    def invalidate_namespace(self, namespace):
+        """
+        Invalidate every key in namespace, however many there are, returning the
+        namespace's new generation. See BaseStash.invalidate_namespace.
+
+        """
+        return self.stash.invalidate_namespace(namespace)
+
+    def _encode(self, val, min_compress_len):
+        """
+        Return a str or bytes val in the form in which it should be stored, or
+        None if it is too long to store.
+
+        """
+        limit = self.server_max_value_length
+        if not (min_compress_len or self.chunk_size) and 4 * len(val) <= limit:
+            return val
+        if min_compress_len and len(val) > min_compress_len:
+            compressed = Compressed.compress(val, min_compress_len, self.codec)
+            if compressed is not None:
+                val = compressed
+        if self.chunk_size and val.__class__ is not Compressed:
+            if _too_long(val, self.chunk_size):
+                return Chunked.split(val, self.chunk_size)
+        if limit and _too_long(val, limit):
+            return None
+        return val
+
+    @staticmethod
+    def _decode(value):
+        if value.__class__ is Compressed:
+            return value.decompress()
+        if value.text:
+            return value.join()
+        return value
+
+    def gets(self, key):
+        """Get a key.
+
+        This method is included for completeness, but doesn't seem to be used by
+        python-memcached.
+
+        """
+        return self.get(key)
+
+    def get_stats(self, stat_args = None):
+        """
+        Get statistics from the connected Stash.
+
+        As from python-memcached, the result is a list holding, for each
+        stash, a tuple of a name for the stash and its weight, and a
+        dictionary of its statistics, whose values are strings. See
+        BaseStash.get_stats for the available stat_args.
+
+        """
+        results = []
+        for name, stash in self._servers():
+            stats = stash.get_stats(stat_args)
+            results.append((name, {name : str(value) for name, value in stats.items()}))
+        return results
+
+    def get_slabs(self):
+        """
+        Get statistics about the items in the connected Stash.
+
+        A stash has no slabs, so its items are reported as a single slab, "1".
+
+        """
+        results = []
+        for name, stash in self._servers():
+            stats = stash.get_stats("items")
+            results.append((name, {'1' : {name : str(value)
+                                          for name, value in stats.items()}}))
+        return results
+
+    def _servers(self):
+        """Return a list of (name, stash) for each of the connected stashes."""
+        servers = self.stash.servers if isinstance(self.stash, RingStash) else [(self.stash, 1)]
+        return [("{} ({})".format(getattr(stash, 'name', None) or type(stash).__name__,
+                                  weight), stash)
+                for stash, weight in servers]
+
+    def set_servers(self, servers):
+        """
+        Replace the connected stashes.
+
+        If the client is connected to a list of stashes, the keys which belong
+        to the stashes which remain are mostly unaffected; see RingStash.
+
+        """
+        if isinstance(servers, list) and isinstance(self.stash, RingStash):
+            self.stash.set_servers(servers)
+        else:
+            self.stash = self._connect(servers)
+
+    @staticmethod
+    def _connect(servers):
+        if isinstance(servers, list):
+            return RingStash(servers)
+        return servers
+
+    # Dummy methods
+
+    def forget_dead_hosts(self):
+        pass
+
+    def disconnect_all(self):
+        pass
+
+
+
+def memoize(client, time=0, key_prefix=None, timeout=None):
+    """
+    Decorator caching the results of a function in a gemstash Client.
+
+    The arguments of each call are hashed into a key in the namespace named
+    key_prefix (by default, the module and qualified name of the function;
+    see Client.namespace_prefix), under which the result is stored for time
+    seconds. Concurrent calls with the same
+    arguments run the function once, as for Client.get_or_set. Arguments are
+    distinguished by their type and repr, so f(1), f(1.0) and f(a=1) are
+    cached separately, and results of None are not cached. An argument whose
+    repr does not depend only on its value (the default object repr, which
+    gives its address, or a function's) raises TypeError.
+
+        @gemstash.memoize(gs, time=300)
+        def lookup(user_id):
+            ...
+
+    The decorated function has additional attributes:
+
+        lookup.multi([(1,), (2,), (3,)])
+
+    returns a list of results for several argument tuples, using a single
+    get_multi, and a single set_multi for those results which are missing.
+
+        lookup.invalidate(1)
+
+    forgets the result of lookup(1), and
+
+        lookup.invalidate_all()
+
+    forgets every result at once, by invalidating the namespace.
+
+    """
+    def decorator(func):
+        namespace = key_prefix or "{}.{}".format(func.__module__, func.__qualname__)
+        # roughly the longest key which will be used, with the separators of
+        # the namespace prefix spelled as valid characters
+        client.check_key(namespace + ":" + "0" * 8 + ":" + "0" * 32)
+
+        def digest(args, kwargs):
+            text = _argument_key(args) + _argument_key(dict(kwargs or {}))
+            return hashlib.blake2b(text.encode("utf_8"), digest_size=16).hexdigest()
+
+        def generation_prefix():
+            return client.namespace_prefix(namespace)
+
+        @functools.wraps(func)
+        def memoized(*args, **kwargs):
+            key = generation_prefix() + digest(args, kwargs)
+            return client.get_or_set(key, lambda: func(*args, **kwargs), time, timeout)
+
+        def multi(arg_tuples):
+            arg_tuples = [tuple(args) for args in arg_tuples]
+            keys = [digest(args, None) for args in arg_tuples]
+            by_key = dict(zip(keys, arg_tuples))
+
+            def compute(missing):
+                return {key : func(*by_key[key]) for key in missing}
+
+            results = client.get_or_set_multi(keys, compute, time,
+                                              generation_prefix(), timeout)
+            return [results.get(key) for key in keys]
+
+        def invalidate(*args, **kwargs):
+            client.delete(generation_prefix() + digest(args, kwargs))
+
+        def invalidate_all():
+            client.invalidate_namespace(namespace)
+
+        memoized.multi = multi
+        memoized.invalidate = invalidate
+        memoized.invalidate_all = invalidate_all
+        return memoized
+
+    return decorator
+
+
+def _argument_key(value):
+    """
+    Return a text encoding of value, for memoize, in which values of different
+    types, and the items of containers, cannot run together.
+
+    """
+    kind = value.__class__
+    if kind is tuple or kind is list:
+        items = [_argument_key(item) for item in value]
+    elif kind is dict:
+        items = sorted(_argument_key(key) + _argument_key(item)
+                       for key, item in value.items())
+    elif kind is set or kind is frozenset:
+        items = sorted(_argument_key(item) for item in value)
+    else:
+        text = repr(value)
+        if kind.__repr__ is object.__repr__ or " at 0x" in text:
+            raise TypeError("cannot memoize on {!r}, whose repr is not based on its "
+                            "value".format(value))
+        if kind not in _ARGUMENT_TYPES:
+            text = "{}.{}:{}".format(kind.__module__, kind.__qualname__, text)
+        return "{}:{}:{}".format(kind.__name__, len(text), text)
+    return "{}:{}:{}".format(kind.__name__, len(items), "".join(items))
+
+
+_ARGUMENT_TYPES = (str, bytes, int, float, complex, bool, type(None))
+
+
+class Histogram(object):
+    """
+    Latency histogram with fixed log-linear buckets, in the style of HDR
+    Histogram.
+
+    Durations are recorded in nanoseconds. Values below 2**precision fall in
+    buckets of their own; above that, each power of two is divided into
+    2**(precision - 1) buckets, so that reported percentiles are within about
+    2**(1 - precision) of the true value (3% by default). Durations longer
+    than max_seconds are counted in the last bucket.
+
+    Counts are updated without locking, so under heavy contention they may be
+    slightly low.
+
+    """
+
+    def __init__(self, precision=6, max_seconds=60):
+        self.precision = precision
+        self.half = 1 << (precision - 1)
+        self.counts = [0] * (self._index(int(max_seconds * 1e9)) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        """Record a duration, in seconds."""
+        value = int(seconds * 1e9)
+        index = self._index(value)
+        if index >= len(self.counts):
+            index = len(self.counts) - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Return the duration, in seconds, below which percent of durations fell."""
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self._upper(index), self.max) / 1e9
+        return self.max / 1e9
+
+    def summary(self):
+        """Return the count, mean, max, p50, p99 and p999 of the durations."""
+        return {
+            'count' : self.count,
+            'mean' : self.total / self.count / 1e9 if self.count else 0.0,
+            'max' : self.max / 1e9,
+            'p50' : self.percentile(50),
+            'p99' : self.percentile(99),
+            'p999' : self.percentile(99.9),
+        }
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = self.total = self.max = 0
+
+    def _index(self, value):
+        shift = value.bit_length() - self.precision
+        if shift <= 0:
+            return value
+        return (shift * self.half) + (value >> shift)
+
+    def _upper(self, index):
+        """Return the largest value which falls in bucket index."""
+        if index < 2 * self.half:
+            return index
+        shift = index // self.half - 1
+        return ((index - shift * self.half + 1) << shift) - 1
+
+
+class Instrumentation(object):
+    """
+    Records the latency of each operation on a Client or stash, and calls
+    tracing hooks around them.
+
+        >>> instrumentation = gemstash.Instrumentation(gs)
+        >>> gs.get("foo")
+        >>> instrumentation.report()['get']
+        {'count': 1, 'mean': 1.2e-06, 'max': 1.2e-06, 'p50': ..., ...}
+        >>> instrumentation.remove()
+
+    The operations named in ops (by default, every operation in OPS which the
+    target has) are wrapped by giving the target a subclass of its own class,
+    so an object which is not instrumented pays nothing at all. remove()
+    restores the original class. Operations called by other operations, such
+    as the set performed by a successful cas, are recorded as well. An
+    instrumented SharedMemoryStash cannot be pickled.
+
+    Hooks are added with add_hook. A before hook is called as
+    before(op, args) when an operation starts, and an after hook as
+    after(op, args, result, error, seconds) when it finishes, where error is
+    the exception raised, if any.
+
+    """
+
+    OPS = ('get', 'gets', 'get_multi', 'set', 'add', 'replace', 'append', 'prepend',
+           'cas', 'incr', 'decr', 'delete', 'set_multi', 'delete_multi', 'flush_all',
+           'get_or_set', 'get_or_set_multi', 'touch', 'gat', 'get_multi_and_touch',
+           'keys_with_prefix', 'get_prefix', 'delete_prefix', 'invalidate_namespace',
+           '__getitem__', '__delitem__', 'lookup', 'update', 'modify', 'flush', 'cleanup')
+    NAMES = {'__getitem__' : 'get', '__delitem__' : 'delete'}
+
+    def __init__(self, target, ops=None, precision=6):
+        """Instrument target."""
+        cls = type(target)
+        if ops is None:
+            ops = [op for op in self.OPS if callable(getattr(cls, op, None))]
+        self.target = target
+        self.before = []
+        self.after = []
+        self.histograms = {}
+        namespace = {'__module__' : cls.__module__, '__qualname__' : cls.__qualname__}
+        for op in ops:
+            name = self.NAMES.get(op, op)
+            histogram = self.histograms.setdefault(name, Histogram(precision))
+            namespace[op] = self._wrap(name, getattr(cls, op), histogram)
+        self._original = cls
+        target.__class__ = type(cls)(cls.__name__, (cls,), namespace)
+
+    def add_hook(self, before=None, after=None):
+        """Add a hook to be called before or after each operation."""
+        if before is not None:
+            self.before.append(before)
+        if after is not None:
+            self.after.append(after)
+
+    def report(self):
+        """Return a summary of the latency of each operation which has been used."""
+        return {name : histogram.summary()
+                for name, histogram in self.histograms.items() if histogram.count}
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+
+    def remove(self):
+        """Stop instrumenting the target."""
+        self.target.__class__ = self._original
+
+    def _wrap(self, name, method, histogram):
+        before, after = self.before, self.after
+
+        @functools.wraps(method)
+        def wrapper(target, *args, **kwargs):
+            for hook in before:
+                hook(name, args)
+            result = error = None
+            started = _time.perf_counter()
+            try:
+                result = method(target, *args, **kwargs)
+                return result
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                seconds = _time.perf_counter() - started
+                histogram.record(seconds)
+                for hook in after:
+                    hook(name, args, result, error, seconds)
+
+        return wrapper
@@ -0,0 +1,249 @@
+# Copyright 2015 Tracy Poff. See LICENSE for details.
+
+"""
+asyncio client for gemstash.
+
+Usage:
+
+    >>> import gemstash
+    >>> from gemstash.aio import AsyncClient
+    >>> gs = AsyncClient(gemstash.Stash())
+    >>> await gs.set("foo", "bar")
+    True
+    >>> await gs.get("foo")
+    'bar'
+
+Requires Python 3.7 or later.
+
+"""
+
+import asyncio
+import functools
+
+import gemstash
+
+# values which Client.get decompresses or joins
+_ENCODED = (gemstash.Compressed, gemstash.Chunked)
+
+
+class AsyncClient(object):
+    """
+    Client mimicking a memcached client, for use from asyncio coroutines.
+
+    The methods are the same as those of gemstash.Client, but are coroutines.
+    An operation on a key held in memory by a Stash or MimicStash is performed
+    immediately if the lock guarding the key is free. Otherwise it is handed to
+    a thread from executor (by default, the event loop's default executor), so
+    that the event loop is never blocked waiting. So are the operations which
+    may be slow however free the lock is: append and prepend, which may copy
+    large values; stores which compress or chunk their value; decompressing or
+    joining a value read by get; and every operation on a TieredStash, which
+    may read from disk, or a SharedMemoryStash, whose lock other processes
+    share.
+
+    Concurrent gets of the same key made while it is handed to the executor
+    share a single lookup. Writing a key starts a fresh lookup for later gets,
+    so that a coroutine always sees its own writes.
+
+    Other arguments are passed to gemstash.Client.
+
+    """
+
+    def __init__(self, servers, executor=None, **kwargs):
+        """Create a new AsyncClient attached to a specified Stash."""
+        self.client = gemstash.Client(servers, **kwargs)
+        self.stash = self.client.stash
+        self.executor = executor
+        self._gets = {}
+
+    def check_key(self, key, key_extra_len=0):
+        """Check whether a given key is valid."""
+        return self.client.check_key(key, key_extra_len)
+
+    def reset_cas(self):
+        """Reset the cas cache."""
+        self.client.reset_cas()
+
+    async def get(self, key):
+        """Retrieve the value of a key from the connected Stash."""
+        pending = self._gets.get(key)
+        if pending is None:
+            done, result = self._inline(key, self._get, key)
+            if done:
+                if result.__class__ in _ENCODED:
+                    return await self._offload(gemstash.Client._decode, result)
+                return result
+            pending = self._offload(self.client.get, key)
+            self._gets[key] = pending
+            pending.add_done_callback(functools.partial(self._forget, key))
+        return await asyncio.shield(pending)
+
+    async def gets(self, key):
+        """Get a key."""
+        return await self.get(key)
+
+    async def get_multi(self, keys, key_prefix=''):
+        """Retrieve the values of multiple keys from the connected Stash."""
+        return await self._offload(self.client.get_multi, keys, key_prefix)
+
+    async def gat(self, key, time=0, sliding=False):
+        """Retrieve the value of a key and change its expiry time."""
+        return await self._write(key, self.client.gat, key, time, sliding)
+
+    async def get_multi_and_touch(self, keys, time=0, key_prefix='', sliding=False):
+        """Retrieve the values of multiple keys and change their expiry times."""
+        return await self._offload(self.client.get_multi_and_touch, keys, time,
+                                   key_prefix, sliding)
+
+    async def touch(self, key, time=0, sliding=False):
+        """Change the expiry time of a key without sending its value again."""
+        return await self._write(key, self.client.touch, key, time, sliding)
+
+    async def set(self, key, val, time=0, min_compress_len=0):
+        """Assign val to key in the connected stash."""
+        return await self._store(self.client.set, key, val, time, min_compress_len)
+
+    async def add(self, key, val, time=0, min_compress_len=0):
+        """Add a new key only if that key does not exist in the stash."""
+        return await self._store(self.client.add, key, val, time, min_compress_len)
+
+    async def replace(self, key, val, time=0, min_compress_len=0):
+        """Replace an existing key's value with val."""
+        return await self._store(self.client.replace, key, val, time, min_compress_len)
+
+    async def append(self, key, val, time=0, min_compress_len=0):
+        """Append the given val to the existing key's value."""
+        self._gets.pop(key, None)
+        return await self._offload(self.client.append, key, val, time, min_compress_len)
+
+    async def prepend(self, key, val, time=0, min_compress_len=0):
+        """Prepend the given val to the existing key's value."""
+        self._gets.pop(key, None)
+        return await self._offload(self.client.prepend, key, val, time, min_compress_len)
+
+    async def cas(self, key, val, time=0, min_compress_len=0):
+        """Set a key only if it has not been changed since last fetched."""
+        return await self._store(self.client.cas, key, val, time, min_compress_len)
+
+    async def incr(self, key, delta=1):
+        """Increment the value assigned to key by delta."""
+        return await self._write(key, self.client.incr, key, delta)
+
+    async def decr(self, key, delta=1):
+        """Decrement the value assigned to key by delta."""
+        return await self._write(key, self.client.decr, key, delta)
+
+    async def delete(self, key, time=0):
+        """Delete a key from the connected Stash."""
+        return await self._write(key, self.client.delete, key, time)
+
+    async def set_multi(self, mapping, time=0, key_prefix='', min_compress_len=0,
+                        atomic=False):
+        """Set multiple keys in the connected Stash."""
+        for key in mapping:
+            self._gets.pop(key_prefix + key, None)
+        return await self._offload(self.client.set_multi, mapping, time,
+                                   key_prefix, min_compress_len, atomic)
+
+    async def delete_multi(self, keys, time=0, key_prefix='', atomic=False):
+        """Delete multiple keys from the connected Stash."""
+        for key in keys:
+            self._gets.pop(key_prefix + key, None)
+        return await self._offload(self.client.delete_multi, keys, time, key_prefix,
+                                   atomic)
+
+    async def keys_with_prefix(self, prefix):
+        """Return a sorted list of the keys beginning with prefix."""
+        return await self._offload(self.client.keys_with_prefix, prefix)
+
+    async def get_prefix(self, prefix):
+        """Retrieve the value of every key beginning with prefix."""
+        return await self._offload(self.client.get_prefix, prefix)
+
+    async def delete_prefix(self, prefix):
+        """Delete every key beginning with prefix."""
+        for key in [key for key in self._gets if key.startswith(prefix)]:
+            del self._gets[key]
+        return await self._offload(self.client.delete_prefix, prefix)
+
+    def namespace_prefix(self, namespace):
+        """Return the prefix for keys in namespace. See gemstash.Client."""
+        return self.client.namespace_prefix(namespace)
+
+    async def invalidate_namespace(self, namespace):
+        """Invalidate every key in namespace at once."""
+        return await self._offload(self.client.invalidate_namespace, namespace)
+
+    def set_servers(self, servers):
+        """Replace the connected stashes. See gemstash.Client.set_servers."""
+        self.client.set_servers(servers)
+        self.stash = self.client.stash
+        self._gets.clear()
+
+    async def flush_all(self):
+        """Expire all data in the connected Stash."""
+        self._gets.clear()
+        return await self._offload(self.client.flush_all)
+
+    async def _write(self, key, func, *args):
+        self._gets.pop(key, None)
+        done, result = self._inline(key, func, *args)
+        if done:
+            return result
+        return await self._offload(func, *args)
+
+    async def _store(self, func, key, val, time, min_compress_len):
+        if self._encodes(val, min_compress_len):
+            self._gets.pop(key, None)
+            return await self._offload(func, key, val, time, min_compress_len)
+        return await self._write(key, func, key, val, time, min_compress_len)
+
+    def _encodes(self, val, min_compress_len):
+        """Return whether storing val may compress it or split it into chunks."""
+        if val.__class__ is not str and val.__class__ is not bytes:
+            return False
+        chunk_size = self.client.chunk_size
+        return ((min_compress_len and len(val) > min_compress_len) or
+                (chunk_size and len(val) > chunk_size))
+
+    def _get(self, key):
+        """Look up key as Client.get does, but without decoding its value."""
+        found = self.stash[key]
+        if found is None:
+            return None
+        value, cas_id = found
+        if value and self.client.cache_cas:
+            self.client.cas_cache[key] = cas_id
+        return value
+
+    def _inline(self, key, func, *args):
+        """
+        Call func right away if the lock for key can be taken without waiting.
+
+        Returns whether func was called, and its result.
+
+        """
+        lock = self._lock(key)
+        if lock is None or not lock.acquire(False):
+            return False, None
+        try:
+            return True, func(*args)
+        finally:
+            lock.release()
+
+    def _lock(self, key):
+        """Return the lock to take to operate on key inline, or None if never."""
+        stash = self.stash
+        while isinstance(stash, gemstash.ShardedStash):
+            stash = stash.shard(key)
+        if isinstance(stash, gemstash.TieredStash) or not isinstance(stash, gemstash.BaseStash):
+            return None
+        return stash.write_lock
+
+    def _offload(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    def _forget(self, key, future):
+        if self._gets.get(key) is future:
+            del self._gets[key]
@@ -0,0 +1,727 @@
+# Copyright 2015 Tracy Poff. See LICENSE for details.
+
+"""
+Benchmarks for gemstash.
+
+Run from the command line:
+
+    python -m gemstash.bench [--ops N] [--only GROUP] [--json FILE]
+
+Every benchmark produces a record of its name, the stash it ran against, its
+parameters and the metrics measured. The records are printed as a table and,
+with --json, written to FILE (or stdout, for "-") as JSON, so that runs can be
+compared with a diff.
+
+"""
+
+import argparse
+import asyncio
+import bisect
+import concurrent.futures
+import gc
+import itertools
+import json
+import platform
+import random
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+
+import gemstash
+import gemstash.server
+from gemstash.aio import AsyncClient
+
+THREAD_COUNTS = (1, 2, 4, 8, 16)
+# (connections, pipeline, keys_per_get) for server_throughput
+SERVER_LOADS = ((1, 1, 1), (4, 1, 1), (4, 16, 1), (4, 16, 10))
+
+
+def contention(stash, threads, ops=20000, keys=1000):
+    """
+    Measure throughput of a mixed workload run by several threads at once.
+
+    Each thread performs ops operations on keys chosen at random from a fixed
+    keyspace: one quarter set, one quarter incr, and the remainder get. Returns
+    the total number of operations per second across all threads.
+
+    """
+    client = gemstash.Client(stash)
+    keyspace = ["key{}".format(i) for i in range(keys)]
+    client.set_multi({key : 1 for key in keyspace})
+    start = threading.Barrier(threads + 1)
+
+    def work(seed):
+        rng = random.Random(seed)
+        picks = [rng.choice(keyspace) for _ in range(ops)]
+        start.wait()
+        for i, key in enumerate(picks):
+            op = i % 4
+            if op == 0:
+                client.set(key, i + 1)
+            elif op == 1:
+                client.incr(key)
+            else:
+                client.get(key)
+
+    workers = [threading.Thread(target=work, args=(seed,))
+               for seed in range(threads)]
+    for worker in workers:
+        worker.start()
+    start.wait()
+    began = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - began
+    return threads * ops / elapsed
+
+
+def event_loop(use_async, ops=20000, concurrency=100, contended=False, keys=1000):
+    """
+    Measure a workload run by coroutines sharing one event loop.
+
+    concurrency coroutines together perform ops operations, alternately get
+    and set, either through an AsyncClient or by calling a Client directly. If
+    contended, another thread repeatedly holds the stash's write_lock for ten
+    milliseconds at a time, as a long append might. Returns the number of
+    operations per second, and the longest time in seconds for which the
+    event loop was unable to run other tasks.
+
+    """
+    stash = gemstash.Stash()
+    if use_async:
+        client = AsyncClient(stash)
+    else:
+        client = gemstash.Client(stash)
+    keyspace = ["key{}".format(i) for i in range(keys)]
+    stop = threading.Event()
+
+    def hog():
+        while not stop.is_set():
+            with stash.write_lock:
+                time.sleep(0.01)
+            time.sleep(0.01)
+
+    async def work(seed):
+        rng = random.Random(seed)
+        for i in range(ops // concurrency):
+            key = rng.choice(keyspace)
+            if use_async:
+                if i % 2:
+                    await client.get(key)
+                else:
+                    await client.set(key, i)
+            else:
+                if i % 2:
+                    client.get(key)
+                else:
+                    client.set(key, i)
+            # let the other coroutines run, as a real handler would
+            await asyncio.sleep(0)
+
+    async def heartbeat(lag):
+        last = time.perf_counter()
+        while not stop.is_set():
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            lag[0] = max(lag[0], now - last - 0.001)
+            last = now
+
+    async def run():
+        lag = [0.0]
+        beat = asyncio.ensure_future(heartbeat(lag))
+        began = time.perf_counter()
+        await asyncio.gather(*[work(seed) for seed in range(concurrency)])
+        elapsed = time.perf_counter() - began
+        stop.set()
+        await beat
+        return ops / elapsed, lag[0]
+
+    if contended:
+        hogger = threading.Thread(target=hog)
+        hogger.start()
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        stop.set()
+        loop.close()
+        if contended:
+            hogger.join()
+
+
+def expiry_boundary(stale_time, beta=0, threads=8, reads=1000, time_to_live=0.05,
+                    cost=0.01, interval=0.001):
+    """
+    Measure read latency of a hot key which keeps expiring.
+
+    Each thread reads the key reads times with Client.get_or_set, pausing for
+    interval seconds between reads, where
+    computing the value takes cost seconds and it lives for time_to_live
+    seconds, so that reads regularly cross an expiry boundary. Refreshes of
+    stale values run in a thread pool. Returns the median and 99th percentile
+    read latency, in seconds.
+
+    """
+    client = gemstash.Client(gemstash.Stash())
+    pool = concurrent.futures.ThreadPoolExecutor(2)
+    latencies = []
+
+    def factory():
+        time.sleep(cost)
+        return "value"
+
+    def work():
+        timings = []
+        for _ in range(reads):
+            began = time.perf_counter()
+            client.get_or_set("hot", factory, time_to_live, stale_time=stale_time,
+                              beta=beta, refresh=pool.submit)
+            timings.append(time.perf_counter() - began)
+            time.sleep(interval)
+        latencies.extend(timings)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    pool.shutdown()
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[len(latencies) * 99 // 100]
+
+
+def counter_overhead(ops=200000, repeat=5):
+    """
+    Measure the cost of the statistics counters on the get path.
+
+    Times ops reads of a present key and of a missing key from a Stash, and ops
+    increments of the counter each read updates, less the cost of an empty
+    statement. The counters are timed on their own, rather than against a
+    copy of the read path without them, so that the comparison cannot go
+    stale. Returns the best time per operation in nanoseconds, keyed by "hit",
+    "miss" and "counter".
+
+    """
+    stash = gemstash.Stash()
+    stash.set("key", "value", 0)
+    def best(statement, key=None):
+        timer = timeit.Timer(statement, globals={'stash' : stash, 'key' : key})
+        return min(timer.repeat(repeat, ops)) / ops * 1e9
+    empty = best("pass")
+    return {
+        'hit' : best("stash[key]", "key"),
+        'miss' : best("stash[key]", "missing"),
+        'counter' : best("stash.get_hits += 1") - empty,
+    }
+
+
+def instrumentation_overhead(ops=200000, repeat=5):
+    """
+    Measure the cost of instrumenting a Client.
+
+    Times ops calls of Client.get for a present key, before instrumenting the
+    client, while instrumented, and after the instrumentation is removed.
+    Returns the best time per call in nanoseconds for each.
+
+    """
+    client = gemstash.Client(gemstash.Stash())
+    client.set("key", "value")
+    timer = timeit.Timer('client.get("key")', globals={'client' : client})
+    results = {'plain' : min(timer.repeat(repeat, ops)) / ops * 1e9}
+    instrumentation = gemstash.Instrumentation(client)
+    results['instrumented'] = min(timer.repeat(repeat, ops)) / ops * 1e9
+    instrumentation.remove()
+    results['removed'] = min(timer.repeat(repeat, ops)) / ops * 1e9
+    return results
+
+
+STASHES = (
+    ("Stash", gemstash.Stash),
+    ("MimicStash", gemstash.MimicStash),
+)
+BATCH_SIZES = (1, 10, 100, 1000)
+KEYS = 10000
+
+
+def server_throughput(stash_factory, ops=20000, connections=4, pipeline=16,
+                      keys_per_get=1, keys=1000, value_size=100):
+    """
+    Measure a gemstash.server under load from a local load generator.
+
+    The server runs on an event loop in its own thread. connections clients,
+    on another event loop, send ops requests in all, pipeline at a time before
+    reading the responses; one request in ten is a set, and the rest are gets
+    of keys_per_get keys. Returns the number of requests and of keys handled
+    per second.
+
+    """
+    stash = stash_factory()
+    value = b"x" * value_size
+    keyspace = [b"key%d" % i for i in range(keys)]
+    stash.set_multi({key.decode() : gemstash.RawValue(0, value) for key in keyspace}, 0)
+    started = concurrent.futures.Future()
+
+    def run_server():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(gemstash.server.serve(stash, port=0))
+        started.set_result((loop, server))
+        loop.run_forever()
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+    async def load(port, requests, seed):
+        rng = random.Random(seed)
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        keys_read = 0
+        for sent in range(0, requests, pipeline):
+            batch, ends, stored = [], 0, 0
+            for i in range(min(pipeline, requests - sent)):
+                if rng.random() < 0.1:
+                    batch.append(b"set %s 0 0 %d\r\n%s\r\n"
+                                 % (rng.choice(keyspace), value_size, value))
+                    stored += 1
+                else:
+                    batch.append(b"get " + b" ".join(rng.sample(keyspace, keys_per_get))
+                                 + b"\r\n")
+                    ends += 1
+            writer.write(b"".join(batch))
+            received = bytearray()
+            while (received.count(b"END\r\n") < ends
+                   or received.count(b"STORED\r\n") < stored):
+                received += await reader.read(65536)
+            keys_read += received.count(b"VALUE ")
+        writer.close()
+        return keys_read
+
+    async def run(port):
+        began = time.perf_counter()
+        counts = await asyncio.gather(*[load(port, ops // connections, seed)
+                                        for seed in range(connections)])
+        return time.perf_counter() - began, sum(counts)
+
+    thread = threading.Thread(target=run_server)
+    thread.start()
+    server_loop, server = started.result()
+    loop = asyncio.new_event_loop()
+    try:
+        elapsed, keys_read = loop.run_until_complete(
+            run(server.sockets[0].getsockname()[1]))
+    finally:
+        loop.close()
+        server_loop.call_soon_threadsafe(server_loop.stop)
+        thread.join()
+    return [("server_throughput",
+             {'connections' : connections, 'pipeline' : pipeline,
+              'keys_per_get' : keys_per_get},
+             {'requests_per_sec' : ops // connections * connections / elapsed,
+              'keys_per_sec' : keys_read / elapsed})]
+
+
+def _best(func, repeat):
+    """Return the shortest time in seconds taken by func() over repeat runs."""
+    best = None
+    for _ in range(repeat):
+        began = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - began
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def _rate(ops, seconds):
+    return {'ops_per_sec' : ops / seconds, 'ns_per_op' : seconds / ops * 1e9}
+
+
+def zipf_keys(keyspace, count, s=1.0, seed=0):
+    """Return count keys drawn from keyspace with Zipfian popularity."""
+    cumulative = list(itertools.accumulate(1 / rank ** s
+                                           for rank in range(1, len(keyspace) + 1)))
+    rng = random.Random(seed)
+    total = cumulative[-1]
+    return [keyspace[bisect.bisect_left(cumulative, rng.random() * total)]
+            for _ in range(count)]
+
+
+def hot_paths(stash_factory, ops=20000, repeat=3):
+    """
+    Measure the single-key operations of a Client over a fresh stash.
+
+    Returns a list of (name, params, metrics) for get (hit and miss), gets,
+    set, set with expiry, add, replace, delete, cas, incr and append.
+
+    """
+    keyspace = ["key{}".format(i) for i in range(KEYS)]
+    picks = [keyspace[i % KEYS] for i in range(ops)]
+    results = []
+
+    def fresh():
+        client = gemstash.Client(stash_factory(), cache_cas=True)
+        for key in keyspace:
+            client.set(key, "value")
+        return client
+
+    client = fresh()
+
+    def record(name, func, params=None, count=ops):
+        results.append((name, params or {}, _rate(count, _best(func, repeat))))
+
+    record("get_hit", lambda: [client.get(key) for key in picks])
+    record("get_miss", lambda: [client.get("missing") for key in picks])
+    record("gets", lambda: [client.gets(key) for key in picks])
+    record("set", lambda: [client.set(key, "value") for key in picks])
+    record("set_expiring", lambda: [client.set(key, "value", 300) for key in picks])
+    record("add_existing", lambda: [client.add(key, "value") for key in picks])
+    record("replace", lambda: [client.replace(key, "value") for key in picks])
+
+    def delete():
+        for key in picks:
+            client.delete(key)
+        for key in keyspace:
+            client.set(key, "value")
+    record("delete", delete, {'includes_reset' : True}, ops + KEYS)
+
+    def cas():
+        for key in picks:
+            client.gets(key)
+            client.cas(key, "value")
+    record("gets_cas", cas)
+
+    for key in keyspace:
+        client.set(key, 1)
+    record("incr", lambda: [client.incr(key) for key in picks])
+
+    for size in (10, 1000):
+        def append():
+            client.set("growing", "x")
+            for _ in range(size):
+                client.append("growing", "x")
+        runs = max(1, ops // size)
+        record("append_growing", lambda: [append() for _ in range(runs)],
+               {'final_length' : size + 1}, runs * size)
+    return results
+
+
+def batches(stash_factory, ops=20000, repeat=3):
+    """
+    Measure get_multi, set_multi and delete_multi at each of BATCH_SIZES.
+
+    Metrics are per key, so batch sizes can be compared directly.
+
+    """
+    keyspace = ["key{}".format(i) for i in range(KEYS)]
+    client = gemstash.Client(stash_factory())
+    results = []
+    for size in BATCH_SIZES:
+        chunks = [keyspace[i:i + size] for i in range(0, KEYS, size)]
+        chunks = (chunks * (ops // KEYS + 1))[:max(1, ops // size)]
+        mappings = [{key : "value" for key in chunk} for chunk in chunks]
+        keys = len(chunks) * size
+        results.append(("set_multi", {'batch' : size}, _rate(keys, _best(
+            lambda: [client.set_multi(mapping) for mapping in mappings], repeat))))
+        results.append(("get_multi", {'batch' : size}, _rate(keys, _best(
+            lambda: [client.get_multi(chunk) for chunk in chunks], repeat))))
+
+        def delete():
+            for chunk, mapping in zip(chunks, mappings):
+                client.delete_multi(chunk)
+                client.set_multi(mapping)
+        results.append(("delete_multi", {'batch' : size, 'includes_reset' : True},
+                        _rate(2 * keys, _best(delete, repeat))))
+    return results
+
+
+def zipf_mix(stash_factory, read_fraction, ops=20000, repeat=3, s=1.0):
+    """
+    Measure a mix of get and set over keys with Zipfian popularity.
+
+    read_fraction of the operations are gets; the rest are sets. A tenth of
+    the keyspace is loaded beforehand, so less popular keys miss.
+
+    """
+    keyspace = ["key{}".format(i) for i in range(KEYS)]
+    picks = zipf_keys(keyspace, ops, s)
+    rng = random.Random(1)
+    reads = [rng.random() < read_fraction for _ in range(ops)]
+    client = gemstash.Client(stash_factory())
+    for key in keyspace[:KEYS // 10]:
+        client.set(key, "value")
+
+    def run():
+        for key, read in zip(picks, reads):
+            if read:
+                client.get(key)
+            else:
+                client.set(key, "value")
+
+    return [("zipf_mix", {'read_fraction' : read_fraction, 's' : s},
+             _rate(ops, _best(run, repeat)))]
+
+
+GROUPS = ('hot_paths', 'batches', 'zipf_mix', 'memory', 'contention', 'event_loop',
+          'expiry_boundary', 'counter_overhead', 'instrumentation_overhead', 'server',
+          'invalidation', 'prefix_scan', 'sessions')
+
+
+def entry_memory(stash_factory, items=100000, time=0):
+    """
+    Measure the memory taken by each entry in a stash.
+
+    Stores items short str values, with expiry time, and returns the number of
+    bytes allocated per entry, including the keys and values themselves.
+
+    """
+    stash = stash_factory()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(items):
+            stash.set("key{}".format(i), "value{}".format(i), time)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return [("entry_memory", {'expiring' : bool(time)},
+             {'bytes_per_entry' : (after - before) / items})]
+
+
+def invalidation(stash_factory, sizes=(1, 100000), repeat=3):
+    """
+    Measure invalidating a group of keys, by namespace and by deleting them.
+
+    For each size, fills a stash with a group of that many keys, and times
+    invalidate_namespace, and delete_multi of the keys. Returns the best time
+    of each in nanoseconds.
+
+    """
+    results = []
+    for size in sizes:
+        timings = {'namespace' : None, 'delete_multi' : None}
+        for _ in range(repeat):
+            stash = stash_factory()
+            prefix = stash.namespace_prefix("group")
+            keys = [prefix + str(i) for i in range(size)]
+            stash.set_multi(dict.fromkeys(keys, "value"), 0)
+            # warm the caches, which filling the stash has left cold
+            stash.invalidate_namespace("other")
+            for method, invalidate in (
+                    ('namespace', lambda: stash.invalidate_namespace("group")),
+                    ('delete_multi', lambda: stash.delete_multi(keys))):
+                # as timeit does, keep the collector from running mid-call
+                gc.disable()
+                try:
+                    began = time.perf_counter()
+                    invalidate()
+                    elapsed = time.perf_counter() - began
+                finally:
+                    gc.enable()
+                if timings[method] is None or elapsed < timings[method]:
+                    timings[method] = elapsed
+        for method, seconds in timings.items():
+            results.append(("invalidation", {'keys' : size, 'method' : method},
+                            {'ns' : seconds * 1e9}))
+    return results
+
+
+def prefix_scan(stash_factory, keys=100000, matches=100, repeat=3):
+    """
+    Measure finding the keys with a prefix, with and without a prefix index.
+
+    Fills a stash with keys keys, of which matches share a prefix, and returns
+    the time taken by keys_with_prefix and by get_prefix, and the time to set
+    a key, with and without prefix_index.
+
+    """
+    results = []
+    for indexed in (False, True):
+        stash = stash_factory(prefix_index=indexed)
+        stash.set_multi({"key{}".format(i) : "value" for i in range(keys - matches)}, 0)
+        stash.set_multi({"group:{}".format(i) : "value" for i in range(matches)}, 0)
+        counter = itertools.count()
+        metrics = {
+            'keys_with_prefix_ns' : _best(lambda: stash.keys_with_prefix("group:"),
+                                          repeat) * 1e9,
+            'get_prefix_ns' : _best(lambda: stash.get_prefix("group:"), repeat) * 1e9,
+            'set_ns' : _rate(keys, _best(
+                lambda: [stash.set("new{}".format(next(counter)), "value", 0)
+                         for _ in range(keys)], 1))['ns_per_op'],
+        }
+        results.append(("prefix_scan", {'keys' : keys, 'matches' : matches,
+                                        'indexed' : indexed}, metrics))
+    return results
+
+
+def sessions(stash_factory, ops=20000, sessions=1000, repeat=3):
+    """
+    Measure keeping sessions alive, by setting them again and by touching them.
+
+    Fills a stash with sessions, each a small dict expiring after 30 minutes,
+    and returns the time per operation of: reading a session and setting it
+    again; touching it; gat; and reading it with sliding expiration on.
+
+    """
+    gs = gemstash.Client(stash_factory())
+    keys = ["session:{}".format(i) for i in range(sessions)]
+    for key in keys:
+        gs.set(key, {'user' : key, 'cart' : [1, 2, 3]}, 1800)
+    picks = [keys[i % sessions] for i in range(ops)]
+
+    def resend():
+        for key in picks:
+            gs.set(key, gs.get(key), 1800)
+
+    def touch():
+        for key in picks:
+            gs.touch(key, 1800)
+
+    def gat():
+        for key in picks:
+            gs.gat(key, 1800)
+
+    def sliding_get():
+        for key in picks:
+            gs.get(key)
+
+    metrics = {}
+    for name, func in (('get_and_set', resend), ('touch', touch), ('gat', gat)):
+        metrics[name + '_ns'] = _rate(ops, _best(func, repeat))['ns_per_op']
+    for key in keys:
+        gs.touch(key, 1800, sliding=True)
+    metrics['sliding_get_ns'] = _rate(ops, _best(sliding_get, repeat))['ns_per_op']
+    return [("sessions", {'sessions' : sessions}, metrics)]
+
+
+def suite(ops=20000, shards=16, groups=GROUPS):
+    """
+    Run the benchmarks in groups, yielding a record for each measurement.
+
+    Records are dicts with the keys "benchmark", "stash", "params" and
+    "metrics".
+
+    """
+    def records(stash, results):
+        for name, params, metrics in results:
+            yield {'benchmark' : name, 'stash' : stash, 'params' : params,
+                   'metrics' : metrics}
+
+    for name, factory in STASHES:
+        if 'hot_paths' in groups:
+            yield from records(name, hot_paths(factory, ops))
+        if 'batches' in groups:
+            yield from records(name, batches(factory, ops))
+        if 'zipf_mix' in groups:
+            for read_fraction in (0.9, 0.5):
+                yield from records(name, zipf_mix(factory, read_fraction, ops))
+        if 'memory' in groups:
+            for time_to_live in (0, 300):
+                yield from records(name, entry_memory(factory, ops, time_to_live))
+        if 'invalidation' in groups:
+            yield from records(name, invalidation(factory))
+        if 'prefix_scan' in groups:
+            yield from records(name, prefix_scan(factory))
+        if 'sessions' in groups:
+            yield from records(name, sessions(factory, ops))
+
+    threaded = STASHES + (
+        ("ShardedStash", lambda: gemstash.ShardedStash(shards=shards)),
+    )
+    for name, factory in threaded:
+        if 'contention' not in groups:
+            break
+        for threads in THREAD_COUNTS:
+            rate = contention(factory(), threads, ops)
+            yield from records(name, [("contention", {'threads' : threads},
+                                       {'ops_per_sec' : rate})])
+
+    for name, factory in STASHES:
+        if 'server' not in groups:
+            break
+        for connections, pipeline, keys_per_get in SERVER_LOADS:
+            yield from records(name, server_throughput(factory, ops, connections,
+                                                       pipeline, keys_per_get))
+
+    for contended in (False, True):
+        if 'event_loop' not in groups:
+            break
+        for name, use_async in (("Client", False), ("AsyncClient", True)):
+            rate, stall = event_loop(use_async, ops, contended=contended)
+            yield from records("Stash", [("event_loop",
+                                          {'client' : name, 'contended' : contended},
+                                          {'ops_per_sec' : rate, 'max_stall_seconds' : stall})])
+
+    for name, stale_time, beta in (("hard expiry", 0, 0),
+                                   ("stale-while-revalidate", 1, 0),
+                                   ("early refresh", 0, 1)):
+        if 'expiry_boundary' not in groups:
+            break
+        p50, p99 = expiry_boundary(stale_time, beta)
+        yield from records("Stash", [("expiry_boundary", {'mode' : name},
+                                      {'p50_seconds' : p50, 'p99_seconds' : p99})])
+
+    if 'counter_overhead' in groups:
+        overhead = counter_overhead()
+        for case in ("hit", "miss"):
+            yield from records("Stash", [("counter_overhead", {'case' : case},
+                                          {'read_ns' : overhead[case],
+                                           'counter_ns' : overhead['counter']})])
+
+    if 'instrumentation_overhead' in groups:
+        yield from records("Stash", [("instrumentation_overhead", {},
+                                      {name + '_ns' : ns
+                                       for name, ns in instrumentation_overhead().items()})])
+
+
+def _format(value):
+    if isinstance(value, float):
+        return "{:,.6g}".format(value)
+    return str(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m gemstash.bench",
+                                     description="Benchmark gemstash.")
+    parser.add_argument("--ops", type=int, default=20000,
+                        help="operations per measurement")
+    parser.add_argument("--shards", type=int, default=16,
+                        help="number of shards for ShardedStash")
+    parser.add_argument("--only", metavar="GROUP", action="append", choices=GROUPS,
+                        help="run only the named group of benchmarks (may be "
+                             "repeated): " + ", ".join(GROUPS))
+    parser.add_argument("--json", metavar="FILE",
+                        help="write the results as JSON to FILE, or - for stdout")
+    args = parser.parse_args(argv)
+
+    results = []
+    out = sys.stderr if args.json == "-" else sys.stdout
+    print("{:<26} {:<14} {:<40} {}".format("benchmark", "stash", "params", "metrics"),
+          file=out)
+    for record in suite(args.ops, args.shards, args.only or GROUPS):
+        results.append(record)
+        print("{:<26} {:<14} {:<40} {}".format(
+            record['benchmark'], record['stash'],
+            " ".join("{}={}".format(k, v) for k, v in sorted(record['params'].items())),
+            " ".join("{}={}".format(k, _format(v))
+                     for k, v in sorted(record['metrics'].items()))),
+            file=out, flush=True)
+
+    if args.json:
+        document = {
+            'python' : platform.python_version(),
+            'implementation' : platform.python_implementation(),
+            'platform' : platform.platform(),
+            'ops' : args.ops,
+            'results' : results,
+        }
+        if args.json == "-":
+            json.dump(document, sys.stdout, indent=2, sort_keys=True)
+            print()
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(document, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,513 @@
+# Copyright 2015 Tracy Poff. See LICENSE for details.
+
+"""
+memcached text protocol server for gemstash.
+
+Usage, from the command line:
+
+    $ python -m gemstash.server --port 11211 --max-bytes 67108864
+
+or from asyncio code, to serve a stash which the process also uses itself:
+
+    >>> import gemstash
+    >>> import gemstash.server
+    >>> stash = gemstash.Stash()
+    >>> server = await gemstash.server.serve(stash, port=11211)
+
+The get, gets, gat, gats, set, add, replace, append, prepend, cas, incr, decr,
+delete, touch, flush_all, stats, version, verbosity and quit commands are
+supported.
+
+Values stored through the server are kept as gemstash.RawValues, holding the
+data and flags sent by the client. Values stored in the stash by other means
+are sent with the flags python-memcached would give them: bytes with flags 0,
+str as utf-8 with flags 16, int in decimal with flags 2, and anything else
+pickled, with flags 1.
+
+Requires Python 3.7 or later.
+
+"""
+
+import argparse
+import asyncio
+import pickle
+import sys
+
+import gemstash
+
+_FLAG_PICKLE = 1 << 0
+_FLAG_INTEGER = 1 << 1
+_FLAG_TEXT = 1 << 4
+
+MAX_LINE_LENGTH = 2048
+_MAX_UINT64 = 2**64 - 1
+
+_STORED = b"STORED\r\n"
+_NOT_STORED = b"NOT_STORED\r\n"
+_EXISTS = b"EXISTS\r\n"
+_NOT_FOUND = b"NOT_FOUND\r\n"
+_DELETED = b"DELETED\r\n"
+_TOUCHED = b"TOUCHED\r\n"
+_END = b"END\r\n"
+_OK = b"OK\r\n"
+_ERROR = b"ERROR\r\n"
+_BAD_FORMAT = b"CLIENT_ERROR bad command line format\r\n"
+_BAD_CHUNK = b"CLIENT_ERROR bad data chunk\r\n"
+_NON_NUMERIC = b"CLIENT_ERROR cannot increment or decrement non-numeric value\r\n"
+_INVALID_DELTA = b"CLIENT_ERROR invalid numeric delta argument\r\n"
+_TOO_LARGE = b"SERVER_ERROR object too large for cache\r\n"
+_NO_MEMORY = b"SERVER_ERROR out of memory storing object\r\n"
+
+
+class _Storage(object):
+    """A storage command waiting for its data block."""
+
+    __slots__ = ('command', 'key', 'flags', 'time', 'length', 'cas_id', 'noreply')
+
+    def __init__(self, command, key, flags, time, length, cas_id, noreply):
+        self.command = command
+        self.key = key
+        self.flags = flags
+        self.time = time
+        self.length = length
+        self.cas_id = cas_id
+        self.noreply = noreply
+
+
+class MemcacheProtocol(asyncio.Protocol):
+    """
+    A connection to a client speaking the memcached text protocol.
+
+    Commands are handled as soon as they have been received in full, so a
+    client may send many before reading any responses; the responses to all
+    the commands in one read are written together. Every key of a get is
+    looked up in a single call to the stash's get_multi.
+
+    If the client does not read its responses as fast as it sends commands,
+    reading from it is paused whenever the transport's write buffer is full,
+    until the buffer drains.
+
+    """
+
+    def __init__(self, stash, stats, max_value_length=gemstash.SERVER_MAX_VALUE_LENGTH):
+        """Create a protocol serving stash, counting connections in stats."""
+        self.stash = stash
+        self.stats = stats
+        self.max_value_length = max_value_length
+        self.transport = None
+        self._buffer = bytearray()
+        self._pending = None
+        self._commands = {
+            b"get" : self._get,
+            b"gets" : self._gets,
+            b"gat" : self._gat,
+            b"gats" : self._gats,
+            b"set" : self._storage,
+            b"add" : self._storage,
+            b"replace" : self._storage,
+            b"append" : self._storage,
+            b"prepend" : self._storage,
+            b"cas" : self._storage,
+            b"incr" : self._incr,
+            b"decr" : self._incr,
+            b"delete" : self._delete,
+            b"touch" : self._touch,
+            b"flush_all" : self._flush_all,
+            b"stats" : self._stats,
+            b"version" : self._version,
+            b"verbosity" : self._verbosity,
+        }
+        self._stores = {
+            b"set" : self._set,
+            b"add" : self._add,
+            b"replace" : self._replace,
+            b"append" : self._append,
+            b"prepend" : self._append,
+            b"cas" : self._cas,
+        }
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.stats['curr_connections'] += 1
+        self.stats['total_connections'] += 1
+
+    def connection_lost(self, exc):
+        self.stats['curr_connections'] -= 1
+
+    def pause_writing(self):
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def data_received(self, data):
+        self.stats['bytes_read'] += len(data)
+        buf = self._buffer
+        buf += data
+        responses = []
+        pos = 0
+        close = False
+        while True:
+            pending = self._pending
+            if pending is not None:
+                end = pos + pending.length
+                if len(buf) < end + 2:
+                    if pending.command is None:
+                        # discard a value too large to store as it arrives
+                        skipped = min(len(buf), end) - pos
+                        pending.length -= skipped
+                        pos += skipped
+                    break
+                if buf[end:end + 2] != b"\r\n":
+                    response = _BAD_CHUNK
+                elif pending.command is None:
+                    # the value was too large; its data is discarded
+                    response = _TOO_LARGE
+                else:
+                    view = memoryview(buf)
+                    block = view[pos:end].tobytes()
+                    view.release()
+                    response = self._stores[pending.command](pending, block)
+                    if pending.noreply:
+                        response = b""
+                self._pending = None
+                pos = end + 2
+                if response is _BAD_CHUNK:
+                    # skip the rest of the line, as memcached does
+                    end = buf.find(b"\n", end)
+                    pos = len(buf) if end < 0 else end + 1
+                responses.append(response)
+                continue
+            end = buf.find(b"\n", pos)
+            if end < 0:
+                if len(buf) - pos > MAX_LINE_LENGTH:
+                    responses.append(b"CLIENT_ERROR line too long\r\n")
+                    close = True
+                break
+            parts = bytes(buf[pos:end]).split()
+            pos = end + 1
+            if not parts:
+                responses.append(_ERROR)
+                continue
+            if parts[0] == b"quit":
+                close = True
+                break
+            command = self._commands.get(parts[0])
+            if command is None:
+                responses.append(_ERROR)
+                continue
+            try:
+                responses.append(command(parts))
+            except (ValueError, IndexError):
+                responses.append(_BAD_FORMAT)
+        del buf[:pos]
+        if responses:
+            out = b"".join(responses)
+            self.stats['bytes_written'] += len(out)
+            self.transport.write(out)
+        if close:
+            self.transport.close()
+
+    def _get(self, parts, cas=False, time=None):
+        keys = parts[1:] if time is None else parts[2:]
+        if not keys:
+            return _ERROR
+        names = [_key(key) for key in keys]
+        if time is None:
+            found = self.stash.get_multi(names)
+        else:
+            found = self.stash.get_multi_and_touch(names, time)
+        out = []
+        for key, name in zip(keys, names):
+            result = found.get(name)
+            if result is None:
+                continue
+            value, cas_id = result
+            flags, data = _encode(value)
+            if cas:
+                out.append(b"VALUE %s %d %d %d\r\n" % (key, flags, len(data), cas_id))
+            else:
+                out.append(b"VALUE %s %d %d\r\n" % (key, flags, len(data)))
+            out.append(data)
+            out.append(b"\r\n")
+        out.append(_END)
+        return b"".join(out)
+
+    def _gets(self, parts):
+        return self._get(parts, cas=True)
+
+    def _gat(self, parts, cas=False):
+        return self._get(parts, cas, int(parts[1]))
+
+    def _gats(self, parts):
+        return self._gat(parts, cas=True)
+
+    def _storage(self, parts):
+        """Read a storage command line; the data block follows it."""
+        command = parts[0]
+        if command == b"cas":
+            cas_id = int(parts[5])
+            noreply = parts[6:7] == [b"noreply"]
+        else:
+            cas_id = None
+            noreply = parts[5:6] == [b"noreply"]
+        key = _key(parts[1])
+        flags, time, length = int(parts[2]), int(parts[3]), int(parts[4])
+        if length < 0 or not 0 <= flags <= 0xffffffff:
+            raise ValueError("bad command line")
+        if length > self.max_value_length:
+            command = None
+        self._pending = _Storage(command, key, flags, time, length, cas_id, noreply)
+        return b""
+
+    def _set(self, pending, data):
+        if self.stash.set(pending.key, gemstash.RawValue(pending.flags, data), pending.time):
+            return _STORED
+        return _NO_MEMORY
+
+    def _add(self, pending, data):
+        def add(found):
+            if found is None:
+                return gemstash.RawValue(pending.flags, data), pending.time
+        return self._store(pending.key, add)
+
+    def _replace(self, pending, data):
+        value = gemstash.RawValue(pending.flags, data)
+        if self.stash.update(pending.key, value, pending.time):
+            return _STORED
+        return _NOT_STORED
+
+    def _append(self, pending, data):
+        # the existing flags and expiry time are kept, as by memcached
+        def append(found):
+            if found is not None:
+                value, cas_id, expires = found
+                flags, old = _encode(value)
+                if pending.command == b"append":
+                    new = old + data
+                else:
+                    new = data + old
+                return gemstash.RawValue(flags, new), expires
+        return self._store(pending.key, append)
+
+    def _cas(self, pending, data):
+        response = _STORED
+        def cas(found):
+            nonlocal response
+            if found is None:
+                self.stats['cas_misses'] += 1
+                response = _NOT_FOUND
+            elif found[1] != pending.cas_id:
+                self.stats['cas_badval'] += 1
+                response = _EXISTS
+            else:
+                self.stats['cas_hits'] += 1
+                return gemstash.RawValue(pending.flags, data), pending.time
+        stored = self.stash.modify(pending.key, cas)
+        if stored is None:
+            return response
+        return _STORED if stored else _NO_MEMORY
+
+    def _store(self, key, func):
+        """Store the value func makes from the one under key, if it makes one."""
+        stored = self.stash.modify(key, func)
+        if stored is None:
+            return _NOT_STORED
+        return _STORED if stored else _NO_MEMORY
+
+    def _incr(self, parts):
+        key = _key(parts[1])
+        if not parts[2].isdigit():
+            return _INVALID_DELTA
+        delta = int(parts[2])
+        if delta > _MAX_UINT64:
+            return _INVALID_DELTA
+        noreply = parts[3:4] == [b"noreply"]
+        name = "incr" if parts[0] == b"incr" else "decr"
+        response = _NOT_FOUND
+        def incr(found):
+            nonlocal response
+            if found is None:
+                self.stats[name + '_misses'] += 1
+                return None
+            value, cas_id, expires = found
+            if value.__class__ is gemstash.RawValue:
+                data = value.data
+                if not data.isdigit() or len(data) > 20 or int(data) > _MAX_UINT64:
+                    response = _NON_NUMERIC
+                    return None
+                if name == "incr":
+                    # 64 bit counters wrap around, but never go below 0
+                    number = (int(data) + delta) & _MAX_UINT64
+                else:
+                    number = max(int(data) - delta, 0)
+                value = gemstash.RawValue(value.flags, b"%d" % number)
+            else:
+                # stored by a Client, so keep the Python type
+                change = delta if name == "incr" else -delta
+                try:
+                    if isinstance(value, str):
+                        value = str(int(value) + change)
+                    elif isinstance(value, int):
+                        value = value + change
+                    else:
+                        raise ValueError("non-numeric value")
+                except ValueError:
+                    response = _NON_NUMERIC
+                    return None
+                number = int(value)
+            self.stats[name + '_hits'] += 1
+            response = b"%d\r\n" % number
+            return value, expires
+        self.stash.modify(key, incr)
+        if response is _NON_NUMERIC:
+            return response
+        return b"" if noreply else response
+
+    def _delete(self, parts):
+        key = _key(parts[1])
+        noreply = parts[-1] == b"noreply"
+        if self.stash.delete_multi([key]):
+            response = _NOT_FOUND
+        else:
+            response = _DELETED
+        return b"" if noreply else response
+
+    def _touch(self, parts):
+        key = _key(parts[1])
+        time = int(parts[2])
+        noreply = parts[3:4] == [b"noreply"]
+        response = _TOUCHED if self.stash.touch(key, time) else _NOT_FOUND
+        return b"" if noreply else response
+
+    def _flush_all(self, parts):
+        noreply = parts[-1] == b"noreply"
+        delay = int(parts[1]) if len(parts) > 1 and parts[1] != b"noreply" else 0
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.stash.flush)
+        else:
+            self.stash.flush()
+        return b"" if noreply else _OK
+
+    def _stats(self, parts):
+        group = parts[1].decode("ascii") if len(parts) > 1 else None
+        stats = self.stash.get_stats(group)
+        if group is None:
+            # the server counts the compound commands it makes itself
+            for name, value in self.stats.items():
+                stats[name] = stats.get(name, 0) + value
+        out = [b"STAT %s %s\r\n" % (str(name).encode("utf_8"), str(value).encode("utf_8"))
+               for name, value in stats.items()]
+        out.append(_END)
+        return b"".join(out)
+
+    def _version(self, parts):
+        return b"VERSION gemstash\r\n"
+
+    def _verbosity(self, parts):
+        return b"" if parts[-1] == b"noreply" else _OK
+
+
+def _key(key):
+    if len(key) > gemstash.SERVER_MAX_KEY_LENGTH:
+        raise ValueError("key too long")
+    return key.decode("utf_8", "surrogateescape")
+
+
+def _encode(value):
+    """Return the flags and data with which a stored value is sent."""
+    kind = value.__class__
+    if kind is gemstash.RawValue:
+        return value.flags, value.data
+    if kind is bytes:
+        return 0, value
+    if kind is str:
+        return _FLAG_TEXT, value.encode("utf_8")
+    if kind is int:
+        return _FLAG_INTEGER, b"%d" % value
+    if kind in gemstash._ENCODED:
+        return _encode(gemstash.Client._decode(value))
+    return _FLAG_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+async def serve(stash, host='127.0.0.1', port=11211,
+                max_value_length=gemstash.SERVER_MAX_VALUE_LENGTH, **kwargs):
+    """
+    Serve stash over the memcached text protocol.
+
+    stash is a Stash, MimicStash or SharedMemoryStash, or a ShardedStash or
+    RingStash of them.
+    Values longer than max_value_length bytes are refused. Other arguments are
+    passed to loop.create_server. Returns the asyncio Server.
+
+    """
+    if not isinstance(stash, (gemstash.BaseStash, gemstash.ShardedStash,
+                              gemstash.SharedMemoryStash)):
+        raise TypeError("cannot serve a {}".format(type(stash).__name__))
+    stats = {
+        'curr_connections' : 0,
+        'total_connections' : 0,
+        'bytes_read' : 0,
+        'bytes_written' : 0,
+        'cas_hits' : 0,
+        'cas_badval' : 0,
+        'cas_misses' : 0,
+        'incr_hits' : 0,
+        'incr_misses' : 0,
+        'decr_hits' : 0,
+        'decr_misses' : 0,
+    }
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(
+        lambda: MemcacheProtocol(stash, stats, max_value_length), host, port, **kwargs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m gemstash.server",
+        description="Serve a gemstash stash over the memcached text protocol.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=11211, help="port to listen on")
+    parser.add_argument("--mimic", action="store_true",
+                        help="store values as memcached does, in a MimicStash")
+    parser.add_argument("--max-items", type=int, default=0,
+                        help="most items to keep (default: unbounded)")
+    parser.add_argument("--max-bytes", type=int, default=0,
+                        help="most bytes to keep (default: unbounded)")
+    parser.add_argument("--max-value-length", type=int,
+                        default=gemstash.SERVER_MAX_VALUE_LENGTH,
+                        help="longest value to accept, in bytes")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="split the stash into this many shards")
+    parser.add_argument("--reaper-interval", type=float, default=1.0,
+                        help="seconds between removals of expired items (0 to disable)")
+    args = parser.parse_args(argv)
+    kind = gemstash.MimicStash if args.mimic else gemstash.Stash
+    kwargs = {
+        'max_items' : args.max_items,
+        'max_bytes' : args.max_bytes,
+        'max_value_length' : args.max_value_length,
+    }
+    if args.shards:
+        stash = gemstash.ShardedStash(args.shards, kind, **kwargs)
+    else:
+        stash = kind(**kwargs)
+    if args.reaper_interval:
+        stash.start_reaper(args.reaper_interval)
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(
+        serve(stash, args.host, args.port, args.max_value_length))
+    print("gemstash serving on {}:{}".format(args.host, args.port), file=sys.stderr)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+        stash.stop_reaper()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,22 @@
 # Copyright 2015 Tracy Poff. See LICENSE for details.
 
+import asyncio
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 
 import gemstash
+import gemstash.aio
+import gemstash.server
 import memcache
 
 # TODO: test reset_cas, gets
@@ -812,3 +826,2010 @@ class Test_gemstash_mimicry(unittest.TestCase):
         # TODO: Don't comment out failing tests. Seriously.
         #
         # self.assertEqual(self.gs.cas("new_key", "val4"), self.mc.cas("new_key", "val4"))
+
+class Test_gemstash_eviction(unittest.TestCase):
+
+    def test_max_items(self):
+        for stash in (gemstash.Stash(max_items=3), gemstash.MimicStash(max_items=3)):
+            gs = gemstash.Client(stash)
+            gs.set_multi({"a" : "1", "b" : "2", "c" : "3"})
+            gs.get("a")
+            gs.set("d", "4")
+
+            self.assertEqual(len(stash), 3,
+                "stash grew beyond max_items")
+            self.assertIsNone(gs.get("b"),
+                "least recently used item was not evicted")
+            self.assertEqual(gs.get("a"), "1",
+                "recently read item was evicted")
+            self.assertEqual(stash.evictions, 1,
+                "eviction was not counted")
+
+    def test_max_bytes(self):
+        stash = gemstash.MimicStash(max_bytes=20)
+        gs = gemstash.Client(stash)
+        gs.set("a", "x" * 9)
+        gs.set("b", "y" * 9)
+        self.assertEqual(stash.bytes, 20)
+        gs.set("c", "z" * 4)
+
+        self.assertIsNone(gs.get("a"),
+            "least recently used item was not evicted")
+        self.assertEqual(gs.get("b"), "y" * 9)
+        self.assertEqual(stash.bytes, 15)
+        self.assertFalse(gs.set("huge", "x" * 100),
+            "item larger than max_bytes should not be stored")
+        self.assertEqual(gs.set_multi({"huge" : "x" * 100}), ["huge"])
+
+    def test_bytes_unbounded(self):
+        for track_bytes in (False, True):
+            stash = gemstash.MimicStash(track_bytes=track_bytes)
+            gs = gemstash.Client(stash)
+            gs.set_multi({"a" : "x" * 9, "b" : "y" * 9, "c" : "z" * 4})
+            self.assertEqual(stash.bytes, 25)
+            gs.set("a", "x")
+            gs.delete("b")
+            gs.set("d", "w", 1)
+            stash.cache["d"].expires = time.time() - 1
+            self.assertIsNone(gs.get("d"))
+            self.assertEqual(stash.bytes, 7)
+            self.assertEqual(stash.get_stats()['bytes'], 7)
+            self.assertEqual(len(stash._sizes), 2 if track_bytes else 0)
+            stash.flush()
+            self.assertEqual(stash.bytes, 0)
+
+    def test_sizeof(self):
+        stash = gemstash.Stash(max_bytes=10, sizeof=lambda key, value: value)
+        gs = gemstash.Client(stash)
+        gs.set("a", 4)
+        gs.set("b", 4)
+        gs.set("a", 6)
+
+        self.assertEqual(stash.bytes, 10)
+        self.assertEqual(stash.evictions, 0,
+            "replacing an item should not evict others")
+        gs.set("c", 1)
+        self.assertIsNone(gs.get("b"))
+        self.assertEqual(stash.evictions, 1)
+
+    def test_unbounded(self):
+        stash = gemstash.Stash()
+        gs = gemstash.Client(stash)
+        gs.set_multi({str(i) : i for i in range(1000)})
+        self.assertEqual(len(stash), 1000)
+        self.assertEqual(stash.evictions, 0)
+
+class Test_gemstash_cleanup(unittest.TestCase):
+
+    # absolute timestamps in the past, far enough back to be safe in any zone
+    PAST = int(time.time()) - 60*60*48
+
+    def test_cleanup(self):
+        for stash in (gemstash.Stash(), gemstash.MimicStash()):
+            gs = gemstash.Client(stash)
+            gs.set_multi({str(i) : i for i in range(100)})
+            gs.set_multi({"old1" : "a", "old2" : "b", "old3" : "c"}, time=self.PAST)
+            gs.set("later", "d", time=300)
+
+            self.assertEqual(sorted(stash.cleanup()), ["old1", "old2", "old3"],
+                "cleanup removed the wrong keys")
+            self.assertEqual(len(stash), 101)
+            self.assertEqual(stash.cleanup(), [],
+                "second cleanup should find nothing to remove")
+
+    def test_cleanup_replaced(self):
+        stash = gemstash.Stash()
+        gs = gemstash.Client(stash)
+        gs.set("replaced", "a", time=self.PAST)
+        gs.set("replaced", "b")
+        gs.set("deleted", "a", time=self.PAST)
+        gs.delete("deleted")
+        gs.set("reexpired", "a", time=self.PAST)
+        gs.set("reexpired", "b", time=self.PAST)
+
+        self.assertEqual(stash.cleanup(), ["reexpired"])
+        self.assertEqual(gs.get("replaced"), "b",
+            "cleanup removed a key which was replaced without expiry")
+
+    def test_expiry_heap_bounded(self):
+        stash = gemstash.Stash()
+        gs = gemstash.Client(stash)
+        for i in range(10000):
+            gs.set("key", i, time=300)
+        self.assertLess(len(stash._expiry), 200,
+            "expiry heap keeps growing for a repeatedly replaced key")
+
+    def test_reaper(self):
+        for stash in (gemstash.Stash(), gemstash.MimicStash()):
+            gs = gemstash.Client(stash)
+            gs.set("keep", "a")
+            gs.set_multi({str(i) : i for i in range(1000)}, time=self.PAST)
+            stash.start_reaper(interval=0.01, budget_ms=0.1)
+            try:
+                with self.assertRaises(RuntimeError):
+                    stash.start_reaper()
+                for _ in range(500):
+                    if len(stash) == 1:
+                        break
+                    time.sleep(0.01)
+            finally:
+                stash.stop_reaper()
+
+            self.assertEqual(list(stash), ["keep"],
+                "reaper failed to remove expired items")
+            self.assertEqual(stash.reaper_stats['reclaimed'], 1000)
+            self.assertGreaterEqual(stash.reaper_stats['slices'], 1)
+            stash.stop_reaper()
+
+class Test_gemstash_sharded(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.gs = gemstash.Client(gemstash.ShardedStash(shards=4), cache_cas=True)
+
+    def setUp(self):
+        self.gs.flush_all()
+
+    def test_operations(self):
+        self.gs.set_multi({str(i) : i for i in range(100)})
+        self.assertEqual(len(self.gs.stash), 100)
+        self.assertEqual(sorted(self.gs.stash, key=int), [str(i) for i in range(100)])
+        self.assertEqual(self.gs.incr("7", 3), 10)
+        self.assertTrue(self.gs.append("8", "1"))
+        self.assertTrue(self.gs.prepend("9", "1"))
+        self.assertEqual(self.gs.get_multi(["7", "8", "9"]), {"7" : 10, "8" : 81, "9" : 19})
+        self.gs.delete("7")
+        self.assertIsNone(self.gs.get("7"))
+        self.assertFalse(self.gs.replace("7", 1))
+        self.gs.flush_all()
+        self.assertEqual(len(self.gs.stash), 0)
+
+    def test_cas(self):
+        self.gs.set("key", "val")
+        self.gs.get("key")
+        evil_client = gemstash.Client(self.gs.stash)
+        evil_client.set("key", "evil_val")
+        self.assertEqual(self.gs.cas("key", "val2"), 0,
+            "cas on a key modified by another client should fail")
+
+    def test_incr_threads(self):
+        self.gs.set("counter", 1)
+
+        def work():
+            for _ in range(1000):
+                self.gs.incr("counter")
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.gs.get("counter"), 8001,
+            "concurrent increments were lost")
+
+    def test_bounds(self):
+        stash = gemstash.ShardedStash(shards=4, max_items=8, stash=gemstash.MimicStash)
+        gs = gemstash.Client(stash)
+        gs.set_multi({str(i) : i for i in range(100)})
+        self.assertLessEqual(len(stash), 8)
+        self.assertEqual(stash.evictions, 100 - len(stash))
+
+
+def _shared_memory_worker(stash, n):
+    gs = gemstash.Client(stash)
+    for _ in range(n):
+        gs.incr("counter")
+    gs.set("worker", {"done" : True})
+    stash.close()
+
+
+@unittest.skipIf(gemstash.shared_memory is None, "requires python 3.8")
+class Test_gemstash_shared_memory(unittest.TestCase):
+
+    def setUp(self):
+        self.stash = gemstash.SharedMemoryStash(slots=64, data_size=4096)
+        self.gs = gemstash.Client(self.stash, cache_cas=True)
+
+    def tearDown(self):
+        self.stash.close()
+        self.stash.unlink()
+
+    def test_operations(self):
+        self.gs.set_multi({"str" : "foo", "int" : 1, "float" : 1.5,
+                           "dict" : {"foo" : "bar"}})
+        self.assertEqual(self.gs.get_multi(["str", "int", "float", "dict"]),
+            {"str" : "foo", "int" : 1, "float" : 1.5, "dict" : {"foo" : "bar"}})
+        self.assertEqual(len(self.stash), 4)
+        self.assertEqual(sorted(self.stash), ["dict", "float", "int", "str"])
+        self.assertEqual(self.gs.incr("int", 4), 5)
+        self.assertTrue(self.gs.append("str", "bar"))
+        self.assertTrue(self.gs.prepend("int", "1"))
+        self.assertEqual(self.gs.get("str"), "foobar")
+        self.assertEqual(self.gs.get("int"), 15)
+        with self.assertRaises(ValueError):
+            self.gs.append("float", "cows")
+        self.assertFalse(self.gs.add("str", "baz"))
+        self.assertFalse(self.gs.replace("missing", "baz"))
+        self.gs.delete("str")
+        self.assertIsNone(self.gs.get("str"))
+        self.gs.flush_all()
+        self.assertEqual(len(self.stash), 0)
+        self.assertIsNone(self.gs.get("int"))
+
+    def test_cas(self):
+        self.gs.set("key", "val")
+        self.gs.get("key")
+        evil_client = gemstash.Client(self.stash)
+        evil_client.set("key", "evil_val")
+        self.assertEqual(self.gs.cas("key", "val2"), 0,
+            "cas on a key modified by another client should fail")
+
+    def test_expiry(self):
+        past = int(time.time()) - 60
+        self.gs.set("old", "a", time=past)
+        self.gs.set("new", "b")
+        self.assertEqual(self.stash.cleanup(), ["old"])
+        self.gs.set("old", "a", time=past)
+        self.assertIsNone(self.gs.get("old"))
+        self.assertEqual(list(self.stash), ["new"])
+
+    def test_compaction(self):
+        for i in range(1000):
+            self.assertTrue(self.gs.set("key{}".format(i % 10), "x" * 100),
+                "set failed although deleted data could be compacted")
+        self.assertEqual(len(self.stash), 10)
+        self.assertFalse(self.gs.set("huge", "x" * 5000),
+            "value larger than the data region should not be stored")
+        for i in range(100):
+            self.assertTrue(self.gs.set(str(i), i),
+                "a full table should evict to make room for new keys")
+        self.assertLess(len(self.stash), 64)
+        self.assertEqual(self.gs.get("99"), 99)
+
+    def test_full(self):
+        for i in range(100):
+            self.assertTrue(self.gs.set("key{}".format(i), "x" * 100),
+                "a full data region should evict to make room")
+        self.assertLess(len(self.stash), 40)
+        self.assertEqual(self.gs.get("key99"), "x" * 100)
+        live = sorted(self.stash)
+        used = self.stash._header()[3]
+        for key in live:
+            self.assertTrue(self.gs.set(key, "y" * 100),
+                "overwriting a key in a full region should succeed")
+        self.assertEqual(sorted(self.stash), live, "overwriting should not evict")
+        self.assertEqual(self.stash._header()[3], used,
+            "a value no longer than the old one should be written over it")
+        self.assertEqual(self.gs.get(live[0]), "y" * 100)
+        for i in range(10):
+            self.gs.set("new{}".format(i), "z" * 100)
+        self.assertLess(len(set(live) & set(self.stash)), len(live))
+        self.assertEqual(self.gs.get(live[0]), "y" * 100,
+            "a recently read key should survive eviction")
+
+    def test_processes(self):
+        self.gs.set("counter", 1)
+        workers = [multiprocessing.Process(target=_shared_memory_worker,
+                                           args=(self.stash, 100))
+                   for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(self.gs.get("counter"), 401,
+            "increments from other processes were lost")
+        self.assertEqual(self.gs.get("worker"), {"done" : True})
+
+    def test_namespaces(self):
+        other = gemstash.SharedMemoryStash(self.stash.name, create=False,
+                                           lock=self.stash.write_lock)
+        prefix = self.gs.namespace_prefix("tenant")
+        self.gs.set_multi({"a" : 1, "b" : 2}, key_prefix=prefix)
+        self.gs.set("plain", 3)
+        self.assertEqual(other.namespace_prefix("tenant"), prefix)
+        self.assertEqual(other.invalidate_namespace("tenant"), 1)
+        prefix = self.gs.namespace_prefix("tenant")
+        self.assertEqual(prefix, "tenant\x1f1\x1f")
+        self.assertEqual(self.gs.get_multi(["a", "b"], key_prefix=prefix), {})
+        self.gs.set(prefix + "a", 4)
+        self.assertEqual(sorted(self.stash.cleanup()), ["tenant\x1f0\x1fa", "tenant\x1f0\x1fb"])
+        self.assertEqual(self.gs.get(prefix + "a"), 4)
+        self.assertEqual(self.gs.get("plain"), 3)
+        other.close()
+
+    def test_prefix(self):
+        self.gs.set_multi({"user:1" : "a", "user:2" : "b", "group:1" : "c"})
+        self.assertEqual(self.gs.keys_with_prefix("user:"), ["user:1", "user:2"])
+        self.assertEqual(self.gs.get_prefix("user:"), {"1" : "a", "2" : "b"})
+        self.assertEqual(self.gs.delete_prefix("user:"), 2)
+        self.assertEqual(sorted(self.stash), ["group:1"])
+
+    def test_generations_kept_apart(self):
+        old = self.gs.namespace_prefix("tenant")
+        self.gs.set(old + "a", 1)
+        self.assertEqual(self.gs.invalidate_namespace("tenant"), 1)
+        self.assertEqual(sorted(self.stash), [old + "a"])
+        self.assertEqual(len(self.stash), 1)
+        self.assertEqual(self.gs.keys_with_prefix(""), [old + "a"])
+        self.assertEqual(self.gs.delete_prefix(""), 1)
+        self.gs.set(old + "a", 2)
+        self.assertIsNone(self.gs.get(self.gs.namespace_prefix("tenant") + "a"),
+                          "deleting every key should not reset the generation")
+        self.stash.flush()
+        self.assertEqual(self.gs.namespace_prefix("tenant"), "tenant\x1f1\x1f")
+        # a key spelled like a generation record is an ordinary key
+        self.gs.set("tenant", "value")
+        self.assertEqual(self.gs.get("tenant"), "value")
+        self.assertEqual(self.stash.namespace_prefix("tenant"), "tenant\x1f1\x1f")
+        self.gs.delete("tenant")
+        self.assertEqual(self.stash.invalidate_namespace("tenant"), 2)
+        self.assertEqual(len(self.stash), 0)
+
+    def test_touch(self):
+        self.gs.set("a", "x", 10)
+        cas_id = self.stash["a"][1]
+        self.assertTrue(self.gs.touch("a", 100))
+        self.assertFalse(self.gs.touch("b", 100))
+        self.assertEqual(self.stash["a"][1], cas_id)
+        self.assertGreater(self.stash.lookup("a")[2], 50)
+        self.assertEqual(self.gs.get_multi_and_touch(["a", "b"], -1), {"a" : "x"})
+        self.assertIsNone(self.gs.gat("a", 100))
+
+    def test_sliding(self):
+        stash = self.stash
+
+        def expire_soon(key):
+            kb = key.encode("utf_8")
+            index = stash._find(kb, zlib.crc32(kb))[0]
+            slot = stash._slot(index)
+            stash._SLOT.pack_into(stash.shm.buf, stash._table + index * stash._SLOT.size,
+                                  *slot[:6] + (time.time() + 1,) + slot[7:])
+
+        self.gs.set_multi({"a" : "x", "b" : "y"}, time=10)
+        self.assertTrue(self.gs.touch("a", 1000, sliding=True))
+        expire_soon("a")
+        self.assertEqual(self.gs.get("a"), "x")
+        self.assertGreater(stash.lookup("a")[2], 500, "a read should push the expiry out")
+        expire_soon("a")
+        self.assertEqual(self.gs.get_multi(["a", "b"]), {"a" : "x", "b" : "y"})
+        self.assertGreater(stash.lookup("a")[2], 500)
+        self.assertLess(stash.lookup("b")[2], 11)
+        self.gs.set("a", "z", 10)
+        self.assertLess(stash.lookup("a")[2], 11, "setting a key should stop it sliding")
+        self.assertEqual(self.gs.gat("a", 1000, sliding=True), "z")
+        self.gs.touch("a", 10)
+        expire_soon("a")
+        self.gs.get("a")
+        self.assertLess(stash.lookup("a")[2], 2, "touching a key should stop it sliding")
+        with self.assertRaises(ValueError):
+            self.gs.touch("a", 0, sliding=True)
+
+
+class Test_gemstash_journal(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = self.tempdir.name
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def reopen(self, stash, stash_class=gemstash.Stash, **kwargs):
+        journal = stash.journal
+        journal.close()
+        return stash_class(journal=gemstash.Journal(journal.path, **kwargs))
+
+    def test_restore(self):
+        for stash_class in (gemstash.Stash, gemstash.MimicStash):
+            path = os.path.join(self.path, stash_class.__name__)
+            stash = stash_class(journal=gemstash.Journal(path, fsync='always'))
+            gs = gemstash.Client(stash)
+            gs.set_multi({"str" : "foo", "int" : 1, "float" : 1.5, "gone" : "x"})
+            gs.set("old", "x", time=int(time.time()) - 60*60*48)
+            gs.set("later", "y", time=300)
+            gs.incr("int", 4)
+            gs.append("str", "bar")
+            gs.delete("gone")
+
+            gs = gemstash.Client(self.reopen(stash, stash_class))
+            self.assertEqual(gs.get_multi(["str", "int", "float", "gone", "old", "later"]),
+                {"str" : "foobar", "int" : 5, "float" : 1.5, "later" : "y"},
+                "stash was not restored from the journal")
+            self.assertEqual(len(gs.stash), 4)
+
+            gs.flush_all()
+            gs = gemstash.Client(self.reopen(gs.stash, stash_class))
+            self.assertEqual(len(gs.stash), 0,
+                "flush was not restored from the journal")
+            gs.stash.journal.close()
+
+    def test_cas_ids(self):
+        stash = gemstash.Stash(journal=gemstash.Journal(self.path, fsync='always'))
+        gs = gemstash.Client(stash, cache_cas=True)
+        gs.set("foo", "bar")
+        gs.set("foo", "baz")
+        gs.gets("foo")
+        stash = self.reopen(stash)
+        gs.stash = stash
+        stash.set("other", "value", 0)
+        self.assertGreater(stash["other"][1], stash["foo"][1],
+            "cas id was reissued after restoring from the journal")
+        self.assertTrue(gs.cas("foo", "qux"),
+            "cas id was not preserved by the journal")
+        stash.journal.close()
+
+    def test_mimic_codecs(self):
+        stash = gemstash.MimicStash(journal=gemstash.Journal(self.path, fsync='always'))
+        gs = gemstash.Client(stash)
+        gs.set_multi({"str" : "foo", "int" : 1, "float" : 1.5})
+        self.assertEqual(gs.get("int"), 1)
+        stash = self.reopen(stash, gemstash.MimicStash)
+        self.assertEqual(stash.get_multi(["str", "int", "float"]),
+                         {"str" : ("foo", 1), "int" : (1, 2), "float" : (1.5, 3)})
+        # records written when items held their parse function
+        stash._restore(('set', 'old', (b"42", None, gemstash._parse_int, 7)))
+        self.assertEqual(stash["old"], (42, 7))
+        stash.journal.close()
+
+    def test_snapshot(self):
+        journal = gemstash.Journal(self.path, fsync='no')
+        gs = gemstash.Client(gemstash.Stash(journal=journal))
+        gs.set_multi({str(i) : i for i in range(100)})
+        journal.snapshot()
+        gs.set("after", "snapshot")
+        gs.delete("5")
+        journal.snapshot()
+        gs.set("last", "change")
+
+        self.assertEqual(sorted(os.listdir(self.path)), ["log.3", "snapshot"],
+            "logs included in a snapshot were not removed")
+        gs = gemstash.Client(self.reopen(gs.stash))
+        self.assertEqual(len(gs.stash), 101)
+        self.assertEqual(gs.get("after"), "snapshot")
+        self.assertEqual(gs.get("last"), "change")
+        self.assertIsNone(gs.get("5"))
+        gs.stash.journal.close()
+
+    def test_truncated_log(self):
+        stash = gemstash.Stash(journal=gemstash.Journal(self.path))
+        gs = gemstash.Client(stash)
+        gs.set("foo", "bar")
+        gs.set("spam", "eggs")
+        stash.journal.close()
+        log = os.path.join(self.path, "log.1")
+        with open(log, "r+b") as f:
+            f.truncate(os.path.getsize(log) - 3)
+
+        gs = gemstash.Client(gemstash.Stash(journal=gemstash.Journal(self.path)))
+        self.assertEqual(gs.get("foo"), "bar")
+        self.assertIsNone(gs.get("spam"))
+        gs.set("spam", "again")
+        gs = gemstash.Client(self.reopen(gs.stash))
+        self.assertEqual(gs.get("spam"), "again",
+            "changes after a truncated log were lost")
+        gs.stash.journal.close()
+
+    def test_tiered(self):
+        path = os.path.join(self.path, "segment")
+        stash = gemstash.TieredStash(path, max_items=2,
+                                     journal=gemstash.Journal(self.path, fsync='always'))
+        stash.set_multi({"k{}".format(i) : {"i" : i} for i in range(5)}, 0)
+        stash.set("gone", "x", -1)
+        self.assertGreaterEqual(len(stash.index), 3)
+        for snapshot in (False, True):
+            if snapshot:
+                stash.journal.snapshot()
+            journal = stash.journal
+            journal.close()
+            stash.close()
+            stash = gemstash.TieredStash(path, max_items=2,
+                                         journal=gemstash.Journal(journal.path))
+            self.assertEqual(sorted(stash), ["k{}".format(i) for i in range(5)],
+                "items on disk were lost")
+            self.assertEqual(stash["k0"][0], {"i" : 0})
+        stash.journal.close()
+        stash.close()
+
+    def test_tiered_too_large(self):
+        path = os.path.join(self.path, "segment")
+        stash = gemstash.TieredStash(path, max_bytes=200,
+                                     journal=gemstash.Journal(self.path, fsync='always'))
+        stash.set("k", "small", 0)
+        stash.set("k", "x" * 1000, 0)
+        journal = stash.journal
+        journal.close()
+        stash.close()
+        stash = gemstash.TieredStash(path, max_bytes=200,
+                                     journal=gemstash.Journal(journal.path))
+        self.assertEqual(stash["k"][0], "x" * 1000,
+            "a value too large for memory was not restored from the journal")
+        stash.journal.close()
+        stash.close()
+
+    def test_namespaces(self):
+        stash = gemstash.Stash(journal=gemstash.Journal(self.path, fsync='always'))
+        gs = gemstash.Client(stash)
+        gs.set(gs.namespace_prefix("tenant") + "a", 1)
+        gs.invalidate_namespace("tenant")
+        gs.set(gs.namespace_prefix("tenant") + "b", 2)
+        stash = self.reopen(stash)
+        gs = gemstash.Client(stash)
+        prefix = gs.namespace_prefix("tenant")
+        self.assertEqual(stash.namespaces.generations, {"tenant" : 1})
+        self.assertEqual(gs.get_multi(["a", "b"], key_prefix=prefix), {"b" : 2})
+        stash.journal.snapshot()
+        stash = self.reopen(stash)
+        self.assertEqual(list(stash), [prefix + "b"],
+                         "keys of invalidated generations should not be snapshotted")
+        self.assertEqual(stash.namespace_prefix("tenant"), prefix)
+        stash.journal.close()
+
+    def test_prefix_index(self):
+        stash = gemstash.Stash(journal=gemstash.Journal(self.path, fsync='always'),
+                               prefix_index=True)
+        stash.set_multi({"a:1" : 1, "a:2" : 2, "b:1" : 3}, 0)
+        stash.delete_multi(["a:1"])
+        stash.journal.close()
+        stash = gemstash.Stash(journal=gemstash.Journal(self.path), prefix_index=True)
+        self.assertEqual(stash.keys_with_prefix("a:"), ["a:2"])
+        self.assertEqual(list(stash.prefix_index), ["a:2", "b:1"])
+        stash.journal.close()
+
+
+class Test_gemstash_tiered(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.stash = gemstash.TieredStash(os.path.join(self.tempdir.name, "segment"),
+                                          max_items=10)
+        self.gs = gemstash.Client(self.stash, cache_cas=True)
+
+    def tearDown(self):
+        self.stash.close()
+        self.tempdir.cleanup()
+
+    def test_demote_and_promote(self):
+        self.gs.set_multi({str(i) : {"value" : i} for i in range(100)})
+        self.assertEqual(len(self.stash.cache), 10)
+        self.assertEqual(len(self.stash.index), 90)
+        self.assertEqual(len(self.stash), 100)
+        self.assertEqual(self.stash.evictions, 0,
+            "items moved to disk should not count as evicted")
+
+        self.assertEqual(self.gs.get("0"), {"value" : 0},
+            "item on disk was not found")
+        self.assertIn("0", self.stash.cache,
+            "item read from disk was not moved back into memory")
+        self.assertNotIn("0", self.stash.index)
+        self.assertEqual(self.gs.get("99"), {"value" : 99})
+        self.assertIsNone(self.gs.get("missing"))
+
+        stats = self.stash.tier_stats
+        self.assertEqual((stats['memory_hits'], stats['disk_hits'], stats['misses']),
+            (1, 1, 1))
+        self.assertGreater(stats['disk_read_seconds'], 0)
+
+    def test_tier_stats(self):
+        self.gs.set_multi({str(i) : i for i in range(1, 21)})
+        # operations other than reads do not count as hits or misses
+        self.assertEqual(self.gs.incr("1", 1), 2)
+        self.assertTrue(self.gs.touch("20", 100))
+        self.assertFalse(self.gs.replace("missing", 0))
+        stats = self.stash.tier_stats
+        self.assertEqual((stats['memory_hits'], stats['disk_hits'], stats['misses']),
+                         (0, 0, 0))
+        self.assertEqual(stats['disk_reads'], 1)
+        self.assertEqual(self.gs.get_multi(["2", "20", "missing"]), {"2" : 2, "20" : 20})
+        self.assertEqual(self.gs.gat("3", 100), 3)
+        stats = self.stash.tier_stats
+        self.assertEqual((stats['memory_hits'], stats['disk_hits'], stats['misses']),
+                         (1, 2, 1))
+        self.assertEqual(stats['disk_reads'], 3)
+
+    def test_operations(self):
+        self.gs.set_multi({str(i) : i for i in range(1, 100)})
+        self.assertEqual(self.gs.incr("1", 4), 5)
+        self.assertTrue(self.gs.append("2", "2"))
+        self.assertTrue(self.gs.replace("3", "three"))
+        self.assertFalse(self.gs.add("4", "four"))
+        self.assertEqual(self.gs.get_multi(["1", "2", "3", "4"]),
+            {"1" : 5, "2" : 22, "3" : "three", "4" : 4})
+        self.gs.delete("5")
+        self.assertIsNone(self.gs.get("5"))
+        self.assertEqual(len(self.stash), 98)
+
+        self.gs.get("6")
+        self.gs.set_multi({str(i) : i for i in range(100, 120)})
+        evil_client = gemstash.Client(self.stash)
+        evil_client.set("6", "evil")
+        self.gs.set_multi({str(i) : i for i in range(120, 140)})
+        self.assertEqual(self.gs.cas("6", "good"), 0,
+            "cas on a key modified by another client should fail")
+
+        self.gs.flush_all()
+        self.assertEqual(len(self.stash), 0)
+        self.gs.set("7", 7)
+        self.assertEqual(self.gs.get("7"), 7)
+
+    def test_disk_bounds(self):
+        stash = gemstash.TieredStash(os.path.join(self.tempdir.name, "small"),
+                                     max_bytes=2000, disk_max_bytes=20000)
+        gs = gemstash.Client(stash)
+        gs.set("huge", "x" * 5000)
+        self.assertIn("huge", stash.index,
+            "item too large for memory was not written to disk")
+        self.assertEqual(gs.get("huge"), "x" * 5000)
+        for i in range(100):
+            gs.set(str(i), "y" * 500)
+        self.assertLessEqual(stash.disk_bytes, 20000)
+        self.assertGreater(stash.evictions, 0)
+        self.assertEqual(gs.get("99"), "y" * 500)
+        stash.close()
+
+    def test_compaction(self):
+        self.stash._MIN_COMPACT_BYTES = 0
+        for i in range(1000):
+            self.gs.set(str(i % 20), "x" * 100)
+        self.assertLess(self.stash.tier_stats['disk_file_bytes'], 2 * 10 * 120,
+            "segment file was not compacted")
+        for i in range(20):
+            self.assertEqual(self.gs.get(str(i)), "x" * 100)
+
+    def test_namespaces(self):
+        prefix = self.gs.namespace_prefix("tenant")
+        self.gs.set_multi({str(i) : i for i in range(50)}, key_prefix=prefix)
+        self.gs.set_multi({str(i) : i for i in range(50)})
+        self.stash.invalidate_namespace("tenant")
+        self.assertEqual(len(self.stash.cleanup()), 50)
+        self.assertEqual(len(self.stash), 50)
+        self.assertEqual(self.gs.get("0"), 0)
+
+    def test_touch(self):
+        stash = gemstash.TieredStash(os.path.join(self.tempdir.name, "large"),
+                                     max_bytes=100)
+        stash.set("big", "x" * 1000, 10)
+        self.assertIn("big", stash.index)
+        self.assertTrue(stash.touch("big", 1000))
+        self.assertGreater(stash.lookup("big")[2], 500,
+            "touching an item kept on disk should change its expiry time there")
+        self.gs.set("0", 0, 10)
+        self.gs.touch("0", 100, sliding=True)
+        self.gs.set_multi({str(i) : i for i in range(1, 20)})
+        self.assertIn("0", self.stash.index)
+        self.stash.index["0"] = self.stash.index["0"][:2] + (time.time() + 5,) + \
+                                self.stash.index["0"][3:]
+        self.assertEqual(self.gs.get("0"), 0)
+        self.assertGreater(self.stash.lookup("0")[2], 50,
+            "a sliding item moved back into memory should keep sliding")
+        stash.close()
+
+    def test_prefix_index(self):
+        stash = gemstash.TieredStash(os.path.join(self.tempdir.name, "indexed"),
+                                     max_items=10, prefix_index=True)
+        stash.set_multi({"k{:02}".format(i) : i for i in range(50)}, 0)
+        self.assertEqual(len(stash.index), 40)
+        self.assertEqual(stash.keys_with_prefix("k1"), ["k{}".format(i) for i in range(10, 20)])
+        self.assertEqual(len(stash.delete_prefix("k")), 50)
+        self.assertEqual((len(stash), len(stash.prefix_index)), (0, 0))
+        stash.close()
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "requires python 3.7")
+class Test_gemstash_async(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.gs = gemstash.aio.AsyncClient(gemstash.Stash(), cache_cas=True)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def hold_lock(self):
+        """Hold the stash's write_lock in another thread until released."""
+        held, release = threading.Event(), threading.Event()
+        def hold():
+            with self.gs.stash.write_lock:
+                held.set()
+                release.wait()
+        threading.Thread(target=hold).start()
+        held.wait()
+        return release
+
+    def test_operations(self):
+        async def operations():
+            gs = self.gs
+            self.assertTrue(await gs.set("foo", "bar"))
+            self.assertEqual(await gs.get("foo"), "bar")
+            self.assertEqual(await gs.set_multi({"one" : 1, "two" : 2}, key_prefix="n"), [])
+            self.assertEqual(await gs.get_multi(["one", "two"], key_prefix="n"),
+                {"one" : 1, "two" : 2})
+            self.assertEqual(await gs.incr("none", 5), 6)
+            self.assertEqual(await gs.decr("none"), 5)
+            self.assertTrue(await gs.append("foo", "baz"))
+            self.assertTrue(await gs.prepend("foo", "<"))
+            self.assertEqual(await gs.get("foo"), "<barbaz")
+            self.assertFalse(await gs.add("foo", "x"))
+            self.assertFalse(await gs.replace("missing", "x"))
+            self.assertTrue(await gs.cas("foo", "cas"))
+            await gs.delete("foo")
+            self.assertIsNone(await gs.get("foo"))
+            await gs.delete_multi(["one"], key_prefix="n")
+            self.assertIsNone(await gs.get("none"))
+            await gs.flush_all()
+            self.assertIsNone(await gs.get("ntwo"))
+        self.run_async(operations())
+
+    def test_coalesce(self):
+        calls = []
+        get = self.gs.client.get
+        def counting_get(key):
+            calls.append(key)
+            return get(key)
+        self.gs.client.get = counting_get
+
+        async def concurrent_gets():
+            await self.gs.set("key", "val")
+            release = self.hold_lock()
+            # the lock is busy, so the gets must wait in the executor
+            pending = [asyncio.ensure_future(self.gs.get("key")) for _ in range(10)]
+            await asyncio.sleep(0.01)
+            release.set()
+            return await asyncio.gather(*pending)
+
+        self.assertEqual(self.run_async(concurrent_gets()), ["val"] * 10)
+        self.assertEqual(calls, ["key"],
+            "concurrent gets of one key were not coalesced")
+
+    def test_read_own_writes(self):
+        async def write_then_read():
+            release = self.hold_lock()
+            stale = asyncio.ensure_future(self.gs.get("key"))
+            await asyncio.sleep(0)
+            write = asyncio.ensure_future(self.gs.set("key", "new"))
+            await asyncio.sleep(0)
+            release.set()
+            await write
+            return await self.gs.get("key"), await stale
+
+        fresh, _ = self.run_async(write_then_read())
+        self.assertEqual(fresh, "new",
+            "get after a set returned the result of an earlier get")
+
+    def test_offload_slow(self):
+        class Executor(concurrent.futures.ThreadPoolExecutor):
+            calls = 0
+            def submit(self, *args, **kwargs):
+                Executor.calls += 1
+                return super().submit(*args, **kwargs)
+        executor = Executor(1)
+        gs = gemstash.aio.AsyncClient(gemstash.Stash(), executor=executor)
+        async def operations():
+            await gs.set("small", "x")
+            self.assertEqual(await gs.get("small"), "x")
+            self.assertEqual(Executor.calls, 0)
+            # compressing, and decompressing, run in the executor
+            await gs.set("large", "x" * 1000, min_compress_len=100)
+            self.assertEqual(Executor.calls, 1)
+            self.assertEqual(await gs.get("large"), "x" * 1000)
+            self.assertEqual(Executor.calls, 2)
+        self.run_async(operations())
+        with tempfile.TemporaryDirectory() as tempdir:
+            stash = gemstash.TieredStash(os.path.join(tempdir, "segment"), max_items=1)
+            gs = gemstash.aio.AsyncClient(stash, executor=executor)
+            self.run_async(gs.set("a", "x"))
+            self.assertEqual(self.run_async(gs.get("a")), "x")
+            self.assertEqual(Executor.calls, 4, "a TieredStash was read on the event loop")
+            stash.close()
+        executor.shutdown()
+
+class Test_gemstash_get_or_set(unittest.TestCase):
+
+    def setUp(self):
+        self.gs = gemstash.Client(gemstash.Stash())
+        self.calls = []
+
+    def slow_factory(self, value, delay=0.05):
+        def factory(*args):
+            self.calls.append(args)
+            time.sleep(delay)
+            return value
+        return factory
+
+    def run_threads(self, target, n=8):
+        results = [None] * n
+        def work(i):
+            try:
+                results[i] = target()
+            except Exception as e:
+                results[i] = e
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_get_or_set(self):
+        factory = self.slow_factory("value")
+        results = self.run_threads(lambda: self.gs.get_or_set("key", factory, time=300))
+        self.assertEqual(results, ["value"] * 8)
+        self.assertEqual(len(self.calls), 1,
+            "factory was called more than once for one key")
+        self.assertEqual(self.gs.get("key"), "value")
+        self.assertEqual(self.gs.get_or_set("key", factory), "value")
+        self.assertEqual(len(self.calls), 1,
+            "factory was called for a key already in the stash")
+
+    def test_error(self):
+        def factory():
+            self.calls.append(())
+            time.sleep(0.05)
+            raise KeyError("broken")
+        results = self.run_threads(lambda: self.gs.get_or_set("key", factory))
+        self.assertEqual(len(self.calls), 1)
+        for result in results:
+            self.assertIsInstance(result, KeyError,
+                "factory's exception was not raised in a waiting caller")
+        self.assertIsNone(self.gs.get("key"))
+        self.assertEqual(self.gs.get_or_set("key", lambda: "fixed"), "fixed",
+            "a failed computation was not retried")
+
+    def test_timeout(self):
+        factory = self.slow_factory("value", delay=0.5)
+        leader = threading.Thread(target=self.gs.get_or_set, args=("key", factory))
+        leader.start()
+        time.sleep(0.05)
+        with self.assertRaises(concurrent.futures.TimeoutError):
+            self.gs.get_or_set("key", factory, timeout=0.01)
+        leader.join()
+        self.assertEqual(len(self.calls), 1)
+
+    def test_get_or_set_multi(self):
+        self.gs.set("pre1", "cached")
+        factory = self.slow_factory({"2" : "two", "3" : "three", "extra" : "x"})
+        results = self.run_threads(lambda: self.gs.get_or_set_multi(
+            ["1", "2", "3"], factory, key_prefix="pre"))
+        for result in results:
+            self.assertEqual(result, {"1" : "cached", "2" : "two", "3" : "three"})
+        self.assertEqual(self.calls, [(["2", "3"],)],
+            "factory was not called once with just the missing keys")
+        self.assertIsNone(self.gs.get("preextra"),
+            "a key which was not asked for was stored")
+
+    def counter(self):
+        def factory():
+            self.calls.append(())
+            return len(self.calls)
+        return factory
+
+    def test_stale_while_revalidate(self):
+        factory = self.counter()
+        deferred = []
+        self.assertEqual(self.gs.get_or_set("key", factory, time=0.05, stale_time=60), 1)
+        self.assertEqual(self.gs.get_or_set("key", factory, time=0.05, stale_time=60,
+                                            refresh=deferred.append), 1)
+        self.assertEqual(deferred, [], "a fresh value was refreshed")
+        time.sleep(0.1)
+
+        for _ in range(5):
+            self.assertEqual(self.gs.get_or_set("key", factory, time=0.05, stale_time=60,
+                                                refresh=deferred.append), 1,
+                "stale value was not returned while refreshing")
+        self.assertEqual(len(deferred), 1,
+            "more than one refresh was started")
+        self.assertEqual(deferred[0](), 2)
+        self.assertEqual(self.gs.get("key"), 2)
+
+        time.sleep(0.1)
+        self.assertEqual(self.gs.get_or_set("key", factory, time=0.05, stale_time=60), 3,
+            "refresh run by the caller did not return the new value")
+
+    def test_stale_refresh_error(self):
+        self.gs.get_or_set("key", lambda: "old", time=0.05, stale_time=60)
+        time.sleep(0.1)
+        def broken():
+            raise KeyError("broken")
+        self.assertEqual(self.gs.get_or_set("key", broken, time=0.05, stale_time=60), "old",
+            "failed refresh did not fall back to the stale value")
+        self.assertEqual(self.gs.get_or_set("key", lambda: "new", time=0.05, stale_time=60),
+            "new", "failed refresh was not retried")
+
+    def test_early_refresh(self):
+        factory = self.counter()
+        self.gs.get_or_set("key", factory, time=300, beta=1)
+        self.gs.stash.flights.record("key", 1e6)
+        self.assertEqual(self.gs.get_or_set("key", factory, time=300, beta=1), 2,
+            "slow computation close to expiry was not refreshed early")
+        self.gs.stash.flights.record("key", 1e-9)
+        self.assertEqual(self.gs.get_or_set("key", factory, time=300, beta=1), 2,
+            "fast computation far from expiry was refreshed early")
+
+class Test_gemstash_memoize(unittest.TestCase):
+
+    def setUp(self):
+        self.gs = gemstash.Client(gemstash.Stash())
+        self.calls = []
+
+        @gemstash.memoize(self.gs, time=300)
+        def add(a, b=0):
+            self.calls.append((a, b))
+            return a + b
+        self.add = add
+
+    def test_memoize(self):
+        self.assertEqual(self.add(1, 2), 3)
+        self.assertEqual(self.add(1, 2), 3)
+        self.assertEqual(self.add(1, b=2), 3)
+        self.assertEqual(self.add("a", "b"), "ab")
+        self.assertEqual(self.calls, [(1, 2), (1, 2), ("a", "b")],
+            "results were not cached")
+        self.assertEqual(self.add.__name__, "add")
+        # the results are kept in a namespace, with no other keys
+        prefix = self.gs.namespace_prefix(self.add.__module__ + "." + self.add.__qualname__)
+        self.assertEqual(len(self.gs.stash), 3)
+        self.assertTrue(all(key.startswith(prefix) for key in self.gs.stash))
+
+    def test_invalidate(self):
+        self.add(1, 2)
+        self.add(3, 4)
+        self.add.invalidate(1, 2)
+        self.add(1, 2)
+        self.add(3, 4)
+        self.assertEqual(self.calls, [(1, 2), (3, 4), (1, 2)])
+        self.add.invalidate_all()
+        self.add(1, 2)
+        self.add(3, 4)
+        self.assertEqual(self.calls, [(1, 2), (3, 4), (1, 2), (1, 2), (3, 4)],
+            "invalidate_all did not forget every result")
+
+    def test_multi(self):
+        self.add(1, 1)
+        self.assertEqual(self.add.multi([(1, 1), (2, 2), (3,)]), [2, 4, 3])
+        self.assertEqual(self.calls, [(1, 1), (2, 2), (3, 0)])
+        self.assertEqual(self.add.multi([(2, 2), (3,)]), [4, 3])
+        self.assertEqual(len(self.calls), 3,
+            "results cached by multi were recomputed")
+
+    def test_arguments(self):
+        @gemstash.memoize(self.gs, time=300)
+        def echo(*args, **kwargs):
+            self.calls.append((args, kwargs))
+            return args, kwargs
+        self.assertEqual(echo(1, a=1), ((1,), {"a" : 1}))
+        self.assertEqual(echo((1,), (("a", 1),)), (((1,), (("a", 1),)), {}),
+            "positional arguments collided with keyword arguments")
+        self.assertEqual(echo(1.0), ((1.0,), {}))
+        self.assertEqual(echo(True), ((True,), {}))
+        self.assertEqual(echo("1, 2"), (("1, 2",), {}))
+        self.assertEqual(echo("1", "2"), (("1", "2"), {}))
+        self.assertEqual(len(self.calls), 6)
+        self.assertEqual(echo(b=[1, {2}], a={"x" : None}), ((), {"a" : {"x" : None},
+                                                                 "b" : [1, {2}]}))
+        echo(a={"x" : None}, b=[1, {2}])
+        self.assertEqual(len(self.calls), 7)
+        with self.assertRaises(TypeError):
+            echo(object())
+        with self.assertRaises(TypeError):
+            echo(key=lambda: None)
+
+    def test_key_prefix(self):
+        with self.assertRaises(gemstash.Client.MemcachedKeyLengthError):
+            gemstash.memoize(self.gs, key_prefix="x" * 250)(len)
+        with self.assertRaises(gemstash.Client.MemcachedKeyCharacterError):
+            gemstash.memoize(self.gs, key_prefix="has space")(len)
+        memoized_len = gemstash.memoize(self.gs, key_prefix="len")(len)
+        self.assertEqual(memoized_len("four"), 4)
+        self.assertTrue(any(key.startswith(self.gs.namespace_prefix("len"))
+                            for key in self.gs.stash))
+
+
+class Test_gemstash_stats(unittest.TestCase):
+
+    PAST = int(time.time()) - 60*60*48
+
+    def setUp(self):
+        self.stashes = [gemstash.Stash(), gemstash.MimicStash(),
+                        gemstash.ShardedStash(shards=4)]
+
+    def test_counters(self):
+        for stash in self.stashes:
+            gs = gemstash.Client(stash)
+            gs.set("foo", "bar")
+            gs.set("count", 5)
+            gs.get("foo")
+            gs.get("missing")
+            gs.incr("count")
+            gs.decr("count")
+            gs.incr("missing")
+            gs.append("foo", "baz")
+            gs.delete("foo")
+            gs.delete("foo")
+            stats = stash.get_stats()
+            self.assertEqual(stats['get_hits'], 1)
+            self.assertEqual(stats['get_misses'], 1)
+            self.assertEqual(stats['cmd_get'], 2)
+            self.assertEqual(stats['cmd_set'], 3, "incr or decr counted as a set")
+            self.assertEqual(stats['incr_hits'], 1)
+            self.assertEqual(stats['incr_misses'], 1)
+            self.assertEqual(stats['decr_hits'], 1)
+            self.assertEqual(stats['delete_hits'], 1)
+            self.assertEqual(stats['delete_misses'], 1)
+            self.assertEqual(stats['curr_items'], 1)
+            self.assertGreater(stats['bytes'], 0)
+
+    def test_cas(self):
+        gs = gemstash.Client(gemstash.Stash(), cache_cas=True)
+        gs.set("foo", "bar")
+        gs.gets("foo")
+        gs.cas("foo", "baz")
+        gs.cas("foo", "qux")
+        gs.cas("new", "value")
+        stats = gs.stash.get_stats()
+        self.assertEqual((stats['cas_hits'], stats['cas_badval'], stats['cas_misses']),
+                         (1, 1, 1))
+
+    def test_unfetched(self):
+        stash = gemstash.Stash(max_items=2)
+        gs = gemstash.Client(stash)
+        gs.set("read", 1)
+        gs.get("read")
+        gs.set("unread", 1)
+        gs.set("expired", 1, self.PAST)
+        gs.set("a", 1)
+        gs.set("b", 1)
+        stats = stash.get_stats()
+        self.assertEqual(stats['evictions'], 3)
+        self.assertEqual(stats['evicted_unfetched'], 2)
+        stash = gemstash.Stash()
+        stash.set("expired", 1, self.PAST)
+        stash.cleanup()
+        self.assertEqual(stash.get_stats()['expired_unfetched'], 1)
+
+    def test_client(self):
+        gs = gemstash.Client(gemstash.Stash())
+        gs.set("foo", "bar")
+        gs.get("foo")
+        [(name, stats)] = gs.get_stats()
+        self.assertEqual(name, "Stash (1)")
+        self.assertEqual(stats['get_hits'], "1")
+        self.assertEqual(stats['curr_items'], "1")
+        [(name, slabs)] = gs.get_slabs()
+        self.assertEqual(slabs['1']['number'], "1")
+        self.assertIn('reclaimed', gs.get_stats("reaper")[0][1])
+        self.assertEqual(gs.get_stats("nonsense"), [(name, {})])
+
+
+class Test_gemstash_instrumentation(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = gemstash.Histogram()
+        for i in range(1, 1001):
+            histogram.record(i / 1e6)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 1000)
+        self.assertAlmostEqual(summary['p50'], 500e-6, delta=500e-6 * 0.04)
+        self.assertAlmostEqual(summary['p99'], 990e-6, delta=990e-6 * 0.04)
+        self.assertAlmostEqual(summary['p999'], 999e-6, delta=999e-6 * 0.04)
+        self.assertAlmostEqual(summary['max'], 1000e-6, delta=1e-9)
+        histogram.record(3600)
+        self.assertEqual(histogram.summary()['count'], 1001)
+
+    def test_instrument(self):
+        for stash in (gemstash.Stash(), gemstash.ShardedStash(shards=4)):
+            gs = gemstash.Client(stash)
+            classes = type(gs), type(stash)
+            client_instrumentation = gemstash.Instrumentation(gs)
+            stash_instrumentation = gemstash.Instrumentation(stash)
+            gs.set("foo", "bar")
+            self.assertEqual(gs.get("foo"), "bar")
+            gs.get("missing")
+            gs.touch("foo", 100)
+            gs.get_prefix("fo")
+            gs.delete("foo")
+            report = client_instrumentation.report()
+            self.assertEqual(report['get']['count'], 2)
+            self.assertEqual(report['set']['count'], 1)
+            self.assertEqual(report['touch']['count'], 1)
+            self.assertEqual(report['get_prefix']['count'], 1)
+            self.assertNotIn('append', report, "unused operation was reported")
+            report = stash_instrumentation.report()
+            self.assertEqual(report['get']['count'], 2)
+            self.assertEqual(report['delete']['count'], 1)
+            self.assertIsInstance(stash, classes[1])
+            self.assertEqual(gs.get_stats()[0][0], "{} (1)".format(classes[1].__name__))
+            client_instrumentation.remove()
+            stash_instrumentation.remove()
+            self.assertEqual((type(gs), type(stash)), classes,
+                "remove did not restore the original classes")
+
+    def test_hooks(self):
+        gs = gemstash.Client(gemstash.Stash())
+        instrumentation = gemstash.Instrumentation(gs, ops=['get', 'incr'])
+        calls = []
+        instrumentation.add_hook(before=lambda op, args: calls.append(("before", op, args)),
+                                 after=lambda op, args, result, error, seconds:
+                                     calls.append(("after", op, result, type(error))))
+        gs.set("foo", "bar")
+        gs.get("foo")
+        with self.assertRaises(ValueError):
+            gs.incr("foo")
+        self.assertEqual(calls, [("before", "get", ("foo",)),
+                                 ("after", "get", "bar", type(None)),
+                                 ("before", "incr", ("foo",)),
+                                 ("after", "incr", None, ValueError)])
+        self.assertEqual(set(instrumentation.report()), {'get', 'incr'})
+
+
+class Test_gemstash_lock_profiling(unittest.TestCase):
+
+    def test_profiled_lock(self):
+        for stash in (gemstash.Stash(profile_lock=True),
+                      gemstash.ShardedStash(shards=2, profile_lock=True)):
+            gs = gemstash.Client(stash)
+            gs.set("foo", "bar")
+            gs.append("foo", "baz")
+            stash.cleanup()
+            stats = stash.get_stats("locks")
+            self.assertEqual(stats['append:acquires'], 1)
+            self.assertGreaterEqual(stats['set:acquires'], 1)
+            self.assertIn('cleanup:hold_seconds', stats)
+            self.assertEqual(stats['acquires'], sum(value for name, value in stats.items()
+                                                    if name.endswith(":acquires")))
+        self.assertEqual(gemstash.Stash().get_stats("locks"), {})
+
+    def test_contention(self):
+        stash = gemstash.Stash(profile_lock=True)
+        gs = gemstash.Client(stash)
+        gs.set("foo", "bar")
+        held = threading.Event()
+
+        def hold():
+            with stash.write_lock.held("hold"):
+                held.set()
+                time.sleep(0.05)
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        held.wait()
+        gs.append("foo", "baz")
+        thread.join()
+        stats = stash.write_lock.stats
+        self.assertEqual(stats['append']['contended'], 1)
+        self.assertGreater(stats['append']['wait_seconds'], 0.02)
+        self.assertGreater(stats['hold']['max_hold_seconds'], 0.04)
+        self.assertTrue(stash.write_lock.report().splitlines()[1].startswith("hold"),
+            "longest held operation was not reported first")
+
+
+    def test_op_names(self):
+        stash = gemstash.Stash(profile_lock=True)
+        stash.set("gone", "value", time.time() - 1)
+        stash.start_reaper(interval=0.01)
+        try:
+            deadline = time.time() + 5
+            while "reaper" not in stash.write_lock.stats and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            stash.stop_reaper()
+        self.assertIn("reaper", stash.write_lock.stats)
+        self.assertNotIn("run", stash.write_lock.stats)
+        # an unnamed acquisition takes the name of the first named one within it
+        with stash.write_lock:
+            stash.set("foo", "1", 0)
+            stash.incr("foo", 1)
+        with stash.write_lock:
+            pass
+        stats = stash.write_lock.stats
+        self.assertEqual(stats['set']['acquires'], 2)
+        self.assertNotIn('incr', stats)
+        self.assertEqual(stats['other']['acquires'], 1)
+        lock = gemstash.Stash().write_lock
+        self.assertIs(lock.held("set"), lock)
+
+
+class Test_gemstash_bulk(unittest.TestCase):
+
+    PAST = int(time.time()) - 60*60*48
+
+    def stashes(self, **kwargs):
+        yield gemstash.Stash(**kwargs)
+        yield gemstash.MimicStash(**kwargs)
+        yield gemstash.ShardedStash(shards=4, **kwargs)
+        with tempfile.TemporaryDirectory() as tempdir:
+            stash = gemstash.TieredStash(os.path.join(tempdir, "segment"), **kwargs)
+            yield stash
+            stash.close()
+
+    def test_multi(self):
+        for stash in self.stashes():
+            gs = gemstash.Client(stash, cache_cas=True)
+            self.assertEqual(gs.set_multi({"foo" : "bar", "int" : 1}, key_prefix="p_"), [])
+            gs.set("p_old", "value", self.PAST)
+            self.assertEqual(stash.get_multi(["p_foo", "p_old", "missing"]).keys(), {"p_foo"})
+            self.assertEqual(gs.get_multi(["foo", "int", "old"], key_prefix="p_"),
+                             {"foo" : "bar", "int" : 1})
+            self.assertIn("foo", gs.cas_cache)
+            self.assertTrue(gs.delete_multi(["foo", "missing"], key_prefix="p_"))
+            self.assertEqual(gs.get_multi(["foo", "int"], key_prefix="p_"), {"int" : 1})
+            stats = stash.get_stats()
+            self.assertEqual(stats['get_hits'], 4)
+            self.assertEqual(stats['get_misses'], 4)
+            self.assertEqual(stats['cmd_set'], 3)
+            self.assertEqual((stats['delete_hits'], stats['delete_misses']), (1, 1))
+
+    def test_atomic_set(self):
+        for stash in self.stashes(max_items=8):
+            gs = gemstash.Client(stash)
+            gs.set("keep", "value")
+            keys = ("key{}".format(i) for i in itertools.count())
+            pair = ["a", "b"]
+            if isinstance(stash, gemstash.ShardedStash):
+                # each shard holds two items, so send the batch to the shard
+                # holding "keep", where it cannot fit, and the pair elsewhere
+                home = stash.shard("keep")
+                keys = (key for key in keys if stash.shard(key) is home)
+                pair = [key for key in "abcdefghijklmnop" if stash.shard(key) is not home][:2]
+            mapping = {key : i for i, key in zip(range(20), keys)}
+            failures = gs.set_multi(mapping, atomic=True)
+            if isinstance(stash, gemstash.TieredStash):
+                # items which do not fit in memory go to disk
+                self.assertEqual(failures, [])
+                continue
+            self.assertEqual(sorted(failures), sorted(mapping))
+            self.assertEqual(gs.get("keep"), "value", "failed atomic set changed the stash")
+            self.assertEqual(gs.set_multi({pair[0] : 1, pair[1] : 2}, atomic=True), [])
+            self.assertEqual(gs.get_multi(pair + ["keep"]),
+                             {pair[0] : 1, pair[1] : 2, "keep" : "value"})
+
+    def test_atomic_delete(self):
+        for stash in self.stashes():
+            gs = gemstash.Client(stash)
+            gs.set_multi({"a" : 1, "b" : 2})
+            self.assertFalse(gs.delete_multi(["a", "b", "missing"], atomic=True))
+            self.assertEqual(gs.get_multi(["a", "b"]), {"a" : 1, "b" : 2},
+                "failed atomic delete removed keys")
+            self.assertTrue(gs.delete_multi(["a", "b"], atomic=True))
+            self.assertEqual(len(stash), 0)
+
+    @unittest.skipIf(gemstash.shared_memory is None, "requires python 3.8")
+    def test_shared_memory(self):
+        stash = gemstash.SharedMemoryStash(slots=16, data_size=256)
+        try:
+            gs = gemstash.Client(stash)
+            self.assertEqual(gs.set_multi({"a" : 1, "b" : "two"}), [])
+            self.assertEqual(gs.get_multi(["a", "b", "c"]), {"a" : 1, "b" : "two"})
+            big = {"key{}".format(i) : "x" * 30 for i in range(10)}
+            self.assertEqual(sorted(gs.set_multi(big, atomic=True)), sorted(big))
+            self.assertEqual(len(stash), 2)
+            self.assertFalse(gs.delete_multi(["a", "c"], atomic=True))
+            self.assertTrue(gs.delete_multi(["a", "a", "b"]))
+            self.assertEqual(len(stash), 0)
+        finally:
+            stash.close()
+            stash.unlink()
+
+
+class Test_gemstash_compression(unittest.TestCase):
+
+    def stashes(self):
+        yield gemstash.Stash()
+        yield gemstash.MimicStash()
+        yield gemstash.ShardedStash(shards=4)
+        with tempfile.TemporaryDirectory() as tempdir:
+            stash = gemstash.TieredStash(os.path.join(tempdir, "segment"), max_items=1)
+            yield stash
+            stash.close()
+
+    def test_compression(self):
+        text = "spam and eggs " * 100
+        for stash in self.stashes():
+            gs = gemstash.Client(stash)
+            gs.set("text", text, min_compress_len=100)
+            gs.set("short", "spam", min_compress_len=100)
+            gs.set_multi({"bytes" : b"\0" * 1000}, min_compress_len=100)
+            self.assertEqual(gs.get("text"), text)
+            self.assertEqual(gs.get_multi(["short", "bytes"]),
+                             {"short" : "spam", "bytes" : b"\0" * 1000})
+            self.assertTrue(gs.append("text", "!"))
+            self.assertTrue(gs.prepend("text", 1))
+            self.assertFalse(gs.append("bytes", "not bytes"))
+            self.assertEqual(gs.get("text"), "1" + text + "!")
+            stats = stash.get_stats("compression")
+            if isinstance(stash, gemstash.TieredStash):
+                # only the items held in memory are counted
+                continue
+            self.assertEqual(stats['compressed_items'], 2)
+            self.assertEqual(stats['compressed_raw_bytes'], len(text) + 2 + 1000)
+            self.assertLess(stats['compressed_bytes'], 200)
+
+    def test_frames(self):
+        value = gemstash.Compressed.compress("a" * 1000, 100)
+        self.assertEqual(len(value.frames), 1)
+        for i in range(25):
+            value = value.append("b" * 10)
+        self.assertEqual(len(value.frames), 3)
+        self.assertEqual(value.tail, b"b" * 50)
+        value = value.prepend("c" * 50)
+        self.assertEqual(value.head, b"c" * 50)
+        self.assertEqual(value.decompress(), "c" * 50 + "a" * 1000 + "b" * 250)
+        self.assertEqual(value.raw_length, 1300)
+        self.assertIsNone(gemstash.Compressed.compress(os.urandom(200), 100))
+
+    def test_codec(self):
+        gemstash.register_codec("reversed", lambda data: data[::-1][:-1],
+                                lambda data: (data + b"x")[::-1])
+        try:
+            gs = gemstash.Client(gemstash.Stash(), codec="reversed")
+            gs.set("foo", "x" * 20 + "y", min_compress_len=10)
+            self.assertEqual(gs.stash["foo"][0].codec, "reversed")
+            self.assertEqual(gs.get("foo"), "x" * 20 + "y")
+        finally:
+            del gemstash.CODECS["reversed"]
+        self.assertRaises(ValueError, gemstash.Client, gemstash.Stash(), codec="reversed")
+
+
+class Test_gemstash_value_length(unittest.TestCase):
+
+    LIMIT = gemstash.SERVER_MAX_VALUE_LENGTH
+
+    def test_client_limit(self):
+        gs = gemstash.Client(gemstash.Stash())
+        self.assertTrue(gs.set("foo", "x" * self.LIMIT))
+        self.assertFalse(gs.set("foo", "x" * (self.LIMIT + 1)))
+        self.assertFalse(gs.set("foo", "é" * (self.LIMIT // 2 + 1)))
+        self.assertEqual(len(gs.get("foo")), self.LIMIT)
+        self.assertFalse(gs.add("bar", b"x" * (self.LIMIT + 1)))
+        self.assertEqual(gs.set_multi({"a" : 1, "b" : b"x" * (self.LIMIT + 1)}), ["b"])
+        self.assertEqual(gs.get("a"), 1)
+        # compressed values are measured after compression
+        self.assertTrue(gs.set("foo", "x" * (self.LIMIT + 1), min_compress_len=1))
+        gs = gemstash.Client(gemstash.Stash(), server_max_value_length=0)
+        self.assertTrue(gs.set("foo", "x" * (self.LIMIT + 1)))
+
+    def test_stash_limit(self):
+        stash = gemstash.MimicStash()
+        self.assertTrue(stash.set("foo", 1, 0))
+        self.assertFalse(stash.set("foo", "x" * (self.LIMIT + 1), 0))
+        self.assertEqual(stash["foo"][0], 1)
+        self.assertTrue(gemstash.Stash().set("foo", "x" * (self.LIMIT + 1), 0))
+        with tempfile.TemporaryDirectory() as tempdir:
+            stashes = [gemstash.Stash(max_value_length=10),
+                       gemstash.ShardedStash(shards=2, max_value_length=10),
+                       gemstash.TieredStash(os.path.join(tempdir, "segment"),
+                                            max_items=1, max_value_length=10)]
+            for stash in stashes:
+                self.assertTrue(stash.set("foo", "x" * 10, 0))
+                self.assertFalse(stash.set("bar", "x" * 11, 0))
+                self.assertTrue(stash.set("bar", ["x"] * 11, 0))
+                self.assertEqual(stash.set_multi({"a" : "a", "b" : "b" * 11}, 0), ["b"])
+                self.assertEqual(sorted(stash.set_multi({"c" : "c", "d" : "d" * 11}, 0,
+                                                        atomic=True)), ["c", "d"])
+                self.assertIsNone(stash["c"])
+            stashes[2].close()
+
+    @unittest.skipIf(gemstash.shared_memory is None, "requires python 3.8")
+    def test_shared_memory(self):
+        stash = gemstash.SharedMemoryStash(slots=16, data_size=1024, max_value_length=10)
+        try:
+            self.assertTrue(stash.set("foo", "x" * 10, 0))
+            self.assertFalse(stash.set("foo", "x" * 11, 0))
+            self.assertEqual(stash.set_multi({"a" : "a", "b" : "b" * 11}, 0), ["b"])
+            self.assertEqual(stash["foo"][0], "x" * 10)
+        finally:
+            stash.close()
+            stash.unlink()
+
+    def test_chunked(self):
+        data = bytes(range(256)) * 10000
+        text = "é" * 1000
+        for stash in (gemstash.Stash(), gemstash.MimicStash()):
+            gs = gemstash.Client(stash, chunk_size=1000)
+            self.assertTrue(gs.set("data", data))
+            self.assertTrue(gs.set("text", text))
+            self.assertTrue(gs.set("small", "x" * 1000))
+            stored = stash["data"][0]
+            self.assertIsInstance(stored, gemstash.Chunked)
+            self.assertEqual(max(map(len, stored.chunks)), 1000)
+            value = gs.get("data")
+            self.assertIs(value, stored)
+            self.assertEqual(value, data)
+            self.assertNotEqual(value, data[:-1] + b"x")
+            self.assertEqual(b"".join(value), data)
+            self.assertIsInstance(next(iter(value)), memoryview)
+            self.assertEqual(bytes(value), data)
+            self.assertEqual(gs.get_multi(["text", "small"]),
+                             {"text" : text, "small" : "x" * 1000})
+            self.assertFalse(gs.append("data", b"more"))
+        self.assertRaises(ValueError, gemstash.Client, gemstash.Stash(),
+                          chunk_size=self.LIMIT + 1)
+
+
+class Test_gemstash_mimic_codec(unittest.TestCase):
+
+    def test_decoded_once(self):
+        stash = gemstash.MimicStash()
+        gs = gemstash.Client(stash)
+        gs.set("foo", "x" * 100)
+        item = stash.cache["foo"]
+        self.assertFalse(item.fetched)
+        self.assertIs(gs.get("foo"), gs.get("foo"))
+        self.assertTrue(item.fetched)
+        self.assertEqual(item.value, b"x" * 100)
+        gs.append("foo", "y")
+        self.assertFalse(stash.cache["foo"].fetched)
+        self.assertEqual(gs.get("foo"), "x" * 100 + "y")
+        self.assertEqual(stash.lookup("foo")[0], "x" * 100 + "y")
+
+    def test_encoding(self):
+        stash = gemstash.MimicStash()
+        gs = gemstash.Client(stash)
+        gs.set_multi({"int" : 12, "float" : 1.5, "bytes" : b"ab", "list" : [1]})
+        self.assertEqual([stash.cache[key].value for key in ("int", "float", "bytes", "list")],
+                         [b"12", b"1.5", b"b'ab'", b"[1]"])
+        self.assertEqual(gs.incr("int", 3), 15)
+        self.assertEqual(gs.get("int"), 15)
+        self.assertTrue(gs.append("float", "0"))
+        self.assertEqual(gs.get("float"), 1.5)
+        # appending to an int may make it unreadable, as in memcached
+        self.assertTrue(gs.append("int", "x"))
+        self.assertRaises(ValueError, gs.get, "int")
+        self.assertRaises(ValueError, gs.append, "int", "y")
+        gs.set("true", True)
+        self.assertRaises(ValueError, gs.get, "true")
+
+
+class Test_gemstash_ring(unittest.TestCase):
+
+    KEYS = ["key{}".format(i) for i in range(20000)]
+
+    def owners(self, ring):
+        return {key : ring.shard(key) for key in self.KEYS}
+
+    def named_stashes(self, n):
+        # stashes are placed on the ring by name, if they have one
+        stashes = [gemstash.Stash() for _ in range(n)]
+        for i, stash in enumerate(stashes):
+            stash.name = "stash{}".format(i)
+        return stashes
+
+    def test_distribution(self):
+        stashes = self.named_stashes(5)
+        ring = gemstash.RingStash(stashes[:4] + [(stashes[4], 2)])
+        counts = collections.Counter(map(id, self.owners(ring).values()))
+        for stash in stashes[:4]:
+            self.assertAlmostEqual(counts[id(stash)] / len(self.KEYS), 1 / 6, delta=0.05)
+        self.assertAlmostEqual(counts[id(stashes[4])] / len(self.KEYS), 2 / 6, delta=0.05)
+
+    def test_remapping(self):
+        stashes = self.named_stashes(5)
+        ring = gemstash.RingStash(stashes[:4])
+        before = self.owners(ring)
+        ring.set_servers(stashes)
+        after = self.owners(ring)
+        moved = [key for key in self.KEYS if after[key] is not before[key]]
+        self.assertAlmostEqual(len(moved) / len(self.KEYS), 1 / 5, delta=0.07)
+        self.assertTrue(all(after[key] is stashes[4] for key in moved),
+                        "keys moved between stashes which remained")
+        ring.set_servers(stashes[1:])
+        removed = [key for key in self.KEYS if after[key] is stashes[0]]
+        self.assertEqual([key for key in self.KEYS if ring.shard(key) is not after[key]],
+                         removed)
+
+    def test_client(self):
+        calls = collections.Counter()
+
+        class CountingStash(gemstash.Stash):
+            def get_multi(self, keys):
+                calls['get_multi'] += 1
+                return super().get_multi(keys)
+
+            def set_multi(self, mapping, time, atomic=False):
+                calls['set_multi'] += 1
+                return super().set_multi(mapping, time, atomic)
+
+        stashes = [CountingStash() for _ in range(3)]
+        gs = gemstash.Client([stashes[0], (stashes[1], 2), stashes[2]])
+        mapping = {key : key for key in self.KEYS[:100]}
+        self.assertEqual(gs.set_multi(mapping), [])
+        self.assertEqual(gs.get_multi(list(mapping)), mapping)
+        self.assertEqual(calls, {'get_multi' : 3, 'set_multi' : 3})
+        self.assertEqual(sum(len(stash) for stash in stashes), 100)
+        self.assertTrue(all(stash[key] for stash in stashes for key in stash))
+        self.assertEqual(gs.set_multi({"a" : 1, "b" : 2}, atomic=True), [])
+        self.assertEqual(gs.incr("a"), 2)
+        self.assertEqual([name for name, stats in gs.get_stats()],
+                         ["CountingStash (1)", "CountingStash (2)", "CountingStash (1)"])
+        self.assertEqual(sum(int(stats['curr_items']) for _, stats in gs.get_stats()), 102)
+        ring = gs.stash
+        gs.set_servers(stashes[:2])
+        self.assertIs(gs.stash, ring)
+        self.assertEqual(len(ring.shards), 2)
+        gs.set_servers(stashes[2])
+        self.assertIs(gs.stash, stashes[2])
+
+    @unittest.skipIf(gemstash.shared_memory is None, "requires python 3.8")
+    def test_shared_namespaces(self):
+        shared = [gemstash.SharedMemoryStash(slots=64, data_size=4096) for i in range(2)]
+        try:
+            attached = [gemstash.SharedMemoryStash(stash.name, create=False,
+                                                   lock=stash.write_lock)
+                        for stash in shared]
+            first, second = gemstash.Client(shared), gemstash.Client(attached)
+            first.set(first.namespace_prefix("t") + "a", 1)
+            self.assertEqual(second.get(second.namespace_prefix("t") + "a"), 1)
+            self.assertEqual(first.invalidate_namespace("t"), 1)
+            self.assertEqual(second.namespace_prefix("t"), first.namespace_prefix("t"))
+            self.assertIsNone(second.get(second.namespace_prefix("t") + "a"),
+                "an invalidated namespace was still read by another client")
+            for stash in attached:
+                stash.close()
+        finally:
+            for stash in shared:
+                stash.close()
+                stash.unlink()
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "requires python 3.7")
+class Test_gemstash_server(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.stash = gemstash.Stash()
+        self.server = self.serve(self.stash)
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+    def serve(self, stash, **kwargs):
+        return self.loop.run_until_complete(gemstash.server.serve(stash, port=0, **kwargs))
+
+    def send(self, request, server=None):
+        """Send request on a new connection, and return all the responses."""
+        port = (server or self.server).sockets[0].getsockname()[1]
+        async def talk():
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(request + b"quit\r\n")
+            response = await reader.read()
+            writer.close()
+            return response
+        return self.loop.run_until_complete(talk())
+
+    def test_storage(self):
+        self.assertEqual(self.send(b"set a 5 0 3\r\nabc\r\nget a\r\n"),
+                         b"STORED\r\nVALUE a 5 3\r\nabc\r\nEND\r\n")
+        self.assertEqual(self.stash["a"][0], gemstash.RawValue(5, b"abc"))
+        self.assertEqual(self.send(b"add a 0 0 1\r\nx\r\nadd b 0 0 1\r\nx\r\n"),
+                         b"NOT_STORED\r\nSTORED\r\n")
+        self.assertEqual(self.send(b"replace c 0 0 1\r\nx\r\nreplace b 1 0 1\r\ny\r\n"),
+                         b"NOT_STORED\r\nSTORED\r\n")
+        self.assertEqual(self.send(b"append a 0 0 2\r\nde\r\nprepend a 0 0 1\r\n_\r\n"
+                                   b"append c 0 0 1\r\nx\r\nget a b c\r\n"),
+                         b"STORED\r\nSTORED\r\nNOT_STORED\r\n"
+                         b"VALUE a 5 6\r\n_abcde\r\nVALUE b 1 1\r\ny\r\nEND\r\n")
+        self.assertEqual(self.send(b"delete a\r\ndelete a\r\nget a\r\n"),
+                         b"DELETED\r\nNOT_FOUND\r\nEND\r\n")
+        self.assertEqual(self.send(b"set a 0 0 1 noreply\r\nx\r\nget a\r\n"),
+                         b"VALUE a 0 1\r\nx\r\nEND\r\n")
+        self.assertEqual(self.send(b"flush_all\r\nget a b\r\n"), b"OK\r\nEND\r\n")
+
+    def test_cas(self):
+        self.send(b"set a 0 0 1\r\nx\r\n")
+        cas_id = self.stash["a"][1]
+        self.assertEqual(self.send(b"gets a\r\n"),
+                         b"VALUE a 0 1 %d\r\nx\r\nEND\r\n" % cas_id)
+        self.assertEqual(self.send(b"cas a 0 0 1 %d\r\ny\r\ncas a 0 0 1 %d\r\nz\r\n"
+                                   b"cas b 0 0 1 1\r\nz\r\nget a\r\n" % (cas_id, cas_id)),
+                         b"STORED\r\nEXISTS\r\nNOT_FOUND\r\nVALUE a 0 1\r\ny\r\nEND\r\n")
+        lines = self.send(b"stats\r\n").split(b"\r\n")
+        stats = dict(line.split(b" ")[1:] for line in lines if line.startswith(b"STAT"))
+        self.assertEqual((stats[b"cas_hits"], stats[b"cas_badval"], stats[b"cas_misses"]),
+                         (b"1", b"1", b"1"))
+
+    def test_incr_decr(self):
+        self.assertEqual(self.send(b"set n 3 0 2\r\n10\r\nincr n 5\r\ndecr n 100\r\n"
+                                   b"incr n 18446744073709551615\r\nincr m 1\r\n"
+                                   b"incr n x\r\nget n\r\n"),
+                         b"STORED\r\n15\r\n0\r\n18446744073709551615\r\nNOT_FOUND\r\n"
+                         b"CLIENT_ERROR invalid numeric delta argument\r\n"
+                         b"VALUE n 3 20\r\n18446744073709551615\r\nEND\r\n")
+        self.assertEqual(self.send(b"incr n 2\r\nset s 0 0 1\r\nx\r\nincr s 1\r\n"),
+                         b"1\r\nSTORED\r\n"
+                         b"CLIENT_ERROR cannot increment or decrement non-numeric value\r\n")
+
+    def test_python_values(self):
+        gs = gemstash.Client(self.stash)
+        gs.set("i", 42)
+        gs.set("s", "caf\u00e9")
+        gs.set("l", [1, 2])
+        response = self.send(b"get i s\r\nincr i 1\r\n")
+        self.assertEqual(response, b"VALUE i 2 2\r\n42\r\nVALUE s 16 5\r\ncaf\xc3\xa9\r\n"
+                                   b"END\r\n43\r\n")
+        self.assertEqual(gs.get("i"), 43)
+        self.assertTrue(self.send(b"get l\r\n").startswith(b"VALUE l 1 "))
+
+    def test_touch(self):
+        self.send(b"set a 0 1 1\r\nx\r\n")
+        self.assertEqual(self.send(b"touch a 100\r\ntouch b 100\r\n"),
+                         b"TOUCHED\r\nNOT_FOUND\r\n")
+        self.assertGreater(self.stash.lookup("a")[2], 50)
+        self.assertEqual(self.stash["a"][0], gemstash.RawValue(0, b"x"))
+        self.assertFalse(self.stash.touch("b", 10))
+        self.assertTrue(self.stash.touch("a", -1))
+        self.assertEqual(self.send(b"get a\r\n"), b"END\r\n")
+
+    def test_gat(self):
+        self.send(b"set a 0 1 1\r\nx\r\n")
+        cas_id = self.stash["a"][1]
+        self.assertEqual(self.send(b"gat 100 a b\r\n"), b"VALUE a 0 1\r\nx\r\nEND\r\n")
+        self.assertGreater(self.stash.lookup("a")[2], 50)
+        self.assertEqual(self.send(b"gats 100 a\r\n"),
+                         b"VALUE a 0 1 %d\r\nx\r\nEND\r\n" % cas_id)
+        self.assertEqual(self.send(b"gat 100\r\ngat\r\n"),
+                         b"ERROR\r\nCLIENT_ERROR bad command line format\r\n")
+        self.assertEqual(self.stash.touch_hits, 2)
+        self.assertEqual(self.stash.touch_misses, 1)
+
+    def test_pipelined(self):
+        request = b"".join(b"set k%d 0 0 %d\r\n%d\r\n" % (i, len(b"%d" % i), i)
+                           for i in range(100))
+        request += b"get " + b" ".join(b"k%d" % i for i in range(100)) + b"\r\n"
+        response = self.send(request)
+        self.assertEqual(response.count(b"STORED\r\n"), 100)
+        self.assertEqual(response.count(b"VALUE "), 100)
+        self.assertTrue(response.endswith(b"VALUE k99 0 2\r\n99\r\nEND\r\n"))
+        # a command split over several packets
+        port = self.server.sockets[0].getsockname()[1]
+        async def trickle():
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            for byte in b"set a 0 0 2\r\nxy\r\nget a\r\nquit\r\n":
+                writer.write(bytes([byte]))
+                await writer.drain()
+            response = await reader.read()
+            writer.close()
+            return response
+        self.assertEqual(self.loop.run_until_complete(trickle()),
+                         b"STORED\r\nVALUE a 0 2\r\nxy\r\nEND\r\n")
+
+    def test_errors(self):
+        self.assertEqual(self.send(b"bogus\r\nget\r\nset a 0 0\r\n"),
+                         b"ERROR\r\nERROR\r\nCLIENT_ERROR bad command line format\r\n")
+        server = self.serve(gemstash.Stash(), max_value_length=10)
+        self.assertEqual(self.send(b"set a 0 0 11\r\n" + b"x" * 11 + b"\r\n"
+                                   b"set b 0 0 1\r\nxx\r\nget a\r\n", server),
+                         b"SERVER_ERROR object too large for cache\r\n"
+                         b"CLIENT_ERROR bad data chunk\r\nEND\r\n")
+        server.close()
+        self.assertEqual(self.send(b"get " + b"k" * 251 + b"\r\n"),
+                         b"CLIENT_ERROR bad command line format\r\n")
+
+    def test_stats(self):
+        response = self.send(b"set a 0 0 1\r\nx\r\nget a\r\nstats\r\nversion\r\n")
+        lines = response.split(b"\r\n")
+        stats = dict(line.split(b" ")[1:] for line in lines if line.startswith(b"STAT"))
+        self.assertEqual(stats[b"get_hits"], b"1")
+        self.assertEqual(stats[b"curr_items"], b"1")
+        self.assertEqual(stats[b"curr_connections"], b"1")
+        self.assertEqual(stats[b"total_connections"], b"1")
+        self.assertEqual(lines[-2], b"VERSION gemstash")
+
+    def test_backpressure(self):
+        class Transport(object):
+            reading = True
+            def pause_reading(self):
+                self.reading = False
+            def resume_reading(self):
+                self.reading = True
+        transport = Transport()
+        protocol = gemstash.server.MemcacheProtocol(self.stash, collections.Counter())
+        protocol.connection_made(transport)
+        protocol.pause_writing()
+        self.assertFalse(transport.reading)
+        protocol.resume_writing()
+        self.assertTrue(transport.reading)
+
+    def test_mimic_and_shards(self):
+        for stash in (gemstash.MimicStash(), gemstash.ShardedStash(4, gemstash.MimicStash)):
+            server = self.serve(stash)
+            self.assertEqual(self.send(b"set a 1 0 1\r\n7\r\nappend a 0 0 1\r\n0\r\n"
+                                       b"incr a 1\r\nadd a 0 0 1\r\nx\r\nget a\r\n", server),
+                             b"STORED\r\nSTORED\r\n71\r\nNOT_STORED\r\n"
+                             b"VALUE a 1 2\r\n71\r\nEND\r\n")
+            server.close()
+        with self.assertRaises(TypeError):
+            self.serve({})
+
+    @unittest.skipIf(gemstash.shared_memory is None, "requires python 3.8")
+    def test_shared_memory(self):
+        shared = [gemstash.SharedMemoryStash(slots=64, data_size=4096) for i in range(2)]
+        try:
+            for stash in (shared[0], gemstash.RingStash(shared)):
+                stash.flush()
+                server = self.serve(stash)
+                response = self.send(b"set a 1 100 1\r\n7\r\nappend a 0 0 1\r\n0\r\n"
+                                     b"incr a 1\r\nadd a 0 0 1\r\nx\r\ngets a\r\n", server)
+                self.assertEqual(response, b"STORED\r\nSTORED\r\n71\r\nNOT_STORED\r\n"
+                                           b"VALUE a 1 2 %d\r\n71\r\nEND\r\n" % stash["a"][1])
+                self.assertGreater(stash.lookup("a")[2], 50)
+                self.assertEqual(self.send(b"cas a 0 0 1 %d\r\nx\r\ncas a 0 0 1 1\r\ny\r\n"
+                                           b"decr a 1\r\nget a\r\n" % stash["a"][1], server),
+                                 b"STORED\r\nEXISTS\r\nCLIENT_ERROR cannot increment or "
+                                 b"decrement non-numeric value\r\nVALUE a 0 1\r\nx\r\nEND\r\n")
+                server.close()
+        finally:
+            for stash in shared:
+                stash.close()
+                stash.unlink()
+
+
+class Test_gemstash_namespaces(unittest.TestCase):
+
+    STASHES = (
+        gemstash.Stash,
+        gemstash.MimicStash,
+        lambda: gemstash.ShardedStash(4),
+        lambda: gemstash.RingStash([gemstash.Stash(), gemstash.Stash()]),
+    )
+
+    def test_invalidate(self):
+        for factory in self.STASHES:
+            stash = factory()
+            gs = gemstash.Client(stash)
+            prefix = gs.namespace_prefix("tenant:1")
+            self.assertEqual(prefix, "tenant:1\x1f0\x1f")
+            self.assertEqual(gs.namespace_prefix("tenant:1"), prefix)
+            gs.set_multi({"a" : 1, "b" : 2}, key_prefix=prefix)
+            gs.set(gs.namespace_prefix("tenant:2") + "a", 3)
+            gs.set("tenant:1:0:a", 4)
+            self.assertEqual(gs.get(prefix + "a"), 1)
+            self.assertEqual(gs.invalidate_namespace("tenant:1"), 1)
+            self.assertEqual(len(stash), 4, "invalidating should not visit the keys")
+            new_prefix = gs.namespace_prefix("tenant:1")
+            self.assertEqual(new_prefix, "tenant:1\x1f1\x1f")
+            self.assertEqual(gs.get_multi(["a", "b"], key_prefix=new_prefix), {})
+            self.assertEqual(gs.get(gs.namespace_prefix("tenant:2") + "a"), 3)
+            gs.set(new_prefix + "a", 5)
+            self.assertEqual(sorted(stash.cleanup()), [prefix + "a", prefix + "b"])
+            self.assertEqual(stash.cleanup(), [])
+            self.assertEqual(gs.get(new_prefix + "a"), 5)
+            self.assertEqual(gs.get("tenant:1:0:a"), 4)
+            self.assertEqual(len(stash), 3)
+
+    def test_eviction(self):
+        stash = gemstash.Stash(max_items=100)
+        gs = gemstash.Client(stash)
+        gs.set("plain", 1)
+        mapping = {str(i) : "value" for i in range(90)}
+        gs.set_multi(mapping, key_prefix=gs.namespace_prefix("t"))
+        gs.get("plain")
+        gs.invalidate_namespace("t")
+        gs.set_multi(mapping, key_prefix=gs.namespace_prefix("t"))
+        self.assertEqual(len(stash), 100)
+        self.assertEqual(gs.get("plain"), 1)
+        self.assertEqual(gs.get_multi(mapping, key_prefix=gs.namespace_prefix("t")), mapping,
+                         "stale keys should be evicted first")
+        self.assertEqual(len(stash.cleanup()), 9)
+
+    def test_bad_namespace(self):
+        with self.assertRaises(ValueError):
+            gemstash.Stash().namespace_prefix("a\x1fb")
+        with self.assertRaises(gemstash.Client.MemcachedKeyCharacterError):
+            gemstash.Client(gemstash.Stash()).check_key(
+                gemstash.Stash().namespace_prefix("a") + "b")
+
+    @unittest.skipIf(sys.version_info < (3, 7), "requires python 3.7")
+    def test_async(self):
+        gs = gemstash.aio.AsyncClient(gemstash.Stash())
+        prefix = gs.namespace_prefix("t")
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(gs.set(prefix + "a", 1))
+            self.assertEqual(loop.run_until_complete(gs.invalidate_namespace("t")), 1)
+            self.assertIsNone(loop.run_until_complete(gs.get(gs.namespace_prefix("t") + "a")))
+        finally:
+            loop.close()
+
+
+class Test_gemstash_prefix(unittest.TestCase):
+
+    KEYS = ["user:1", "user:10", "user:2", "user:2:friends", "users", "group:1"]
+
+    STASHES = (
+        lambda: gemstash.Stash(prefix_index=True),
+        lambda: gemstash.MimicStash(prefix_index=True),
+        lambda: gemstash.ShardedStash(4, prefix_index=True),
+        lambda: gemstash.RingStash([gemstash.Stash(prefix_index=True), gemstash.Stash()]),
+        gemstash.Stash,
+    )
+
+    def test_operations(self):
+        for factory in self.STASHES:
+            stash = factory()
+            gs = gemstash.Client(stash)
+            gs.set_multi({key : key.upper() for key in self.KEYS})
+            gs.set("user:3", "gone", time=-1)
+            self.assertEqual(gs.keys_with_prefix("user:"),
+                             ["user:1", "user:10", "user:2", "user:2:friends"])
+            self.assertEqual(gs.keys_with_prefix("user:2"), ["user:2", "user:2:friends"])
+            self.assertEqual(gs.keys_with_prefix("nobody"), [])
+            self.assertEqual(gs.keys_with_prefix(""), sorted(self.KEYS))
+            self.assertEqual(gs.get_prefix("user:1"), {"" : "USER:1", "0" : "USER:10"})
+            self.assertEqual(gs.delete_prefix("user:"), 4)
+            self.assertEqual(gs.delete_prefix("user:"), 0)
+            self.assertEqual(sorted(stash), ["group:1", "users"])
+
+    def test_consistency(self):
+        stash = gemstash.Stash(max_items=20, prefix_index=True)
+        gs = gemstash.Client(stash)
+        gs.set_multi({"k{:02}".format(i) : i for i in range(30)})
+        self.assertEqual(list(stash.prefix_index), ["k{:02}".format(i) for i in range(10, 30)],
+                         "evicted keys should leave the index")
+        gs.delete("k10")
+        gs.set("k11", 1, time=-1)
+        stash.cleanup()
+        gs.set("k11", "back")
+        self.assertEqual(list(stash.prefix_index), sorted(stash))
+        self.assertEqual(len(stash.prefix_index), 19)
+        gs.flush_all()
+        self.assertEqual(list(stash.prefix_index), [])
+        self.assertEqual(gs.keys_with_prefix("k"), [])
+
+    def test_index(self):
+        index = gemstash.PrefixIndex()
+        index.BLOCK = 4
+        keys = set()
+        rng = random.Random(0)
+        for _ in range(5000):
+            key = "{:x}".format(rng.randrange(500))
+            if rng.random() < 0.6:
+                index.add(key)
+                keys.add(key)
+            else:
+                index.discard(key)
+                keys.discard(key)
+        index.add(1)
+        self.assertEqual(list(index), sorted(keys))
+        self.assertEqual(len(index), len(keys))
+        self.assertTrue(all(len(block) <= 8 for block in index._blocks))
+        for prefix in ("", "1", "1f", "ff", "g"):
+            self.assertEqual(index.prefixed(prefix),
+                             sorted(key for key in keys if key.startswith(prefix)))
+
+    def test_namespaces(self):
+        gs = gemstash.Client(gemstash.Stash(prefix_index=True))
+        gs.set_multi({"a" : 1, "b" : 2}, key_prefix=gs.namespace_prefix("t"))
+        self.assertEqual(gs.get_prefix(gs.namespace_prefix("t")), {"a" : 1, "b" : 2})
+        gs.invalidate_namespace("t")
+        self.assertEqual(gs.get_prefix(gs.namespace_prefix("t")), {})
+
+
+class Test_gemstash_touch(unittest.TestCase):
+
+    STASHES = (
+        gemstash.Stash,
+        gemstash.MimicStash,
+        lambda: gemstash.ShardedStash(4),
+        lambda: gemstash.RingStash([gemstash.Stash(), gemstash.MimicStash()]),
+    )
+
+    def owner(self, stash, key):
+        while isinstance(stash, gemstash.ShardedStash):
+            stash = stash.shard(key)
+        return stash
+
+    def test_touch(self):
+        for factory in self.STASHES:
+            stash = factory()
+            gs = gemstash.Client(stash, cache_cas=True)
+            gs.set("a", "value", 10)
+            gs.set("n", 1)
+            cas_id = stash["a"][1]
+            self.assertTrue(gs.touch("a", 1000))
+            self.assertTrue(gs.touch("n", 1000))
+            self.assertFalse(gs.touch("b", 1000))
+            self.assertEqual(stash["a"], ("value", cas_id),
+                             "touch should keep the value and its cas id")
+            self.assertGreater(stash.lookup("a")[2], 500)
+            self.assertGreater(stash.lookup("n")[2], 500)
+            self.assertTrue(gs.touch("a", 0))
+            self.assertIsNone(stash.lookup("a")[2])
+            self.assertTrue(gs.touch("a", -1))
+            self.assertIsNone(gs.get("a"))
+
+    def test_gat(self):
+        for factory in self.STASHES:
+            stash = factory()
+            gs = gemstash.Client(stash, cache_cas=True)
+            gs.set_multi({"a" : "x", "b" : 2}, time=10)
+            gs.set("z", "y" * 100, min_compress_len=10)
+            self.assertEqual(gs.gat("a", 1000), "x")
+            self.assertEqual(gs.gat("z", 1000), "y" * 100)
+            self.assertIsNone(gs.gat("c", 1000))
+            self.assertGreater(stash.lookup("a")[2], 500)
+            self.assertEqual(gs.get_multi_and_touch(["a", "b", "c"], 2000, key_prefix=""),
+                             {"a" : "x", "b" : 2})
+            self.assertGreater(stash.lookup("b")[2], 1500)
+            self.assertEqual(gs.cas_cache["b"], stash["b"][1])
+
+    def test_sliding(self):
+        for factory in self.STASHES:
+            stash = factory()
+            gs = gemstash.Client(stash)
+            gs.set_multi({"a" : "x", "b" : "y"}, time=10)
+            self.assertTrue(gs.touch("a", 1000, sliding=True))
+            owner = self.owner(stash, "a")
+            owner.cache["a"].expires = time.time() + 1
+            self.assertEqual(gs.get("a"), "x")
+            self.assertGreater(stash.lookup("a")[2], 500, "a read should push the expiry out")
+            owner.cache["a"].expires = time.time() + 1
+            self.assertEqual(gs.get_multi(["a", "b"]), {"a" : "x", "b" : "y"})
+            self.assertGreater(stash.lookup("a")[2], 500)
+            self.assertLess(stash.lookup("b")[2], 11)
+
+            gs.set("a", "z", 10)
+            self.assertLess(stash.lookup("a")[2], 11, "setting a key should stop it sliding")
+            gs.touch("a", 1000, sliding=True)
+            gs.touch("a", 10)
+            self.assertLess(stash.lookup("a")[2], 11)
+            gs.touch("a", 1000, sliding=True)
+            gs.delete("a")
+            self.assertEqual(owner._sliding, {})
+
+    def test_sliding_reaped(self):
+        stash = gemstash.Stash(max_items=2)
+        stash.set("a", "x", 10)
+        stash.touch("a", 1000, sliding=True)
+        # as if reads had pushed the deadline out past the one in the heap
+        stash.cache["a"].expires += 100
+        stash._expiry.insert(0, (time.time() - 1, -1, "a"))
+        self.assertEqual(stash.cleanup(), [])
+        self.assertIn(stash.cache["a"].expires, [entry[0] for entry in stash._expiry],
+                      "the key should be requeued at its new deadline")
+        self.assertIn("a", stash.cache)
+        stash.cache["a"].expires = time.time() - 1
+        stash._rebuild_expiry()
+        self.assertEqual(stash.cleanup(), ["a"])
+        self.assertEqual(stash._sliding, {})
+
+        stash.set("b", "x", 10)
+        stash.touch("b", 1000, sliding=True)
+        stash.set("c", "x", 0)
+        stash.set("d", "x", 0)
+        self.assertNotIn("b", stash.cache)
+        self.assertEqual(stash._sliding, {}, "evicted keys should stop sliding")
+
+    def test_sliding_time(self):
+        stash = gemstash.Stash()
+        stash.set("a", "x", 10)
+        for bad in (0, -1, int(time.time()) + 100):
+            with self.assertRaises(ValueError):
+                stash.touch("a", bad, sliding=True)
+            with self.assertRaises(ValueError):
+                stash.gat("a", bad, sliding=True)
+
+    def test_stats(self):
+        stash = gemstash.Stash()
+        stash.set("a", "x", 10)
+        stash.touch("a", 100)
+        stash.touch("b", 100)
+        stash.get_multi_and_touch(["a", "b"], 100)
+        stats = stash.get_stats()
+        self.assertEqual((stats["cmd_touch"], stats["touch_hits"], stats["touch_misses"]),
+                         (4, 2, 2))
+        self.assertEqual((stats["get_hits"], stats["get_misses"]), (1, 1))
+
+    @unittest.skipIf(sys.version_info < (3, 7), "requires python 3.7")
+    def test_async(self):
+        stash = gemstash.Stash()
+        gs = gemstash.aio.AsyncClient(stash)
+        async def run():
+            await gs.set("a", "x", 10)
+            self.assertTrue(await gs.touch("a", 1000, sliding=True))
+            self.assertEqual(await gs.gat("a", 1000), "x")
+            self.assertEqual(await gs.get_multi_and_touch(["a", "b"], 1000), {"a" : "x"})
+        asyncio.run(run())
+        self.assertGreater(stash.lookup("a")[2], 500)